@@ -4,33 +4,561 @@ Sistema SaaS CiviPro | Desenvolvido por João Layon - Desenvolvedor Full Stack
 Sistema completo para gestão de obras e orçamentos
 """
 
+import base64
+import bisect
+import calendar
+import codecs
+import csv
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
+import random
+import re
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
-from io import BytesIO
+from io import BytesIO, StringIO
+from xml.sax.saxutils import escape as xml_escape
 from flask import (
     Flask, render_template, request, redirect, url_for, flash, session,
-    send_file, jsonify
+    send_file, jsonify, g, has_app_context, make_response, Response
 )
 from werkzeug.security import generate_password_hash, check_password_hash
-from functools import wraps
+from functools import lru_cache, wraps
 
+from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 from reportlab.lib.units import cm
+from reportlab.platypus import (
+    BaseDocTemplate, CondPageBreak, Flowable, Frame, KeepTogether, PageBreak, PageTemplate, Paragraph, Spacer, Table,
+    TableStyle
+)
+from reportlab.platypus.tableofcontents import TableOfContents
+import click
 import mercadopago
+try:
+    import psycopg
+    from psycopg_pool import ConnectionPool as PsycopgPool
+except ImportError:
+    psycopg = None
+from mercadopago.config import RequestOptions
+from mercadopago.http import HttpClient
+import numpy as np
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "troque_essa_chave_producao")
 DB = "database.db"
+# Vazio ou sqlite:///caminho usa o arquivo SQLite; postgresql://... usa o
+# PostgreSQL (requer psycopg[binary,pool])
+DB_URL = os.environ.get("DB_URL", "")
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "30"))
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+# Espera (segundos) por uma conexão quando as DB_POOL_SIZE estão em uso
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+# Espera do próprio SQLite por um lock (segundos) e novas tentativas do
+# BEGIN IMMEDIATE em write_transaction quando ela se esgota
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "5"))
+DB_WRITE_RETRIES = int(os.environ.get("DB_WRITE_RETRIES", "5"))
+DB_RETRY_BASE = 0.05
+DB_RETRY_MAX = 2.0
+
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+
+def record_sql(sql, elapsed):
+    # Só conta comandos feitos dentro de uma requisição (ver /metrics)
+    if not has_app_context():
+        return
+    stats = g.get("_sql_stats")
+    if stats is None:
+        return
+    stats[0] += 1
+    stats[1] += elapsed
+    if elapsed > stats[2][0]:
+        stats[2] = (elapsed, sql)
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - started)
+
+class PooledConnection(sqlite3.Connection):
+    # close() devolve a conexão ao pool em vez de fechá-la; dentro de uma
+    # requisição ela só é liberada no teardown_appcontext
+    pool = None
+    in_request = False
+    dialect = "sqlite"
+    BEGIN_WRITE = "BEGIN IMMEDIATE"
+
+    def close(self):
+        if self.in_request:
+            return
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+    def discard(self):
+        self.pool = None
+        super().close()
+
+    # Connection.execute do sqlite3 não passa por cursor(); os atalhos são
+    # refeitos aqui para todo comando cair no TracedCursor
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def insert(self, sql, parameters=()):
+        """INSERT que devolve o id da linha criada."""
+        return self.execute(sql, parameters).lastrowid
+
+class ConnectionPool:
+    """No máximo `size` conexões abertas por processo; acima disso acquire()
+    espera uma ser devolvida, até DB_POOL_TIMEOUT segundos."""
+    dialect = "sqlite"
+
+    def __init__(self, database, size):
+        self.database = database
+        self.size = size
+        self.pid = os.getpid()
+        self._idle = []
+        self._open = 0
+        self._lock = threading.Lock()
+        self._returned = threading.Condition(self._lock)
+        self._stats = {"created": 0, "reused": 0, "released": 0, "discarded": 0,
+                       "in_use": 0, "peak_in_use": 0, "waits": 0, "timeouts": 0}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, factory=PooledConnection, check_same_thread=False, timeout=DB_BUSY_TIMEOUT)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        deadline = time.monotonic() + DB_POOL_TIMEOUT
+        with self._lock:
+            if self.pid != os.getpid():
+                # Processo filho (fork do gunicorn): conexões herdadas não são seguras
+                self._idle = []
+                self._open = 0
+                self._stats["in_use"] = 0
+                self.pid = os.getpid()
+            if not self._idle and self._open >= self.size:
+                self._stats["waits"] += 1
+                while not self._idle and self._open >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise sqlite3.OperationalError(
+                            f"pool de conexões esgotado: {self.size} em uso por mais de {DB_POOL_TIMEOUT:g}s")
+                    self._returned.wait(remaining)
+            conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._open += 1
+            self._stats["reused" if conn else "created"] += 1
+            self._stats["in_use"] += 1
+            self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._stats["in_use"])
+        if conn:
+            return conn
+        try:
+            return self._connect()
+        except Exception:
+            self._closed()
+            raise
+
+    def _closed(self):
+        with self._lock:
+            self._open -= 1
+            self._stats["in_use"] = max(0, self._stats["in_use"] - 1)
+            self._returned.notify()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._stats["in_use"] = max(0, self._stats["in_use"] - 1)
+                self._idle.append(conn)
+                self._stats["released"] += 1
+                self._returned.notify()
+                return
+            self._stats["discarded"] += 1
+        self._closed()
+        conn.discard()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle), open=self._open, size=self.size)
+
+@lru_cache(maxsize=1024)
+def postgres_sql(sql):
+    """Troca os marcadores "?" do sqlite3 por "%s" fora das strings e escapa os "%" literais."""
+    parts = re.split(r"('(?:[^']|'')*')", sql)
+    return "".join(part.replace("%", "%%") if i % 2 else part.replace("%", "%%").replace("?", "%s")
+                   for i, part in enumerate(parts))
+
+class PostgresRow(tuple):
+    """Linha acessível por índice ou por nome de coluna, como sqlite3.Row."""
+
+    def __new__(cls, values, index=None):
+        row = super().__new__(cls, values)
+        row._index = index
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return list(self._index)
+
+def postgres_row_factory(cursor):
+    index = {column.name: i for i, column in enumerate(cursor.description or ())}
+    return lambda values: PostgresRow(values, index)
+
+class PostgresCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    @property
+    def row_factory(self):
+        return self._cursor.row_factory
+
+    @row_factory.setter
+    def row_factory(self, factory):
+        # None devolve tuplas, como no sqlite3
+        self._cursor.row_factory = factory or psycopg.rows.tuple_row
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            self._cursor.execute(postgres_sql(sql), parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - started)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            self._cursor.executemany(postgres_sql(sql), seq_of_parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - started)
+        return self
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+class PostgresConnection:
+    """Conexão do psycopg com a parte da interface do sqlite3 que o app usa.
+
+    Fica em autocommit: transação só com BEGIN explícito (write_transaction),
+    como o modo legado do sqlite3 faz com as leituras."""
+    dialect = "postgresql"
+    BEGIN_WRITE = "BEGIN"
+    in_request = False
+
+    def __init__(self, raw, pool):
+        self.raw = raw
+        self.pool = pool
+        self.IntegrityError = psycopg.IntegrityError
+        self.OperationalError = psycopg.OperationalError
+
+    @property
+    def in_transaction(self):
+        return self.raw.info.transaction_status != psycopg.pq.TransactionStatus.IDLE
+
+    def cursor(self):
+        return PostgresCursor(self.raw.cursor(row_factory=postgres_row_factory))
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def insert(self, sql, parameters=()):
+        return self.execute(sql + " RETURNING id", parameters).fetchone()[0]
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        if not self.in_request:
+            self.pool.release(self)
+
+class PostgresPool:
+    """Mesma interface do ConnectionPool sobre o psycopg_pool."""
+    dialect = "postgresql"
+
+    def __init__(self, url, size):
+        if psycopg is None:
+            raise RuntimeError("DB_URL aponta para o PostgreSQL, mas o psycopg não está instalado "
+                               "(pip install \"psycopg[binary,pool]\")")
+        self.url = url
+        self.size = size
+        self.pid = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._stats = {"in_use": 0, "peak_in_use": 0}
+
+    def acquire(self):
+        with self._lock:
+            if self.pid != os.getpid():
+                # Criado no processo que vai usá-lo: sockets herdados de um fork
+                # não podem ser compartilhados
+                # max_size limita as conexões abertas; getconn() espera até timeout
+                self._pool = PsycopgPool(self.url, min_size=1, max_size=self.size, timeout=DB_POOL_TIMEOUT,
+                                         kwargs={"autocommit": True}, open=True)
+                self._stats["in_use"] = 0
+                self.pid = os.getpid()
+            pool = self._pool
+        # Conta só depois do getconn(): esgotado o timeout, ele levanta PoolTimeout
+        raw = pool.getconn()
+        with self._lock:
+            self._stats["in_use"] += 1
+            self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._stats["in_use"])
+        return PostgresConnection(raw, self)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._stats["in_use"] = max(0, self._stats["in_use"] - 1)
+            pool = self._pool
+        pool.putconn(conn.raw)
+
+    def stats(self):
+        with self._lock:
+            pool_stats = self._pool.get_stats() if self._pool else {}
+            return dict(pool_stats, **self._stats, size=self.size)
+
+def create_pool(url, size):
+    if url.startswith(("postgres://", "postgresql://")):
+        return PostgresPool(url, size)
+    return ConnectionPool(url[len("sqlite:///"):] if url.startswith("sqlite:///") else DB, size)
+
+db_pool = create_pool(DB_URL, DB_POOL_SIZE)
 
 def get_db_conn():
-    conn = sqlite3.connect(DB)
-    conn.row_factory = sqlite3.Row
+    if not has_app_context():
+        return db_pool.acquire()
+    conn = g.get("_db_conn")
+    if conn is None:
+        conn = db_pool.acquire()
+        conn.in_request = True
+        g._db_conn = conn
     return conn
 
+write_stats = {"transactions": 0, "busy_retries": 0, "busy_failures": 0}
+
+def is_busy_error(exc):
+    code = getattr(exc, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(exc) or "busy" in str(exc)
+
+@contextmanager
+def write_transaction(conn, retries=None):
+    """Transação de escrita: BEGIN IMMEDIATE, commit ao sair e rollback em erro.
+
+    O lock de escrita é pego já no início, então a transação não falha no meio
+    ao tentar promover uma leitura; se o banco continuar ocupado depois do
+    busy_timeout, o BEGIN é repetido com espera exponencial e jitter. Dentro de
+    uma transação já aberta, só participa dela (quem abriu faz o commit). No
+    PostgreSQL, com locks por linha, é um BEGIN simples."""
+    if conn.in_transaction:
+        yield conn
+        return
+    retries = DB_WRITE_RETRIES if retries is None else retries
+    for attempt in itertools.count():
+        try:
+            conn.execute(conn.BEGIN_WRITE)
+            break
+        except conn.OperationalError as e:
+            if not is_busy_error(e) or attempt >= retries:
+                write_stats["busy_failures"] += is_busy_error(e)
+                raise
+            write_stats["busy_retries"] += 1
+            time.sleep(min(DB_RETRY_MAX, DB_RETRY_BASE * 2 ** attempt) * random.uniform(0.5, 1.5))
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    write_stats["transactions"] += 1
+
+@app.teardown_appcontext
+def release_db_conn(exc):
+    conn = g.pop("_db_conn", None)
+    if conn is not None:
+        conn.in_request = False
+        db_pool.release(conn)
+
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_SLOWEST = 10
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+SERVER_TIMING = os.environ.get("SERVER_TIMING") == "1"
+
+def metric_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+class RequestMetrics:
+    # Acumulado por processo: com vários workers do gunicorn, cada um expõe o seu
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+        self.slowest = {}
+
+    def observe(self, endpoint, elapsed, queries, sql_time, slowest):
+        with self._lock:
+            route = self.routes.get(endpoint)
+            if route is None:
+                route = self.routes[endpoint] = {"buckets": [0] * (len(METRICS_BUCKETS) + 1), "count": 0,
+                                                 "sum": 0.0, "queries": 0, "sql_time": 0.0}
+            route["buckets"][bisect.bisect_left(METRICS_BUCKETS, elapsed)] += 1
+            route["count"] += 1
+            route["sum"] += elapsed
+            route["queries"] += queries
+            route["sql_time"] += sql_time
+
+            slow_time, sql = slowest
+            if sql:
+                key = (endpoint, " ".join(sql.split())[:200])
+                if slow_time > self.slowest.get(key, 0):
+                    self.slowest[key] = slow_time
+                if len(self.slowest) > METRICS_SLOWEST * 2:
+                    self.slowest = dict(sorted(self.slowest.items(), key=lambda item: -item[1])[:METRICS_SLOWEST])
+
+    def render(self):
+        lines = [
+            "# HELP civipro_request_duration_seconds Tempo de resposta por rota.",
+            "# TYPE civipro_request_duration_seconds histogram",
+        ]
+        with self._lock:
+            routes = {endpoint: dict(route, buckets=list(route["buckets"])) for endpoint, route in self.routes.items()}
+            slowest = sorted(self.slowest.items(), key=lambda item: -item[1])[:METRICS_SLOWEST]
+        for endpoint, route in sorted(routes.items()):
+            label = metric_label(endpoint)
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + ("+Inf",), route["buckets"]):
+                cumulative += count
+                lines.append(f'civipro_request_duration_seconds_bucket{{endpoint="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'civipro_request_duration_seconds_sum{{endpoint="{label}"}} {route["sum"]:.6f}')
+            lines.append(f'civipro_request_duration_seconds_count{{endpoint="{label}"}} {route["count"]}')
+        for name, field, kind, help_text in (
+            ("civipro_sql_queries_total", "queries", "counter", "Comandos SQL executados, por rota."),
+            ("civipro_sql_duration_seconds_total", "sql_time", "counter", "Tempo gasto em SQL, por rota."),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            lines += [f'{name}{{endpoint="{metric_label(endpoint)}"}} {route[field]:.6g}' for endpoint, route in sorted(routes.items())]
+        lines += ["# HELP civipro_sql_slowest_seconds Comandos SQL mais lentos vistos até agora.",
+                  "# TYPE civipro_sql_slowest_seconds gauge"]
+        lines += [f'civipro_sql_slowest_seconds{{endpoint="{metric_label(endpoint)}",statement="{metric_label(sql)}"}} {elapsed:.6f}'
+                  for (endpoint, sql), elapsed in slowest]
+        lines += ["# HELP civipro_db_pool Estado do pool de conexões SQLite.", "# TYPE civipro_db_pool gauge"]
+        lines += [f'civipro_db_pool{{stat="{stat}"}} {value}' for stat, value in sorted(db_pool.stats().items())
+                  if isinstance(value, int)]
+        lines += ["# HELP civipro_page_cache Cache de páginas em memória deste processo.", "# TYPE civipro_page_cache gauge"]
+        lines += [f'civipro_page_cache{{stat="{stat}"}} {value}' for stat, value in sorted(page_cache.stats().items())]
+        lines += ["# HELP civipro_db_writes_total Transações de escrita e esperas por lock neste processo.",
+                  "# TYPE civipro_db_writes_total counter"]
+        lines += [f'civipro_db_writes_total{{stat="{stat}"}} {value}' for stat, value in sorted(write_stats.items())]
+        return "\n".join(lines) + "\n"
+
+request_metrics = RequestMetrics()
+
+@app.before_request
+def start_request_metrics():
+    g._request_started = time.perf_counter()
+    g._sql_stats = [0, 0.0, (0.0, None)]
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("_request_started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    queries, sql_time, slowest = g.pop("_sql_stats")
+    request_metrics.observe(request.endpoint or "not_found", elapsed, queries, sql_time, slowest)
+    if SERVER_TIMING or app.debug:
+        response.headers["Server-Timing"] = (f'app;dur={elapsed * 1000:.1f}, '
+                                             f'db;dur={sql_time * 1000:.1f};desc="{queries} consultas"')
+    return response
+
+def metrics_authorized():
+    # Com METRICS_TOKEN, só o coletor com o Bearer; sem ele, só usuários logados
+    if METRICS_TOKEN:
+        return request.headers.get("Authorization") == f"Bearer {METRICS_TOKEN}"
+    return current_user() is not None
+
+@app.route("/metrics")
+def metrics():
+    if not metrics_authorized():
+        return Response("unauthorized\n", status=401, mimetype="text/plain")
+    return Response(request_metrics.render(), mimetype="text/plain; version=0.0.4")
+
 def init_db():
     conn = get_db_conn()
+    if conn.dialect != "sqlite":
+        run_migrations(conn)
+        with write_transaction(conn):
+            fail_stale_jobs(conn)
+        conn.close()
+        return
     c = conn.cursor()
 
     c.execute("""
@@ -152,279 +680,1351 @@ def init_db():
     )
     """)
 
-    try:
-        c.execute("ALTER TABLE projects ADD COLUMN project_type TEXT DEFAULT 'residencial'")
-    except:
-        pass
-    
-    try:
-        c.execute("ALTER TABLE projects ADD COLUMN status TEXT DEFAULT 'em_andamento'")
-    except:
-        pass
-    
-    try:
-        c.execute("ALTER TABLE projects ADD COLUMN notes TEXT")
-    except:
-        pass
-    
-    try:
-        c.execute("ALTER TABLE projects ADD COLUMN real_cost REAL DEFAULT 0")
-    except:
-        pass
-    
-    try:
-        c.execute("ALTER TABLE materials ADD COLUMN category TEXT DEFAULT 'geral'")
-    except:
-        pass
-    
-    try:
-        c.execute("ALTER TABLE projects ADD COLUMN client_id INTEGER")
-    except:
-        pass
-    
-    try:
-        c.execute("ALTER TABLE budgets ADD COLUMN item_type TEXT DEFAULT 'material'")
-    except:
-        pass
-    
-    try:
-        c.execute("ALTER TABLE users ADD COLUMN trial_start_date TEXT")
-    except:
-        pass
-    
-    try:
-        c.execute("ALTER TABLE users ADD COLUMN trial_end_date TEXT")
-    except:
-        pass
-    
-    try:
-        c.execute("ALTER TABLE users ADD COLUMN subscription_status TEXT DEFAULT 'trial'")
-    except:
-        pass
-    
-    try:
-        c.execute("ALTER TABLE users ADD COLUMN subscription_id TEXT")
-    except:
-        pass
-    
-    try:
-        c.execute("ALTER TABLE users ADD COLUMN plan_id TEXT")
-    except:
-        pass
-
     conn.commit()
+    run_migrations(conn)
+    with write_transaction(conn):
+        fail_stale_jobs(conn)
     conn.close()
 
-if not os.path.exists(DB):
-    init_db()
-else:
-    init_db()
+def add_column_if_missing(conn, table, column, definition):
+    columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
 
-def current_user():
-    uid = session.get("user_id")
-    if not uid:
-        return None
-    conn = get_db_conn()
-    user = conn.execute(
-        """SELECT id, name, email, trial_start_date, trial_end_date, 
-        subscription_status, subscription_id, plan_id FROM users WHERE id=?""", 
-        (uid,)
-    ).fetchone()
-    conn.close()
-    return user
+def migrate_legacy_columns(conn):
+    # Bancos criados antes das fases 2 e 3 não têm estas colunas
+    for table, column, definition in (
+        ("projects", "project_type", "TEXT DEFAULT 'residencial'"),
+        ("projects", "status", "TEXT DEFAULT 'em_andamento'"),
+        ("projects", "notes", "TEXT"),
+        ("projects", "real_cost", "REAL DEFAULT 0"),
+        ("projects", "client_id", "INTEGER"),
+        ("materials", "category", "TEXT DEFAULT 'geral'"),
+        ("budgets", "item_type", "TEXT DEFAULT 'material'"),
+        ("users", "trial_start_date", "TEXT"),
+        ("users", "trial_end_date", "TEXT"),
+        ("users", "subscription_status", "TEXT DEFAULT 'trial'"),
+        ("users", "subscription_id", "TEXT"),
+        ("users", "plan_id", "TEXT"),
+    ):
+        add_column_if_missing(conn, table, column, definition)
 
-def check_subscription_status(user):
-    if not user:
-        return {'active': False, 'status': 'no_user', 'days_left': 0}
-    
-    status = user['subscription_status'] or 'trial'
-    
-    if status == 'active':
-        return {'active': True, 'status': 'active', 'days_left': None, 'is_trial': False}
-    
-    if status == 'trial':
-        if user['trial_end_date']:
-            trial_end = datetime.fromisoformat(user['trial_end_date'])
-            now = datetime.utcnow()
-            if now < trial_end:
-                days_left = (trial_end - now).days + 1
-                return {'active': True, 'status': 'trial', 'days_left': days_left, 'is_trial': True}
-        
-        return {'active': False, 'status': 'trial_expired', 'days_left': 0, 'is_trial': False}
-    
-    return {'active': False, 'status': status, 'days_left': 0, 'is_trial': False}
+def migrate_budget_coefficients(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS budget_coefficients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        item_type TEXT NOT NULL,
+        name TEXT NOT NULL,
+        unit TEXT,
+        basis TEXT,
+        coefficient REAL NOT NULL,
+        min_qty REAL,
+        max_qty REAL,
+        decimals INTEGER,
+        sort_order INTEGER DEFAULT 0,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_coefficients_user_item ON budget_coefficients(user_id, item_type, name)")
+    conn.executemany(
+        """INSERT INTO budget_coefficients
+        (user_id, item_type, name, unit, basis, coefficient, min_qty, max_qty, decimals, sort_order)
+        VALUES (NULL,?,?,?,?,?,?,?,?,?)""",
+        [row + (order,) for order, row in enumerate(DEFAULT_COEFFICIENTS)]
+    )
 
-def require_active_subscription(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        user = current_user()
-        if not user:
-            flash("Faça login para acessar esta página", "warning")
-            return redirect(url_for("login"))
-        
-        subscription = check_subscription_status(user)
-        if not subscription['active']:
-            flash("Seu período de teste expirou. Assine um plano para continuar usando o CiviPro.", "danger")
-            return redirect(url_for("subscription_plans"))
-        
-        return f(*args, **kwargs)
-    return decorated_function
+# Fontes do índice de busca: código usado no rowid (id * 8 + código) e
+# campos secundários pesquisáveis
+SEARCH_SOURCES = {
+    "materials": (1, ("category", "unit")),
+    "labor": (2, ("category", "description")),
+    "equipment": (3, ("category", "description")),
+    "suppliers": (4, ("category", "email", "cnpj")),
+    "clients": (5, ("email", "cpf_cnpj", "phone")),
+}
 
-def init_default_materials(user_id):
-    conn = get_db_conn()
-    existing = conn.execute("SELECT COUNT(*) as count FROM materials WHERE user_id=?", (user_id,)).fetchone()
-    
-    if existing["count"] == 0:
-        default_materials = [
-            ("Cimento", "sacos", 35.00, "estrutura"),
-            ("Areia", "m³", 80.00, "estrutura"),
-            ("Brita", "m³", 90.00, "estrutura"),
-            ("Tijolos", "un", 0.75, "alvenaria"),
-            ("Ferro 6mm", "kg", 6.50, "estrutura"),
-            ("Ferro 8mm", "kg", 6.50, "estrutura"),
-            ("Ferro 10mm", "kg", 6.50, "estrutura"),
-            ("Cal", "sacos", 12.00, "acabamento"),
-            ("Argamassa", "sacos", 8.50, "acabamento"),
-            ("Cerâmica", "m²", 25.00, "acabamento"),
-            ("Azulejo", "m²", 30.00, "acabamento"),
-            ("Tinta", "lata", 95.00, "acabamento"),
-            ("Tubos PVC", "m", 15.00, "hidráulica"),
-            ("Fios elétricos", "m", 3.50, "elétrica"),
-        ]
-        
-        for name, unit, price, category in default_materials:
-            conn.execute(
-                "INSERT INTO materials (user_id, name, unit, price, category, updated_at) VALUES (?,?,?,?,?,?)",
-                (user_id, name, unit, price, category, datetime.utcnow().isoformat())
-            )
-        conn.commit()
-    conn.close()
+def search_trigger_sql(table):
+    code, columns = SEARCH_SOURCES[table]
+    detail = " || ' ' || ".join(f"coalesce(new.{column}, '')" for column in columns)
+    insert = f"""INSERT INTO search_index(rowid, owner, kind, ref_id, name, detail)
+        VALUES (new.id * 8 + {code}, coalesce('u' || new.user_id, 'global'), '{table}', new.id, new.name, trim({detail}));"""
+    delete = f"DELETE FROM search_index WHERE rowid = old.id * 8 + {code};"
+    return insert, delete
 
-def init_default_labor(user_id):
-    conn = get_db_conn()
-    existing = conn.execute("SELECT COUNT(*) as count FROM labor WHERE user_id=?", (user_id,)).fetchone()
-    
-    if existing["count"] == 0:
-        default_labor = [
-            ("Pedreiro", "pedreiro", "dia", 180.00, "Profissional qualificado em alvenaria"),
-            ("Servente", "ajudante", "dia", 120.00, "Auxiliar de pedreiro"),
-            ("Eletricista", "eletricista", "dia", 200.00, "Instalações elétricas"),
-            ("Encanador", "encanador", "dia", 200.00, "Instalações hidráulicas"),
-            ("Carpinteiro", "carpinteiro", "dia", 190.00, "Esquadrias e formas"),
-            ("Pintor", "pintor", "dia", 160.00, "Pintura interna e externa"),
-            ("Mestre de obras", "mestre", "dia", 250.00, "Coordenação da obra"),
-        ]
-        
-        for name, category, unit, price, description in default_labor:
-            conn.execute(
-                "INSERT INTO labor (user_id, name, category, unit, price, description, updated_at) VALUES (?,?,?,?,?,?,?)",
-                (user_id, name, category, unit, price, description, datetime.utcnow().isoformat())
-            )
-        conn.commit()
-    conn.close()
+def create_search_update_trigger(conn, table):
+    # Só colunas pesquisáveis: reajuste de preço não reescreve o índice FTS
+    insert, delete = search_trigger_sql(table)
+    columns = ("name", "user_id") + SEARCH_SOURCES[table][1]
+    changed = " OR ".join(f"old.{column} IS NOT new.{column}" for column in columns)
+    conn.execute(f"DROP TRIGGER IF EXISTS {table}_search_update")
+    conn.execute(f"""CREATE TRIGGER {table}_search_update AFTER UPDATE OF {', '.join(columns)} ON {table}
+        WHEN {changed} BEGIN {delete} {insert} END""")
 
-def init_default_equipment(user_id):
-    conn = get_db_conn()
-    existing = conn.execute("SELECT COUNT(*) as count FROM equipment WHERE user_id=?", (user_id,)).fetchone()
-    
-    if existing["count"] == 0:
-        default_equipment = [
-            ("Betoneira", "misturador", "dia", 80.00, "Misturador de concreto e argamassa"),
-            ("Andaime", "estrutura", "dia", 50.00, "Estrutura de acesso em altura"),
-            ("Serra circular", "ferramenta", "dia", 40.00, "Corte de madeira"),
-            ("Furadeira industrial", "ferramenta", "dia", 35.00, "Perfuração de concreto e alvenaria"),
-            ("Compactador de solo", "compactação", "dia", 120.00, "Compactação de terreno"),
-            ("Martelete", "ferramenta", "dia", 45.00, "Demolição e perfuração"),
-        ]
-        
-        for name, category, unit, price, description in default_equipment:
-            conn.execute(
-                "INSERT INTO equipment (user_id, name, category, unit, price, description, updated_at) VALUES (?,?,?,?,?,?,?)",
-                (user_id, name, category, unit, price, description, datetime.utcnow().isoformat())
-            )
-        conn.commit()
-    conn.close()
+PRICE_TABLES = (("material", "materials"), ("labor", "labor"), ("equipment", "equipment"))
+CATALOG_TABLES = tuple(table for _, table in PRICE_TABLES)
+CATALOG_ITEM_TYPES = {table: item_type for item_type, table in PRICE_TABLES}
 
-@app.context_processor
-def inject_datetime():
-    user = current_user()
-    subscription = check_subscription_status(user) if user else None
-    return {
-        'datetime': datetime, 
-        'current_user': current_user,
-        'subscription_status': subscription
+def migrate_price_history(conn):
+    # Histórico só de inserção: cada cadastro, troca de preço ou de nome e
+    # exclusão (preço NULL) vira uma linha com a data em que passou a valer
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS price_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        item_type TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        name TEXT,
+        price REAL,
+        effective_at TEXT NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_price_history_item ON price_history(user_id, item_type, item_id, effective_at)")
+    now = "strftime('%Y-%m-%dT%H:%M:%f', 'now')"
+    for item_type, table in PRICE_TABLES:
+        insert = f"""INSERT INTO price_history (user_id, item_type, item_id, name, price, effective_at)
+            VALUES (new.user_id, '{item_type}', new.id, new.name, new.price, COALESCE(new.updated_at, {now}));"""
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_price_insert AFTER INSERT ON {table} BEGIN {insert} END")
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_price_update AFTER UPDATE OF name, price ON {table}
+            WHEN old.price IS NOT new.price OR old.name IS NOT new.name BEGIN {insert} END""")
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_price_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO price_history (user_id, item_type, item_id, name, price, effective_at)
+            VALUES (old.user_id, '{item_type}', old.id, old.name, NULL, {now}); END""")
+        conn.execute(f"""INSERT INTO price_history (user_id, item_type, item_id, name, price, effective_at)
+            SELECT user_id, '{item_type}', id, name, price, COALESCE(updated_at, '') FROM {table}""")
+
+def migrate_search_index(conn):
+    # owner guarda "u<user_id>" como token para o filtro por usuário usar o
+    # próprio índice FTS; remove_diacritics faz "ceramica" achar "cerâmica"
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        owner, kind UNINDEXED, ref_id UNINDEXED, name, detail,
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """)
+    conn.execute("INSERT INTO search_index(search_index, rank) VALUES('rank', 'bm25(0, 0, 0, 10.0, 1.0)')")
+    for table, (code, columns) in SEARCH_SOURCES.items():
+        insert, delete = search_trigger_sql(table)
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN {insert} END")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN {delete} END")
+        create_search_update_trigger(conn, table)
+        detail = " || ' ' || ".join(f"coalesce({column}, '')" for column in columns)
+        conn.execute(f"""INSERT INTO search_index(rowid, owner, kind, ref_id, name, detail)
+            SELECT id * 8 + {code}, coalesce('u' || user_id, 'global'), '{table}', id, name, trim({detail}) FROM {table}""")
+
+def migrate_search_update_triggers(conn):
+    for table in SEARCH_SOURCES:
+        create_search_update_trigger(conn, table)
+
+def catalog_source(table):
+    """Catálogo visível a um usuário (passe o user_id em todos os "?"): os
+    itens dele mais os do catálogo compartilhado (user_id NULL) que ele não
+    sobrescreveu nem ocultou."""
+    return f"""(SELECT * FROM {table} WHERE user_id=? AND hidden=0
+        UNION ALL
+        SELECT * FROM {table} g WHERE g.user_id IS NULL
+            AND NOT EXISTS (SELECT 1 FROM {table} o WHERE o.user_id=? AND o.base_id=g.id)) AS {table}"""
+
+def migrate_shared_catalog(conn):
+    # Os itens padrão passam a existir uma vez só, com user_id NULL. O usuário
+    # guarda apenas o que mudou: uma linha com base_id apontando para o item
+    # compartilhado (preço próprio) ou com hidden=1 (item excluído)
+    now = datetime.utcnow().isoformat()
+    seeds = {
+        "materials": (("name", "unit", "price", "category"), DEFAULT_MATERIALS),
+        "labor": (("name", "category", "unit", "price", "description"), DEFAULT_LABOR),
+        "equipment": (("name", "category", "unit", "price", "description"), DEFAULT_EQUIPMENT),
     }
+    add_column_if_missing(conn, "price_history", "base_id", "INTEGER")
+    for item_type, table in PRICE_TABLES:
+        add_column_if_missing(conn, table, "base_id", "INTEGER")
+        add_column_if_missing(conn, table, "hidden", "INTEGER NOT NULL DEFAULT 0")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_base ON {table}(user_id, base_id)")
 
-@app.route("/register", methods=["GET", "POST"])
-def register():
-    if request.method == "POST":
-        name = request.form["name"].strip()
-        email = request.form["email"].strip().lower()
-        password = request.form["password"]
+        insert, _ = search_trigger_sql(table)
+        conn.execute(f"DROP TRIGGER IF EXISTS {table}_search_insert")
+        conn.execute(f"CREATE TRIGGER {table}_search_insert AFTER INSERT ON {table} BEGIN {insert} END")
+        create_search_update_trigger(conn, table)
 
-        if not name or not email or not password:
-            flash("Preencha todos os campos", "warning")
-            return redirect(url_for("register"))
+        # Item oculto entra no histórico como excluído (preço NULL)
+        history = f"""INSERT INTO price_history (user_id, item_type, item_id, base_id, name, price, effective_at)
+            VALUES (new.user_id, '{item_type}', new.id, new.base_id, new.name,
+                    CASE WHEN new.hidden THEN NULL ELSE new.price END,
+                    COALESCE(new.updated_at, strftime('%Y-%m-%dT%H:%M:%f', 'now')));"""
+        conn.execute(f"DROP TRIGGER IF EXISTS {table}_price_insert")
+        conn.execute(f"DROP TRIGGER IF EXISTS {table}_price_update")
+        conn.execute(f"CREATE TRIGGER {table}_price_insert AFTER INSERT ON {table} BEGIN {history} END")
+        conn.execute(f"""CREATE TRIGGER {table}_price_update AFTER UPDATE OF name, price, hidden ON {table}
+            WHEN old.price IS NOT new.price OR old.name IS NOT new.name OR old.hidden IS NOT new.hidden
+            BEGIN {history} END""")
 
-        conn = get_db_conn()
-        try:
-            pw_hash = generate_password_hash(password)
-            now = datetime.utcnow()
-            trial_end = now + timedelta(days=7)
-            
-            c = conn.cursor()
-            c.execute(
-                """INSERT INTO users 
-                (name, email, password_hash, created_at, trial_start_date, trial_end_date, subscription_status) 
-                VALUES (?,?,?,?,?,?,?)""",
-                (name, email, pw_hash, now.isoformat(), now.isoformat(), trial_end.isoformat(), 'trial')
-            )
-            conn.commit()
-            user_id = c.lastrowid
-            init_default_materials(user_id)
-            init_default_labor(user_id)
-            init_default_equipment(user_id)
-            flash("Conta criada! Você tem 7 dias de teste grátis com todos os recursos.", "success")
-            return redirect(url_for("login"))
-        except sqlite3.IntegrityError:
-            flash("E-mail já cadastrado", "danger")
-            return redirect(url_for("register"))
-        finally:
-            conn.close()
+        columns, rows = seeds[table]
+        conn.executemany(
+            f"INSERT INTO {table} (user_id, {', '.join(columns)}, updated_at) VALUES (NULL, {', '.join('?' * len(columns))}, ?)",
+            [row + (now,) for row in rows]
+        )
+        shared = f"SELECT id FROM {table} g WHERE g.user_id IS NULL AND g.name = {table}.name"
+        # A cópia dos padrões feita no cadastro vira sobrescrita do item compartilhado...
+        conn.execute(f"""UPDATE {table} SET base_id = ({shared}) WHERE id IN (
+            SELECT MIN(id) FROM {table} WHERE user_id IS NOT NULL AND EXISTS ({shared}) GROUP BY user_id, name)""")
+        # ...padrão que o usuário já tinha excluído continua oculto para ele...
+        conn.execute(f"""INSERT INTO {table} (user_id, base_id, name, hidden, updated_at)
+            SELECT u.id, g.id, g.name, 1, ? FROM users u JOIN {table} g ON g.user_id IS NULL
+            WHERE NOT EXISTS (SELECT 1 FROM {table} o WHERE o.user_id = u.id AND o.base_id = g.id)""", (now,))
+        # ...e a cópia ainda idêntica ao padrão deixa de ser necessária
+        same = " AND ".join(f"g.{column} IS {table}.{column}" for column in columns)
+        conn.execute(f"""DELETE FROM {table} WHERE base_id IS NOT NULL AND hidden = 0 AND EXISTS (
+            SELECT 1 FROM {table} g WHERE g.id = {table}.base_id AND {same})""")
 
-    return render_template("login.html", action="register")
+COST_SUMMARY_COLUMNS = ("estimated_total", "material_total", "labor_total", "equipment_total", "line_count")
+COST_SUMMARY_UPSERT = """INSERT INTO project_cost_summary
+    (project_id, user_id, estimated_total, material_total, labor_total, equipment_total, line_count, regenerated_at)
+    VALUES (?,?,?,?,?,?,?,?)
+    ON CONFLICT(project_id) DO UPDATE SET user_id=excluded.user_id, estimated_total=excluded.estimated_total,
+    material_total=excluded.material_total, labor_total=excluded.labor_total, equipment_total=excluded.equipment_total,
+    line_count=excluded.line_count, regenerated_at=excluded.regenerated_at"""
 
-@app.route("/login", methods=["GET", "POST"])
-def login():
-    if request.method == "POST":
-        email = request.form["email"].strip().lower()
-        password = request.form["password"]
+def rebuild_cost_summary(conn, project_ids=None):
+    """Recalcula project_cost_summary a partir de budgets e devolve os projetos que estavam divergentes."""
+    scope = ""
+    params = []
+    if project_ids is not None:
+        if not project_ids:
+            return []
+        scope = f" WHERE p.id IN ({','.join('?' * len(project_ids))})"
+        params = list(project_ids)
 
-        conn = get_db_conn()
-        user = conn.execute("SELECT * FROM users WHERE email=?", (email,)).fetchone()
-        conn.close()
+    expected = conn.execute(f"""
+        SELECT p.id AS project_id, p.user_id,
+               COALESCE(SUM(b.cost), 0) AS estimated_total,
+               COALESCE(SUM(CASE WHEN b.item_type='material' THEN b.cost END), 0) AS material_total,
+               COALESCE(SUM(CASE WHEN b.item_type='labor' THEN b.cost END), 0) AS labor_total,
+               COALESCE(SUM(CASE WHEN b.item_type='equipment' THEN b.cost END), 0) AS equipment_total,
+               COUNT(b.id) AS line_count, MAX(b.created_at) AS regenerated_at
+        FROM projects p JOIN budgets b ON b.project_id = p.id{scope}
+        GROUP BY p.id
+    """, params).fetchall()
+    current = {row["project_id"]: row for row in conn.execute(
+        f"SELECT s.* FROM project_cost_summary s JOIN projects p ON p.id = s.project_id{scope}", params
+    )}
 
-        if not user or not check_password_hash(user["password_hash"], password):
-            flash("Credenciais inválidas", "danger")
-            return redirect(url_for("login"))
+    drifted = []
+    for row in expected:
+        summary = current.pop(row["project_id"], None)
+        if summary is None or any(abs((summary[col] or 0) - row[col]) > 0.005 for col in COST_SUMMARY_COLUMNS):
+            drifted.append(row["project_id"])
+    # Resumos sem linhas de orçamento (ou de projetos já excluídos) também são divergências
+    drifted.extend(pid for pid, summary in current.items() if summary["line_count"])
+    orphans = [] if project_ids is not None else [
+        row[0] for row in conn.execute(
+            "SELECT project_id FROM project_cost_summary WHERE project_id NOT IN (SELECT id FROM projects)"
+        )
+    ]
 
-        session["user_id"] = user["id"]
-        flash("Login realizado", "success")
-        return redirect(url_for("dashboard"))
+    conn.executemany("DELETE FROM project_cost_summary WHERE project_id=?", [(pid,) for pid in list(current) + orphans])
+    conn.executemany(COST_SUMMARY_UPSERT, [tuple(row) for row in expected])
+    return drifted + orphans
 
-    return render_template("login.html", action="login")
+def migrate_cost_summary(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS project_cost_summary (
+        project_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        estimated_total REAL NOT NULL DEFAULT 0,
+        material_total REAL NOT NULL DEFAULT 0,
+        labor_total REAL NOT NULL DEFAULT 0,
+        equipment_total REAL NOT NULL DEFAULT 0,
+        line_count INTEGER NOT NULL DEFAULT 0,
+        regenerated_at TEXT,
+        FOREIGN KEY(project_id) REFERENCES projects(id)
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cost_summary_user ON project_cost_summary(user_id)")
+    rebuild_cost_summary(conn)
 
-@app.route("/logout")
-def logout():
-    session.clear()
-    flash("Deslogado", "info")
-    return redirect(url_for("login"))
+def migrate_budget_price_keys(conn):
+    # Índice de dependências do catálogo: cada linha de orçamento guarda o dono
+    # e a chave do item (nome em minúsculas, a mesma de load_price_maps), para
+    # uma troca de preço achar só as linhas afetadas
+    conn.execute("ALTER TABLE budgets ADD COLUMN user_id INTEGER")
+    conn.execute("ALTER TABLE budgets ADD COLUMN item_key TEXT")
+    conn.execute("UPDATE budgets SET user_id=(SELECT user_id FROM projects WHERE projects.id=budgets.project_id)")
+    # Em Python: o lower() do SQLite só converte ASCII
+    names = [row[0] for row in conn.execute("SELECT DISTINCT material FROM budgets WHERE material IS NOT NULL")]
+    conn.executemany("UPDATE budgets SET item_key=? WHERE material=?", [(name.lower(), name) for name in names])
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_budgets_price_key ON budgets(user_id, item_type, item_key)")
 
-@app.route("/subscription-plans")
-def subscription_plans():
-    user = current_user()
-    subscription = check_subscription_status(user) if user else None
-    
+TRIAL_DAYS = 7
+
+def migrate_legacy_trials(conn):
+    # Contas anteriores ao período de teste não têm trial_end_date; a migração
+    # 13 deu a elas vencimento 0 e a varredura as marcou como trial_expired.
+    # Elas ganham um teste completo a partir de agora
+    now = datetime.utcnow()
+    trial_end = now + timedelta(days=TRIAL_DAYS)
+    conn.execute(
+        """UPDATE users SET subscription_status='trial', trial_start_date=COALESCE(trial_start_date, ?),
+        trial_end_date=?, subscription_expires_at=?
+        WHERE trial_end_date IS NULL AND COALESCE(subscription_status, 'trial') IN ('trial', 'trial_expired')""",
+        (now.isoformat(), trial_end.isoformat(), calendar.timegm(trial_end.utctimetuple()))
+    )
+
+MIGRATIONS = [
+    (1, "colunas adicionadas após o MVP", migrate_legacy_columns),
+    (2, "índices das consultas por usuário e por projeto", (
+        "CREATE INDEX IF NOT EXISTS idx_projects_user_created ON projects(user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_clients_user_name ON clients(user_id, name)",
+        "CREATE INDEX IF NOT EXISTS idx_suppliers_user_category ON suppliers(user_id, category, name)",
+        "CREATE INDEX IF NOT EXISTS idx_materials_user_name ON materials(user_id, name)",
+        "CREATE INDEX IF NOT EXISTS idx_materials_user_category ON materials(user_id, category, name)",
+        "CREATE INDEX IF NOT EXISTS idx_labor_user_category ON labor(user_id, category, name)",
+        "CREATE INDEX IF NOT EXISTS idx_equipment_user_category ON equipment(user_id, category, name)",
+        "CREATE INDEX IF NOT EXISTS idx_budgets_project_type ON budgets(project_id, item_type)",
+    )),
+    (3, "tabela de coeficientes de quantidade", migrate_budget_coefficients),
+    (4, "cache de PDFs de orçamento", (
+        """CREATE TABLE IF NOT EXISTS pdf_cache (
+            project_id INTEGER PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            pdf BLOB NOT NULL,
+            created_at TEXT,
+            FOREIGN KEY(project_id) REFERENCES projects(id)
+        )""",
+    )),
+    (5, "fila de jobs em segundo plano", (
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            kind TEXT NOT NULL,
+            params TEXT,
+            status TEXT NOT NULL,
+            progress INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            result BLOB,
+            result_name TEXT,
+            error TEXT,
+            created_at TEXT,
+            finished_at TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_user_created ON jobs(user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs(created_at)",
+    )),
+    # A paginação por keyset compara tuplas; NULL nas colunas de ordenação
+    # faria linhas antigas sumirem das listagens
+    (6, "chaves de ordenação das listagens sem NULL", (
+        "UPDATE projects SET created_at='' WHERE created_at IS NULL",
+        "UPDATE materials SET name='' WHERE name IS NULL",
+        "UPDATE materials SET category='geral' WHERE category IS NULL",
+        "UPDATE suppliers SET category='geral' WHERE category IS NULL",
+        "UPDATE labor SET category='geral' WHERE category IS NULL",
+        "UPDATE equipment SET category='geral' WHERE category IS NULL",
+    )),
+    (7, "índice de busca textual do catálogo", migrate_search_index),
+    (8, "resumo de custos por projeto", migrate_cost_summary),
+    (9, "histórico de preços do catálogo", migrate_price_history),
+    (10, "índice de busca ignora atualizações só de preço", migrate_search_update_triggers),
+    (11, "catálogo padrão compartilhado com sobrescritas por usuário", migrate_shared_catalog),
+    (12, "fila de webhooks do Mercado Pago", (
+        """CREATE TABLE IF NOT EXISTS webhook_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            resource_id TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            notifications INTEGER NOT NULL DEFAULT 1,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            last_error TEXT,
+            received_at TEXT,
+            processed_at TEXT
+        )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_webhook_events_pending ON webhook_events(topic, resource_id) WHERE status='pending'",
+        "CREATE INDEX IF NOT EXISTS idx_webhook_events_due ON webhook_events(status, next_attempt_at)",
+    )),
+    (13, "vencimento da assinatura em segundos, com índice para a varredura", (
+        "ALTER TABLE users ADD COLUMN subscription_expires_at INTEGER",
+        "UPDATE users SET subscription_status='trial' WHERE subscription_status IS NULL",
+        "UPDATE users SET subscription_expires_at = COALESCE(CAST(strftime('%s', trial_end_date) AS INTEGER), 0)",
+        "CREATE INDEX IF NOT EXISTS idx_users_trial_expiry ON users(subscription_expires_at) WHERE subscription_status='trial'",
+    )),
+    (14, "versões dos dados por usuário e cache de páginas compartilhado", (
+        """CREATE TABLE IF NOT EXISTS data_versions (
+            scope TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS page_cache (
+            key TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            global_version INTEGER NOT NULL,
+            body BLOB NOT NULL,
+            mimetype TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_page_cache_user ON page_cache(user_id, version)",
+        "CREATE INDEX IF NOT EXISTS idx_page_cache_created ON page_cache(created_at)",
+    )),
+    (15, "índice das linhas de orçamento por item do catálogo", migrate_budget_price_keys),
+    (16, "período de teste para contas sem trial_end_date", migrate_legacy_trials),
+    (17, "última atividade dos jobs", ("ALTER TABLE jobs ADD COLUMN updated_at TEXT",)),
+]
+
+# O PostgreSQL nasce direto no esquema atual. Migrações novas em MIGRATIONS
+# precisam de uma versão equivalente aqui, com o mesmo número
+POSTGRES_NOW = "to_char(clock_timestamp() AT TIME ZONE 'UTC', 'YYYY-MM-DD\"T\"HH24:MI:SS.MS')"
+
+POSTGRES_TABLES = (
+    """CREATE TABLE IF NOT EXISTS users (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        name TEXT NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        created_at TEXT,
+        trial_start_date TEXT,
+        trial_end_date TEXT,
+        subscription_status TEXT DEFAULT 'trial',
+        subscription_id TEXT,
+        plan_id TEXT,
+        subscription_expires_at BIGINT
+    )""",
+    """CREATE TABLE IF NOT EXISTS clients (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        name TEXT NOT NULL,
+        email TEXT,
+        phone TEXT,
+        cpf_cnpj TEXT,
+        address TEXT,
+        created_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS suppliers (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        name TEXT NOT NULL,
+        email TEXT,
+        phone TEXT,
+        cnpj TEXT,
+        address TEXT,
+        category TEXT DEFAULT 'geral',
+        created_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS materials (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        name TEXT,
+        unit TEXT,
+        price DOUBLE PRECISION,
+        category TEXT DEFAULT 'geral',
+        updated_at TEXT,
+        base_id INTEGER,
+        hidden INTEGER NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS labor (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        name TEXT NOT NULL,
+        category TEXT,
+        unit TEXT DEFAULT 'hora',
+        price DOUBLE PRECISION,
+        description TEXT,
+        updated_at TEXT,
+        base_id INTEGER,
+        hidden INTEGER NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS equipment (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        name TEXT NOT NULL,
+        category TEXT,
+        unit TEXT DEFAULT 'dia',
+        price DOUBLE PRECISION,
+        description TEXT,
+        updated_at TEXT,
+        base_id INTEGER,
+        hidden INTEGER NOT NULL DEFAULT 0
+    )""",
+    # O SQLite não aplica as chaves estrangeiras; aqui elas existem, com
+    # ON DELETE para as exclusões continuarem funcionando como antes
+    """CREATE TABLE IF NOT EXISTS projects (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        client_id INTEGER REFERENCES clients(id) ON DELETE SET NULL,
+        name TEXT,
+        client TEXT,
+        area DOUBLE PRECISION,
+        project_type TEXT DEFAULT 'residencial',
+        finish_level TEXT,
+        status TEXT DEFAULT 'em_andamento',
+        deadline TEXT,
+        notes TEXT,
+        real_cost DOUBLE PRECISION DEFAULT 0,
+        created_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS budgets (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        project_id INTEGER REFERENCES projects(id) ON DELETE CASCADE,
+        item_type TEXT DEFAULT 'material',
+        material TEXT,
+        quantity DOUBLE PRECISION,
+        unit TEXT,
+        cost DOUBLE PRECISION,
+        created_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS budget_coefficients (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        item_type TEXT NOT NULL,
+        name TEXT NOT NULL,
+        unit TEXT,
+        basis TEXT,
+        coefficient DOUBLE PRECISION NOT NULL,
+        min_qty DOUBLE PRECISION,
+        max_qty DOUBLE PRECISION,
+        decimals INTEGER,
+        sort_order INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS pdf_cache (
+        project_id INTEGER PRIMARY KEY REFERENCES projects(id) ON DELETE CASCADE,
+        content_hash TEXT NOT NULL,
+        pdf BYTEA NOT NULL,
+        created_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id),
+        kind TEXT NOT NULL,
+        params TEXT,
+        status TEXT NOT NULL,
+        progress INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        result BYTEA,
+        result_name TEXT,
+        error TEXT,
+        created_at TEXT,
+        finished_at TEXT
+    )""",
+    # Equivalente do FTS5: tsvector com o nome (peso A) e os campos secundários
+    # (peso B), sem acentos; o id segue a mesma conta do rowid (id * 8 + código)
+    """CREATE TABLE IF NOT EXISTS search_index (
+        id BIGINT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        ref_id INTEGER NOT NULL,
+        name TEXT,
+        detail TEXT,
+        document TSVECTOR NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS project_cost_summary (
+        project_id INTEGER PRIMARY KEY REFERENCES projects(id) ON DELETE CASCADE,
+        user_id INTEGER NOT NULL,
+        estimated_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+        material_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+        labor_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+        equipment_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+        line_count INTEGER NOT NULL DEFAULT 0,
+        regenerated_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS price_history (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id INTEGER,
+        item_type TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        name TEXT,
+        price DOUBLE PRECISION,
+        effective_at TEXT NOT NULL,
+        base_id INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS webhook_events (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        topic TEXT NOT NULL,
+        resource_id TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        notifications INTEGER NOT NULL DEFAULT 1,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT NOT NULL,
+        last_error TEXT,
+        received_at TEXT,
+        processed_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS data_versions (
+        scope TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        updated_at TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS page_cache (
+        key TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        global_version INTEGER NOT NULL,
+        body BYTEA NOT NULL,
+        mimetype TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_projects_user_created ON projects(user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_clients_user_name ON clients(user_id, name)",
+    "CREATE INDEX IF NOT EXISTS idx_suppliers_user_category ON suppliers(user_id, category, name)",
+    "CREATE INDEX IF NOT EXISTS idx_materials_user_name ON materials(user_id, name)",
+    "CREATE INDEX IF NOT EXISTS idx_materials_user_category ON materials(user_id, category, name)",
+    "CREATE INDEX IF NOT EXISTS idx_labor_user_category ON labor(user_id, category, name)",
+    "CREATE INDEX IF NOT EXISTS idx_equipment_user_category ON equipment(user_id, category, name)",
+    "CREATE INDEX IF NOT EXISTS idx_materials_user_base ON materials(user_id, base_id)",
+    "CREATE INDEX IF NOT EXISTS idx_labor_user_base ON labor(user_id, base_id)",
+    "CREATE INDEX IF NOT EXISTS idx_equipment_user_base ON equipment(user_id, base_id)",
+    "CREATE INDEX IF NOT EXISTS idx_budgets_project_type ON budgets(project_id, item_type)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_coefficients_user_item ON budget_coefficients(user_id, item_type, name)",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_user_created ON jobs(user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_search_index_document ON search_index USING GIN (document)",
+    "CREATE INDEX IF NOT EXISTS idx_cost_summary_user ON project_cost_summary(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_price_history_item ON price_history(user_id, item_type, item_id, effective_at)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_webhook_events_pending ON webhook_events(topic, resource_id) WHERE status='pending'",
+    "CREATE INDEX IF NOT EXISTS idx_webhook_events_due ON webhook_events(status, next_attempt_at)",
+    "CREATE INDEX IF NOT EXISTS idx_users_trial_expiry ON users(subscription_expires_at) WHERE subscription_status='trial'",
+    "CREATE INDEX IF NOT EXISTS idx_page_cache_user ON page_cache(user_id, version)",
+    "CREATE INDEX IF NOT EXISTS idx_page_cache_created ON page_cache(created_at)",
+)
+
+# Os mesmos triggers do SQLite (histórico de preços e índice de busca), em PL/pgSQL
+POSTGRES_FUNCTIONS = (
+    f"""CREATE OR REPLACE FUNCTION record_price_history() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            INSERT INTO price_history (user_id, item_type, item_id, name, price, effective_at)
+            VALUES (OLD.user_id, TG_ARGV[0], OLD.id, OLD.name, NULL, {POSTGRES_NOW});
+        ELSE
+            INSERT INTO price_history (user_id, item_type, item_id, base_id, name, price, effective_at)
+            VALUES (NEW.user_id, TG_ARGV[0], NEW.id, NEW.base_id, NEW.name,
+                    CASE WHEN NEW.hidden <> 0 THEN NULL ELSE NEW.price END, COALESCE(NEW.updated_at, {POSTGRES_NOW}));
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION search_fold(value TEXT) RETURNS TEXT AS $$
+        SELECT translate(lower(coalesce(value, '')), 'áàâãäéèêëíìîïóòôõöúùûüçñ', 'aaaaaeeeeiiiiooooouuuucn')
+    $$ LANGUAGE sql IMMUTABLE""",
+    """CREATE OR REPLACE FUNCTION sync_search_index() RETURNS trigger AS $$
+    DECLARE
+        code INTEGER := TG_ARGV[0]::INTEGER;
+        detail TEXT;
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            DELETE FROM search_index WHERE id = OLD.id * 8 + code;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            SELECT trim(string_agg(coalesce(to_jsonb(NEW) ->> field, ''), ' ' ORDER BY position)) INTO detail
+            FROM unnest(TG_ARGV[1:]) WITH ORDINALITY AS fields(field, position);
+            INSERT INTO search_index (id, owner, kind, ref_id, name, detail, document)
+            VALUES (NEW.id * 8 + code, coalesce('u' || NEW.user_id, 'global'), TG_TABLE_NAME, NEW.id, NEW.name, detail,
+                    setweight(to_tsvector('simple', search_fold(NEW.name)), 'A') ||
+                    setweight(to_tsvector('simple', search_fold(detail)), 'B'));
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+)
+
+def postgres_triggers():
+    for item_type, table in PRICE_TABLES:
+        changed = " OR ".join(f"OLD.{column} IS DISTINCT FROM NEW.{column}" for column in ("price", "name", "hidden"))
+        yield f"""CREATE TRIGGER {table}_price_insert AFTER INSERT ON {table}
+            FOR EACH ROW EXECUTE FUNCTION record_price_history('{item_type}')"""
+        yield f"""CREATE TRIGGER {table}_price_update AFTER UPDATE OF name, price, hidden ON {table}
+            FOR EACH ROW WHEN ({changed}) EXECUTE FUNCTION record_price_history('{item_type}')"""
+        yield f"""CREATE TRIGGER {table}_price_delete AFTER DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION record_price_history('{item_type}')"""
+    for table, (code, columns) in SEARCH_SOURCES.items():
+        arguments = ", ".join(f"'{value}'" for value in (code, *columns))
+        searchable = ("name", "user_id") + columns
+        changed = " OR ".join(f"OLD.{column} IS DISTINCT FROM NEW.{column}" for column in searchable)
+        yield f"""CREATE TRIGGER {table}_search_insert AFTER INSERT ON {table}
+            FOR EACH ROW EXECUTE FUNCTION sync_search_index({arguments})"""
+        yield f"""CREATE TRIGGER {table}_search_delete AFTER DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION sync_search_index({arguments})"""
+        yield f"""CREATE TRIGGER {table}_search_update AFTER UPDATE OF {', '.join(searchable)} ON {table}
+            FOR EACH ROW WHEN ({changed}) EXECUTE FUNCTION sync_search_index({arguments})"""
+
+def migrate_postgres_schema(conn):
+    for sql in POSTGRES_TABLES + POSTGRES_FUNCTIONS + tuple(postgres_triggers()):
+        conn.execute(sql)
+    # Catálogo padrão compartilhado e coeficientes padrão, como no SQLite
+    now = datetime.utcnow().isoformat()
+    conn.executemany("INSERT INTO materials (name, unit, price, category, updated_at) VALUES (?,?,?,?,?)",
+                     [row + (now,) for row in DEFAULT_MATERIALS])
+    for table, rows in (("labor", DEFAULT_LABOR), ("equipment", DEFAULT_EQUIPMENT)):
+        conn.executemany(f"INSERT INTO {table} (name, category, unit, price, description, updated_at) VALUES (?,?,?,?,?,?)",
+                         [row + (now,) for row in rows])
+    conn.executemany(
+        """INSERT INTO budget_coefficients
+        (user_id, item_type, name, unit, basis, coefficient, min_qty, max_qty, decimals, sort_order)
+        VALUES (NULL,?,?,?,?,?,?,?,?,?)""",
+        [row + (order,) for order, row in enumerate(DEFAULT_COEFFICIENTS)]
+    )
+
+POSTGRES_MIGRATIONS = [
+    (14, "esquema completo no PostgreSQL", migrate_postgres_schema),
+    (15, "índice das linhas de orçamento por item do catálogo", migrate_budget_price_keys),
+    (16, "período de teste para contas sem trial_end_date", migrate_legacy_trials),
+    (17, "última atividade dos jobs", ("ALTER TABLE jobs ADD COLUMN updated_at TEXT",)),
+]
+
+def run_migrations(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TEXT
+    )
+    """)
+    conn.commit()
+
+    migrations = MIGRATIONS if conn.dialect == "sqlite" else POSTGRES_MIGRATIONS
+    latest = migrations[-1][0]
+    current = conn.execute("SELECT MAX(version) AS version FROM schema_version").fetchone()["version"] or 0
+    if current >= latest:
+        return
+
+    # BEGIN IMMEDIATE (no PostgreSQL, o LOCK) serializa workers do gunicorn
+    # que sobem ao mesmo tempo
+    with write_transaction(conn):
+        if conn.dialect == "postgresql":
+            conn.execute("LOCK TABLE schema_version IN EXCLUSIVE MODE")
+        applied = {row["version"] for row in conn.execute("SELECT version FROM schema_version")}
+        for version, description, step in migrations:
+            if version in applied:
+                continue
+            if callable(step):
+                step(conn)
+            else:
+                for sql in step:
+                    conn.execute(sql)
+            conn.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?,?,?)",
+                (version, description, datetime.utcnow().isoformat())
+            )
+
+# Repositórios: as consultas de usuários, projetos, orçamentos e catálogo
+# ficam aqui, em SQL que roda igual no SQLite e no PostgreSQL; o que muda
+# entre os dois (marcadores, id do INSERT, BEGIN) é resolvido pela conexão.
+# Quem chama cuida da transação (write_transaction)
+class Repository:
+    def __init__(self, conn, user_id=None):
+        self.conn = conn
+        self.user_id = user_id
+
+class UserRepository(Repository):
+    def get(self, user_id):
+        return self.conn.execute(
+            """SELECT id, name, email, trial_start_date, trial_end_date,
+            subscription_status, subscription_expires_at, subscription_id, plan_id FROM users WHERE id=?""",
+            (user_id,)
+        ).fetchone()
+
+    def get_by_email(self, email):
+        return self.conn.execute("SELECT * FROM users WHERE email=?", (email,)).fetchone()
+
+    def create(self, name, email, password_hash, trial_days):
+        now = datetime.utcnow()
+        trial_end = now + timedelta(days=trial_days)
+        return self.conn.insert(
+            """INSERT INTO users
+            (name, email, password_hash, created_at, trial_start_date, trial_end_date, subscription_status,
+            subscription_expires_at)
+            VALUES (?,?,?,?,?,?,?,?)""",
+            (name, email, password_hash, now.isoformat(), now.isoformat(), trial_end.isoformat(), "trial",
+             calendar.timegm(trial_end.utctimetuple()))
+        )
+
+    def set_subscription(self, user_id, subscription_id, plan_id):
+        self.conn.execute("UPDATE users SET subscription_id=?, plan_id=? WHERE id=?", (subscription_id, plan_id, user_id))
+
+    def set_status(self, user_id, status):
+        """Muda o status da assinatura; devolve False se já era esse."""
+        return self.conn.execute(
+            "UPDATE users SET subscription_status=? WHERE id=? AND (subscription_status IS NULL OR subscription_status<>?)",
+            (status, user_id, status)
+        ).rowcount > 0
+
+    def expire_trials(self, now):
+        expired = [row["id"] for row in self.conn.execute(
+            "SELECT id FROM users WHERE subscription_status='trial' AND subscription_expires_at<=?", (now,)
+        )]
+        self.conn.execute("UPDATE users SET subscription_status='trial_expired' WHERE subscription_status='trial' AND subscription_expires_at<=?",
+                          (now,))
+        return expired
+
+class ProjectRepository(Repository):
+    """Projetos de um usuário."""
+
+    def get(self, project_id):
+        return self.conn.execute("SELECT * FROM projects WHERE id=? AND user_id=?", (project_id, self.user_id)).fetchone()
+
+    def list(self, project_ids=None):
+        if project_ids is None:
+            return self.conn.execute("SELECT * FROM projects WHERE user_id=? ORDER BY created_at DESC",
+                                     (self.user_id,)).fetchall()
+        if not project_ids:
+            return []
+        return self.conn.execute(
+            f"SELECT * FROM projects WHERE user_id=? AND id IN ({','.join('?' * len(project_ids))}) ORDER BY created_at DESC",
+            (self.user_id, *project_ids)
+        ).fetchall()
+
+    def create(self, fields):
+        fields = dict(fields, user_id=self.user_id, created_at=datetime.utcnow().isoformat())
+        return self.conn.insert(f"INSERT INTO projects ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+                                list(fields.values()))
+
+    def update(self, project_id, fields):
+        self.conn.execute(f"UPDATE projects SET {', '.join(f'{column}=?' for column in fields)} WHERE id=? AND user_id=?",
+                          [*fields.values(), project_id, self.user_id])
+        invalidate_pdf_cache(self.conn, [project_id])
+
+    def delete(self, project_id):
+        if self.get(project_id) is None:
+            return
+        self.conn.execute("DELETE FROM budgets WHERE project_id=?", (project_id,))
+        self.conn.execute("DELETE FROM project_cost_summary WHERE project_id=?", (project_id,))
+        invalidate_pdf_cache(self.conn, [project_id])
+        self.conn.execute("DELETE FROM projects WHERE id=? AND user_id=?", (project_id, self.user_id))
+
+class BudgetRepository(Repository):
+    """Linhas de orçamento e o resumo de custos (project_cost_summary) de cada projeto."""
+
+    def lines(self, project_id):
+        return self.conn.execute("SELECT material, quantity, unit, cost FROM budgets WHERE project_id=? ORDER BY id",
+                                 (project_id,)).fetchall()
+
+    def rows_by_project(self, project_ids):
+        return {
+            pid: self.conn.execute(
+                "SELECT item_type, material, quantity, unit, cost FROM budgets WHERE project_id=? ORDER BY id",
+                (pid,)
+            ).fetchall()
+            for pid in project_ids
+        }
+
+    def summaries(self, project_ids):
+        if not project_ids:
+            return {}
+        rows = self.conn.execute(
+            f"SELECT * FROM project_cost_summary WHERE project_id IN ({','.join('?' * len(project_ids))})",
+            list(project_ids)
+        ).fetchall()
+        return {row["project_id"]: row for row in rows}
+
+    def replace(self, project_ids, budget_rows, totals, summaries):
+        """Troca todas as linhas dos projetos, o custo real e o resumo de uma vez."""
+        self.conn.executemany("DELETE FROM budgets WHERE project_id=?", [(pid,) for pid in project_ids])
+        self.conn.executemany(
+            """INSERT INTO budgets (project_id, user_id, item_type, material, item_key, quantity, unit, cost, created_at)
+            VALUES (?,?,?,?,?,?,?,?,?)""",
+            budget_rows
+        )
+        self.conn.executemany("UPDATE projects SET real_cost=? WHERE id=?", totals)
+        self.conn.executemany(COST_SUMMARY_UPSERT, summaries)
+        invalidate_pdf_cache(self.conn, project_ids)
+
+    def price_keys(self, user_id, item_type):
+        """Chaves de itens do catálogo usadas nos orçamentos do usuário."""
+        return {row[0] for row in self.conn.execute(
+            "SELECT DISTINCT item_key FROM budgets WHERE user_id=? AND item_type=?", (user_id, item_type)
+        )}
+
+    def price_key_owners(self, item_type):
+        return [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT user_id FROM budgets WHERE user_id IS NOT NULL AND item_type=?", (item_type,)
+        )]
+
+    def reprice(self, user_id, item_type, item_key, price):
+        """Aplica o preço unitário às linhas que usam o item, num único UPDATE; devolve os projetos alterados."""
+        return {row[0] for row in self.conn.execute(
+            """UPDATE budgets SET cost = quantity * ?
+            WHERE user_id=? AND item_type=? AND item_key=? AND cost <> quantity * ?
+            RETURNING project_id""",
+            (price, user_id, item_type, item_key, price)
+        ).fetchall()}
+
+class CatalogRepository(Repository):
+    """Cadastros de um usuário: materiais, mão de obra e equipamentos (com o
+    catálogo compartilhado por baixo), clientes e fornecedores."""
+
+    def __init__(self, conn, table, user_id):
+        super().__init__(conn, user_id)
+        self.table = table
+        self.shared = table in CATALOG_TABLES
+        # Nomes (antes e depois) dos itens com preço alterados por esta instância
+        self.changed_names = set()
+
+    def get(self, item_id):
+        return self.conn.execute(f"SELECT * FROM {self.table} WHERE id=? AND user_id=?", (item_id, self.user_id)).fetchone()
+
+    def list(self, order="name"):
+        if self.shared:
+            return self.conn.execute(f"SELECT * FROM {catalog_source(self.table)} ORDER BY {order}",
+                                     (self.user_id, self.user_id)).fetchall()
+        return self.conn.execute(f"SELECT * FROM {self.table} WHERE user_id=? ORDER BY {order}", (self.user_id,)).fetchall()
+
+    def add(self, fields):
+        fields = dict(fields, user_id=self.user_id)
+        fields["updated_at" if self.shared else "created_at"] = datetime.utcnow().isoformat()
+        if self.shared:
+            self.changed_names.add(fields["name"])
+        return self.conn.insert(f"INSERT INTO {self.table} ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+                                list(fields.values()))
+
+    def save(self, item_id, fields):
+        """Grava a edição de um item. O item compartilhado não muda: o usuário
+        ganha uma linha própria com base_id apontando para ele."""
+        table, user_id = self.table, self.user_id
+        if not self.shared:
+            self.conn.execute(f"UPDATE {table} SET {', '.join(f'{column}=?' for column in fields)} WHERE id=? AND user_id=?",
+                              [*fields.values(), item_id, user_id])
+            return
+        fields = dict(fields, hidden=0, updated_at=datetime.utcnow().isoformat())
+        row = self.conn.execute(f"SELECT user_id, name FROM {table} WHERE id=? AND (user_id=? OR user_id IS NULL)",
+                                (item_id, user_id)).fetchone()
+        if row is None:
+            return
+        self.changed_names.update((row["name"], fields["name"]))
+        if row["user_id"] is None:
+            override = self.conn.execute(f"SELECT id, name FROM {table} WHERE user_id=? AND base_id=?",
+                                         (user_id, item_id)).fetchone()
+            if override is None:
+                fields.update(user_id=user_id, base_id=item_id)
+                self.conn.execute(f"INSERT INTO {table} ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+                                  list(fields.values()))
+                return
+            item_id = override["id"]
+            self.changed_names.add(override["name"])
+        self.conn.execute(f"UPDATE {table} SET {', '.join(f'{column}=?' for column in fields)} WHERE id=? AND user_id=?",
+                          [*fields.values(), item_id, user_id])
+
+    def delete(self, item_id):
+        """Apaga um item próprio. Item compartilhado (ou a sobrescrita dele) só fica oculto para o usuário."""
+        table, user_id = self.table, self.user_id
+        if not self.shared:
+            self.conn.execute(f"DELETE FROM {table} WHERE id=? AND user_id=?", (item_id, user_id))
+            return
+        row = self.conn.execute(f"SELECT id, user_id, base_id, name FROM {table} WHERE id=? AND (user_id=? OR user_id IS NULL)",
+                                (item_id, user_id)).fetchone()
+        if row is None:
+            return
+        self.changed_names.add(row["name"])
+        now = datetime.utcnow().isoformat()
+        if row["user_id"] is None:
+            override = self.conn.execute(f"SELECT id, name FROM {table} WHERE user_id=? AND base_id=?",
+                                         (user_id, item_id)).fetchone()
+            if override is None:
+                self.conn.execute(f"INSERT INTO {table} (user_id, base_id, name, hidden, updated_at) VALUES (?,?,?,1,?)",
+                                  (user_id, row["id"], row["name"], now))
+            else:
+                self.changed_names.add(override["name"])
+                self.conn.execute(f"UPDATE {table} SET hidden=1, updated_at=? WHERE id=?", (now, override["id"]))
+        elif row["base_id"] is not None:
+            self.conn.execute(f"UPDATE {table} SET hidden=1, updated_at=? WHERE id=?", (now, row["id"]))
+        else:
+            self.conn.execute(f"DELETE FROM {table} WHERE id=?", (row["id"],))
+
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+def load_user(uid):
+    now = time.monotonic()
+    if USER_CACHE_TTL > 0:
+        with _user_cache_lock:
+            cached = _user_cache.get(uid)
+        if cached and cached[0] > now:
+            return cached[1]
+
+    conn = get_db_conn()
+    user = UserRepository(conn).get(uid)
+    conn.close()
+
+    if user and USER_CACHE_TTL > 0:
+        with _user_cache_lock:
+            _user_cache[uid] = (now + USER_CACHE_TTL, user)
+    return user
+
+def invalidate_user_cache(uid):
+    with _user_cache_lock:
+        _user_cache.pop(uid, None)
+    if not has_app_context():
+        return
+    cached = g.get("_current_user")
+    if cached and cached[0] == uid:
+        g.pop("_current_user")
+        g.pop("_subscription", None)
+
+def current_user():
+    uid = session.get("user_id")
+    if not uid:
+        return None
+    # Uma única busca por requisição: rota, context processor e base.html
+    # reutilizam o mesmo registro guardado em flask.g
+    cached = g.get("_current_user")
+    if cached and cached[0] == uid:
+        return cached[1]
+    user = load_user(uid)
+    g._current_user = (uid, user)
+    return user
+
+def check_subscription_status(user):
+    if not user:
+        return {'active': False, 'status': 'no_user', 'days_left': 0}
+    
+    status = user['subscription_status'] or 'trial'
+    
+    if status == 'active':
+        return {'active': True, 'status': 'active', 'days_left': None, 'is_trial': False}
+    
+    if status == 'trial':
+        # subscription_expires_at é o fim do teste em segundos desde a época
+        # (UTC); evita converter trial_end_date a cada requisição
+        remaining = (user['subscription_expires_at'] or 0) - time.time()
+        if remaining > 0:
+            days_left = int(remaining // 86400) + 1
+            return {'active': True, 'status': 'trial', 'days_left': days_left, 'is_trial': True}
+        
+        return {'active': False, 'status': 'trial_expired', 'days_left': 0, 'is_trial': False}
+    
+    return {'active': False, 'status': status, 'days_left': 0, 'is_trial': False}
+
+def current_subscription():
+    # Calculada uma vez por requisição, junto com o usuário em flask.g
+    uid = session.get("user_id")
+    cached = g.get("_subscription")
+    if cached and cached[0] == uid:
+        return cached[1]
+    subscription = check_subscription_status(current_user())
+    g._subscription = (uid, subscription)
+    return subscription
+
+def expire_trials(conn, now=None):
+    """Marca como trial_expired todos os testes vencidos e devolve os ids alterados."""
+    now = int(time.time() if now is None else now)
+    with write_transaction(conn):
+        expired = UserRepository(conn).expire_trials(now)
+        for uid in expired:
+            bump_data_version(conn, uid)
+    for uid in expired:
+        invalidate_user_cache(uid)
+    return expired
+
+# Rotas que respondem JSON recebem erro em JSON em vez de redirecionamento
+JSON_ROUTE_PREFIXES = ("/api/", "/jobs/", "/catalog/")
+
+def require_active_subscription(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        json_route = request.path.startswith(JSON_ROUTE_PREFIXES)
+        user = current_user()
+        if not user:
+            if json_route:
+                return jsonify({"error": "login required"}), 401
+            flash("Faça login para acessar esta página", "warning")
+            return redirect(url_for("login"))
+        
+        subscription = current_subscription()
+        if not subscription['active']:
+            if json_route:
+                return jsonify({"error": "assinatura inativa", "status": subscription["status"]}), 402
+            flash("Seu período de teste expirou. Assine um plano para continuar usando o CiviPro.", "danger")
+            return redirect(url_for("subscription_plans"))
+        
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Cache de páginas por usuário. A chave inclui a versão dos dados do usuário e a
+# do catálogo padrão (tabela data_versions); toda escrita incrementa a versão,
+# então uma entrada antiga nunca volta a ser servida e não precisa ser apagada.
+PAGE_CACHE_MAX_BYTES = int(float(os.environ.get("PAGE_CACHE_MB", "32")) * 1024 * 1024)
+# Com PAGE_CACHE_SHARED=1 as páginas também vão para a tabela page_cache,
+# compartilhada entre os workers do gunicorn
+PAGE_CACHE_SHARED = os.environ.get("PAGE_CACHE_SHARED") == "1"
+PAGE_CACHE_SHARED_ROWS = int(os.environ.get("PAGE_CACHE_SHARED_ROWS", "5000"))
+
+# POSTs que não alteram dados exibidos nas páginas não invalidam o cache
+CACHE_NEUTRAL_ENDPOINTS = {
+    "login", "register", "logout", "mercadopago_webhook", "api_simulator",
+    "export_pdf_job", "export_zip", "export_book",
+}
+
+def data_scope(user_id):
+    return "global" if user_id is None else f"u{user_id}"
+
+def bump_data_version(conn, user_id):
+    """Incrementa a versão dos dados do usuário (user_id None: catálogo padrão). Não faz commit."""
+    conn.execute(
+        """INSERT INTO data_versions (scope, version, updated_at) VALUES (?, 1, ?)
+        ON CONFLICT(scope) DO UPDATE SET version=data_versions.version + 1, updated_at=excluded.updated_at""",
+        (data_scope(user_id), datetime.utcnow().replace(microsecond=0).isoformat())
+    )
+
+def load_data_versions(conn, user_id):
+    """(versão do usuário, versão do catálogo padrão) e a data da última mudança."""
+    rows = {row["scope"]: row for row in conn.execute(
+        "SELECT scope, version, updated_at FROM data_versions WHERE scope IN (?, 'global')", (data_scope(user_id),)
+    )}
+    versions = tuple(rows[scope]["version"] if scope in rows else 0 for scope in (data_scope(user_id), "global"))
+    # A página também muda com a data (prazos, dias de teste restantes)
+    changed = [datetime.fromisoformat(row["updated_at"]) for row in rows.values()]
+    changed.append(datetime.combine(datetime.utcnow().date(), datetime.min.time()))
+    return versions, max(changed)
+
+class PageCache:
+    """LRU em memória limitado pelo total de bytes das páginas guardadas."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            page = self._entries.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def put(self, key, page):
+        size = len(page[0])
+        if size > self.max_bytes // 4:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._entries[key] = page
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted[0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+page_cache = PageCache(PAGE_CACHE_MAX_BYTES)
+_shared_page_writes = itertools.count(1)
+
+def load_shared_page(conn, key):
+    row = conn.execute("SELECT body, mimetype FROM page_cache WHERE key=?", (key,)).fetchone()
+    return (row["body"], row["mimetype"]) if row else None
+
+def store_shared_page(conn, key, user_id, versions, page):
+    with write_transaction(conn):
+        conn.execute(
+            """INSERT INTO page_cache (key, user_id, version, global_version, body, mimetype, created_at)
+            VALUES (?,?,?,?,?,?,?)
+            ON CONFLICT(key) DO UPDATE SET user_id=excluded.user_id, version=excluded.version,
+            global_version=excluded.global_version, body=excluded.body, mimetype=excluded.mimetype,
+            created_at=excluded.created_at""",
+            (key, user_id, *versions, page[0], page[1], datetime.utcnow().isoformat())
+        )
+        # Páginas de versões anteriores do mesmo usuário não serão mais lidas
+        conn.execute("DELETE FROM page_cache WHERE user_id=? AND (version<? OR global_version<?)", (user_id, *versions))
+        if next(_shared_page_writes) % 100 == 0:
+            conn.execute("""DELETE FROM page_cache WHERE created_at <= (
+                SELECT created_at FROM page_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?)""", (PAGE_CACHE_SHARED_ROWS,))
+
+def set_page_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    # O navegador guarda a página, mas sempre revalida com If-None-Match
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+def cached_page(f):
+    """Serve a página do cache enquanto a versão dos dados do usuário não mudar.
+
+    Com If-None-Match/If-Modified-Since válidos responde 304 sem renderizar.
+    Vai abaixo de @require_active_subscription: o acesso é conferido antes."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user = current_user()
+        # Mensagens flash pendentes fazem parte da página; essa vai sem cache
+        if not user or session.get("_flashes"):
+            return f(*args, **kwargs)
+
+        conn = get_db_conn()
+        versions, last_modified = load_data_versions(conn, user["id"])
+        subscription = current_subscription()
+        key = hashlib.sha1(json.dumps(
+            [request.endpoint, request.full_path, user["id"], versions, subscription["status"],
+             subscription.get("days_left"), last_modified.date().isoformat()]
+        ).encode("utf-8")).hexdigest()
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(key)
+        else:
+            not_modified = bool(request.if_modified_since) and last_modified <= request.if_modified_since.replace(tzinfo=None)
+        if not_modified:
+            conn.close()
+            return set_page_validators(Response(status=304), key, last_modified)
+
+        page = page_cache.get(key)
+        if page is None and PAGE_CACHE_SHARED:
+            page = load_shared_page(conn, key)
+            if page is not None:
+                page_cache.put(key, page)
+        if page is None:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200 or response.direct_passthrough or session.get("_flashes"):
+                conn.close()
+                return response
+            page = (response.get_data(), response.mimetype)
+            page_cache.put(key, page)
+            if PAGE_CACHE_SHARED:
+                store_shared_page(conn, key, user["id"], versions, page)
+        conn.close()
+        return set_page_validators(Response(page[0], mimetype=page[1]), key, last_modified)
+    return decorated_function
+
+@app.after_request
+def bump_data_version_after_write(response):
+    # A versão sobe depois do commit da rota: uma leitura concorrente que ainda
+    # viu a versão antiga guarda a página sob uma chave que não será mais usada
+    if request.method in ("GET", "HEAD", "OPTIONS") or response.status_code >= 400:
+        return response
+    uid = session.get("user_id")
+    if uid and request.endpoint not in CACHE_NEUTRAL_ENDPOINTS:
+        conn = get_db_conn()
+        with write_transaction(conn):
+            bump_data_version(conn, uid)
+        conn.close()
+    return response
+
+# Catálogo padrão, gravado uma única vez com user_id NULL (migração 11) e
+# compartilhado por todos os usuários
+DEFAULT_MATERIALS = [
+    ("Cimento", "sacos", 35.00, "estrutura"),
+    ("Areia", "m³", 80.00, "estrutura"),
+    ("Brita", "m³", 90.00, "estrutura"),
+    ("Tijolos", "un", 0.75, "alvenaria"),
+    ("Ferro 6mm", "kg", 6.50, "estrutura"),
+    ("Ferro 8mm", "kg", 6.50, "estrutura"),
+    ("Ferro 10mm", "kg", 6.50, "estrutura"),
+    ("Cal", "sacos", 12.00, "acabamento"),
+    ("Argamassa", "sacos", 8.50, "acabamento"),
+    ("Cerâmica", "m²", 25.00, "acabamento"),
+    ("Azulejo", "m²", 30.00, "acabamento"),
+    ("Tinta", "lata", 95.00, "acabamento"),
+    ("Tubos PVC", "m", 15.00, "hidráulica"),
+    ("Fios elétricos", "m", 3.50, "elétrica"),
+]
+
+DEFAULT_LABOR = [
+    ("Pedreiro", "pedreiro", "dia", 180.00, "Profissional qualificado em alvenaria"),
+    ("Servente", "ajudante", "dia", 120.00, "Auxiliar de pedreiro"),
+    ("Eletricista", "eletricista", "dia", 200.00, "Instalações elétricas"),
+    ("Encanador", "encanador", "dia", 200.00, "Instalações hidráulicas"),
+    ("Carpinteiro", "carpinteiro", "dia", 190.00, "Esquadrias e formas"),
+    ("Pintor", "pintor", "dia", 160.00, "Pintura interna e externa"),
+    ("Mestre de obras", "mestre", "dia", 250.00, "Coordenação da obra"),
+]
+
+DEFAULT_EQUIPMENT = [
+    ("Betoneira", "misturador", "dia", 80.00, "Misturador de concreto e argamassa"),
+    ("Andaime", "estrutura", "dia", 50.00, "Estrutura de acesso em altura"),
+    ("Serra circular", "ferramenta", "dia", 40.00, "Corte de madeira"),
+    ("Furadeira industrial", "ferramenta", "dia", 35.00, "Perfuração de concreto e alvenaria"),
+    ("Compactador de solo", "compactação", "dia", 120.00, "Compactação de terreno"),
+    ("Martelete", "ferramenta", "dia", 45.00, "Demolição e perfuração"),
+]
+
+@app.context_processor
+def inject_datetime():
+    subscription = current_subscription() if current_user() else None
+    return {
+        'datetime': datetime, 
+        'current_user': current_user,
+        'subscription_status': subscription
+    }
+
+@app.route("/register", methods=["GET", "POST"])
+def register():
+    if request.method == "POST":
+        name = request.form["name"].strip()
+        email = request.form["email"].strip().lower()
+        password = request.form["password"]
+
+        if not name or not email or not password:
+            flash("Preencha todos os campos", "warning")
+            return redirect(url_for("register"))
+
+        conn = get_db_conn()
+        try:
+            pw_hash = generate_password_hash(password)
+            with write_transaction(conn):
+                UserRepository(conn).create(name, email, pw_hash, trial_days=TRIAL_DAYS)
+            flash("Conta criada! Você tem 7 dias de teste grátis com todos os recursos.", "success")
+            return redirect(url_for("login"))
+        except conn.IntegrityError:
+            flash("E-mail já cadastrado", "danger")
+            return redirect(url_for("register"))
+        finally:
+            conn.close()
+
+    return render_template("login.html", action="register")
+
+@app.route("/login", methods=["GET", "POST"])
+def login():
+    if request.method == "POST":
+        email = request.form["email"].strip().lower()
+        password = request.form["password"]
+
+        conn = get_db_conn()
+        user = UserRepository(conn).get_by_email(email)
+        conn.close()
+
+        if not user or not check_password_hash(user["password_hash"], password):
+            flash("Credenciais inválidas", "danger")
+            return redirect(url_for("login"))
+
+        session["user_id"] = user["id"]
+        flash("Login realizado", "success")
+        return redirect(url_for("dashboard"))
+
+    return render_template("login.html", action="login")
+
+@app.route("/logout")
+def logout():
+    session.clear()
+    flash("Deslogado", "info")
+    return redirect(url_for("login"))
+
+MERCADOPAGO_BASE_URL = "https://api.mercadopago.com"
+
+class MercadoPagoHttpClient(HttpClient):
+    # MERCADOPAGO_API_URL aponta o SDK para outro servidor (um stub local em testes)
+    def request(self, method, url, *args, **kwargs):
+        base_url = os.environ.get("MERCADOPAGO_API_URL")
+        if base_url and url.startswith(MERCADOPAGO_BASE_URL):
+            url = base_url.rstrip("/") + url[len(MERCADOPAGO_BASE_URL):]
+        return super().request(method, url, *args, **kwargs)
+
+def mercadopago_sdk(access_token, **options):
+    return mercadopago.SDK(access_token, http_client=MercadoPagoHttpClient(),
+                           request_options=RequestOptions(**options) if options else None)
+
+@app.route("/subscription-plans")
+def subscription_plans():
+    user = current_user()
+    subscription = current_subscription() if user else None
+    
     plans = [
         {
             'id': 'basic',
@@ -501,7 +2101,7 @@ def create_subscription():
         return redirect(url_for("subscription_plans"))
     
     try:
-        sdk = mercadopago.SDK(access_token)
+        sdk = mercadopago_sdk(access_token)
         
         preapproval_data = {
             "reason": f"CiviPro {plan_names[plan_id]} - Assinatura Mensal",
@@ -526,12 +2126,10 @@ def create_subscription():
         
         if result["status"] == 201:
             conn = get_db_conn()
-            conn.execute(
-                "UPDATE users SET subscription_id=?, plan_id=? WHERE id=?",
-                (response["id"], plan_id, user["id"])
-            )
-            conn.commit()
+            with write_transaction(conn):
+                UserRepository(conn).set_subscription(user["id"], response["id"], plan_id)
             conn.close()
+            invalidate_user_cache(user["id"])
             
             return redirect(response["init_point"])
         else:
@@ -557,7 +2155,7 @@ def subscription_manage():
     if not user:
         return redirect(url_for("login"))
     
-    subscription = check_subscription_status(user)
+    subscription = current_subscription()
     
     plan_names = {
         'basic': 'Básico',
@@ -580,52 +2178,165 @@ def subscription_manage():
                          current_plan=current_plan,
                          current_price=current_price)
 
-@app.route("/mercadopago-webhook", methods=["POST"])
-def mercadopago_webhook():
+WEBHOOK_BATCH_SIZE = 20
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_RETRY_BASE = 30
+WEBHOOK_RETRY_MAX = timedelta(hours=1)
+# Evento reivindicado fica reservado por este tempo; se o worker morrer no
+# meio, outro processo o pega de volta quando o prazo vence
+WEBHOOK_LEASE = timedelta(minutes=2)
+WEBHOOK_POLL_INTERVAL = 5
+WEBHOOK_API_TIMEOUT = 10.0
+WEBHOOK_FETCH_WORKERS = 4
+WEBHOOK_RETENTION = timedelta(days=7)
+WEBHOOK_WORKER = os.environ.get("WEBHOOK_WORKER", "1") != "0"
+PREAPPROVAL_STATUSES = {"authorized": "active", "paused": "cancelled", "cancelled": "cancelled"}
+
+_webhook_fetcher = ThreadPoolExecutor(max_workers=WEBHOOK_FETCH_WORKERS, thread_name_prefix="civipro-webhook-fetch")
+_webhook_wakeup = threading.Event()
+_webhook_thread = None
+_webhook_thread_lock = threading.Lock()
+
+def enqueue_webhook_event(conn, topic, resource_id):
+    # Notificações repetidas de um evento ainda pendente só incrementam o
+    # contador: o worker consulta o estado atual uma vez só
+    with write_transaction(conn):
+        conn.execute("""
+            INSERT INTO webhook_events (topic, resource_id, next_attempt_at, received_at) VALUES (?,?,?,?)
+            ON CONFLICT(topic, resource_id) WHERE status='pending'
+            DO UPDATE SET notifications = webhook_events.notifications + 1, received_at = excluded.received_at
+        """, (topic, resource_id, *[datetime.utcnow().isoformat()] * 2))
+
+def claim_webhook_events(conn, limit=WEBHOOK_BATCH_SIZE):
+    now = datetime.utcnow()
+    with write_transaction(conn):
+        # No PostgreSQL o BEGIN não trava a tabela: cada worker pula as linhas
+        # já reivindicadas por outro
+        events = conn.execute(f"""
+            SELECT id, topic, resource_id, notifications, attempts FROM webhook_events
+            WHERE status='pending' AND next_attempt_at<=? ORDER BY next_attempt_at, id LIMIT ?
+            {"FOR UPDATE SKIP LOCKED" if conn.dialect == "postgresql" else ""}
+        """, (now.isoformat(), limit)).fetchall()
+        conn.executemany("UPDATE webhook_events SET next_attempt_at=?, attempts=attempts+1 WHERE id=?",
+                         [((now + WEBHOOK_LEASE).isoformat(), event["id"]) for event in events])
+    return events
+
+def fetch_preapproval(sdk, preapproval_id):
+    """Devolve (preapproval, erro, definitivo)."""
+    if sdk is None:
+        return None, "MERCADOPAGO_ACCESS_TOKEN não configurado", False
     try:
-        data = request.json
-        
-        if data.get("type") == "subscription_preapproval":
-            preapproval_id = data.get("data", {}).get("id")
-            
-            if not preapproval_id:
-                return jsonify({"status": "error", "message": "No preapproval_id"}), 400
-            
-            access_token = os.environ.get("MERCADOPAGO_ACCESS_TOKEN")
-            if not access_token:
-                return jsonify({"status": "error", "message": "No access token"}), 500
-            
-            sdk = mercadopago.SDK(access_token)
-            result = sdk.preapproval().get(preapproval_id)
-            
-            if result["status"] == 200:
-                preapproval = result["response"]
-                external_ref = preapproval.get("external_reference", "")
-                status = preapproval.get("status")
-                
-                if external_ref.startswith("user_"):
-                    user_id = int(external_ref.replace("user_", ""))
-                    
-                    conn = get_db_conn()
-                    
-                    if status == "authorized":
-                        conn.execute(
-                            "UPDATE users SET subscription_status='active' WHERE id=?",
-                            (user_id,)
-                        )
-                    elif status in ["paused", "cancelled"]:
-                        conn.execute(
-                            "UPDATE users SET subscription_status='cancelled' WHERE id=?",
-                            (user_id,)
-                        )
-                    
-                    conn.commit()
-                    conn.close()
-        
-        return jsonify({"status": "ok"}), 200
-        
+        result = sdk.preapproval().get(preapproval_id)
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return None, str(e), False
+    if result["status"] == 200:
+        return result["response"], None, False
+    # 4xx (exceto 429) não melhora com nova tentativa
+    return None, f"HTTP {result['status']}", 400 <= result["status"] < 500 and result["status"] != 429
+
+def preapproval_target(conn, preapproval):
+    """(user_id, status) que a assinatura pede, ou (None, None) se não há o que aplicar.
+
+    ValueError para external_reference malformada ou usuário inexistente."""
+    status = PREAPPROVAL_STATUSES.get(preapproval.get("status"))
+    if not status:
+        return None, None
+    external_ref = preapproval.get("external_reference") or ""
+    match = re.fullmatch(r"user_(\d+)", external_ref)
+    if not match:
+        raise ValueError(f"external_reference inválida: {external_ref!r}")
+    user_id = int(match.group(1))
+    if UserRepository(conn).get(user_id) is None:
+        raise ValueError(f"usuário {user_id} não encontrado")
+    return user_id, status
+
+def process_webhook_events(conn, limit=WEBHOOK_BATCH_SIZE):
+    """Processa um lote de eventos pendentes e devolve quantos foram reivindicados."""
+    events = claim_webhook_events(conn, limit)
+    if not events:
+        return 0
+
+    access_token = os.environ.get("MERCADOPAGO_ACCESS_TOKEN")
+    sdk = mercadopago_sdk(access_token, connection_timeout=WEBHOOK_API_TIMEOUT, max_retries=0) if access_token else None
+    # As consultas do lote saem em paralelo; a gravação é uma transação só
+    fetched = _webhook_fetcher.map(lambda event: fetch_preapproval(sdk, event["resource_id"]), events)
+    results = [(event, *result) for event, result in zip(events, fetched)]
+
+    now = datetime.utcnow()
+    touched = set()
+    with write_transaction(conn):
+        for event, preapproval, error, permanent in results:
+            if error is None:
+                # Referência ruim falha só este evento; o resto do lote segue
+                try:
+                    user_id, status = preapproval_target(conn, preapproval)
+                except ValueError as e:
+                    error, permanent = str(e), True
+            if error is None:
+                if user_id is not None and UserRepository(conn).set_status(user_id, status):
+                    bump_data_version(conn, user_id)
+                    touched.add(user_id)
+                # Notificação nova durante a consulta: o estado pode ter mudado
+                # depois do GET, então o evento volta para a fila
+                conn.execute("""UPDATE webhook_events
+                    SET status = CASE WHEN notifications=? THEN 'done' ELSE 'pending' END,
+                        next_attempt_at=?, processed_at=?, last_error=NULL WHERE id=?""",
+                             (event["notifications"], now.isoformat(), now.isoformat(), event["id"]))
+            elif permanent or event["attempts"] + 1 >= WEBHOOK_MAX_ATTEMPTS:
+                conn.execute("UPDATE webhook_events SET status='failed', last_error=?, processed_at=? WHERE id=?",
+                             (error, now.isoformat(), event["id"]))
+            else:
+                delay = min(timedelta(seconds=WEBHOOK_RETRY_BASE * 2 ** event["attempts"]), WEBHOOK_RETRY_MAX)
+                conn.execute("UPDATE webhook_events SET next_attempt_at=?, last_error=? WHERE id=?",
+                             ((now + delay).isoformat(), error, event["id"]))
+        conn.execute("DELETE FROM webhook_events WHERE status!='pending' AND processed_at < ?",
+                     ((now - WEBHOOK_RETENTION).isoformat(),))
+    for user_id in touched:
+        invalidate_user_cache(user_id)
+    return len(events)
+
+def webhook_worker_loop():
+    while True:
+        _webhook_wakeup.wait(WEBHOOK_POLL_INTERVAL)
+        _webhook_wakeup.clear()
+        conn = db_pool.acquire()
+        try:
+            while process_webhook_events(conn):
+                pass
+        except Exception:
+            app.logger.exception("falha ao processar webhooks do Mercado Pago")
+        finally:
+            conn.close()
+
+def wake_webhook_worker():
+    # Threads não sobrevivem ao fork do gunicorn: cada processo sobe a sua
+    global _webhook_thread
+    if not WEBHOOK_WORKER:
+        return
+    if _webhook_thread is None or not _webhook_thread.is_alive():
+        with _webhook_thread_lock:
+            if _webhook_thread is None or not _webhook_thread.is_alive():
+                _webhook_thread = threading.Thread(target=webhook_worker_loop, name="civipro-webhooks", daemon=True)
+                _webhook_thread.start()
+    _webhook_wakeup.set()
+
+@app.route("/mercadopago-webhook", methods=["POST"])
+def mercadopago_webhook():
+    # Só grava o evento e responde; a consulta ao Mercado Pago e a
+    # atualização do usuário ficam com o worker
+    data = request.get_json(silent=True) or {}
+    if data.get("type") != "subscription_preapproval":
+        return jsonify({"status": "ok"}), 200
+
+    preapproval_id = (data.get("data") or {}).get("id")
+    if not preapproval_id:
+        return jsonify({"status": "error", "message": "No preapproval_id"}), 400
+
+    conn = get_db_conn()
+    enqueue_webhook_event(conn, data["type"], str(preapproval_id))
+    conn.close()
+    wake_webhook_worker()
+    return jsonify({"status": "ok"}), 200
 
 @app.route("/cancel-subscription", methods=["POST"])
 def cancel_subscription():
@@ -644,17 +2355,15 @@ def cancel_subscription():
         return redirect(url_for("subscription_manage"))
     
     try:
-        sdk = mercadopago.SDK(access_token)
+        sdk = mercadopago_sdk(access_token)
         result = sdk.preapproval().update(user['subscription_id'], {"status": "cancelled"})
         
         if result["status"] == 200:
             conn = get_db_conn()
-            conn.execute(
-                "UPDATE users SET subscription_status='cancelled' WHERE id=?",
-                (user["id"],)
-            )
-            conn.commit()
+            with write_transaction(conn):
+                UserRepository(conn).set_status(user["id"], "cancelled")
             conn.close()
+            invalidate_user_cache(user["id"])
             
             flash("Assinatura cancelada com sucesso", "success")
         else:
@@ -665,63 +2374,51 @@ def cancel_subscription():
     
     return redirect(url_for("subscription_manage"))
 
-@app.route("/")
-@app.route("/dashboard")
-def dashboard():
-    user = current_user()
-    if not user:
-        return redirect(url_for("login"))
+def dashboard_metrics(conn, user_id):
+    sql = f"""
+        SELECT
+            (SELECT COUNT(*) FROM projects WHERE user_id=?) AS total_projects,
+            (SELECT COUNT(*) FROM projects WHERE user_id=? AND status='em_andamento') AS active_projects,
+            (SELECT COUNT(*) FROM {catalog_source("materials")}) AS total_materials,
+            (SELECT COUNT(*) FROM clients WHERE user_id=?) AS total_clients,
+            (SELECT COUNT(*) FROM suppliers WHERE user_id=?) AS total_suppliers,
+            (SELECT COUNT(*) FROM {catalog_source("labor")}) AS total_labor,
+            (SELECT COUNT(*) FROM {catalog_source("equipment")}) AS total_equipment,
+            (SELECT COALESCE(SUM(real_cost), 0) FROM projects WHERE user_id=?) AS total_real
+    """
+    counts = conn.execute(sql, [user_id] * sql.count("?")).fetchone()
+    metrics = dict(counts)
+
+    totals = conn.execute("""
+        SELECT COALESCE(SUM(material_total), 0) AS cost_materials,
+               COALESCE(SUM(labor_total), 0) AS cost_labor,
+               COALESCE(SUM(equipment_total), 0) AS cost_equipment,
+               COALESCE(SUM(estimated_total), 0) AS total_estimated
+        FROM project_cost_summary WHERE user_id=?
+    """, (user_id,)).fetchone()
+    metrics.update(dict(totals))
+
+    # Uma única consulta devolve só as linhas que a tela usa:
+    # os 5 projetos mais recentes e os que estouraram o orçamento
+    rows = conn.execute("""
+        SELECT * FROM (
+            SELECT p.*, COALESCE(s.estimated_total, 0) AS estimated,
+                   ROW_NUMBER() OVER (ORDER BY p.created_at DESC) AS recent_rank
+            FROM projects p LEFT JOIN project_cost_summary s ON s.project_id = p.id
+            WHERE p.user_id=?
+        ) AS ranked
+        WHERE recent_rank <= 5 OR (real_cost > 0 AND real_cost > estimated)
+        ORDER BY recent_rank
+    """, (user_id,)).fetchall()
+
+    recent = [r for r in rows if r["recent_rank"] <= 5]
+    metrics["projects"] = recent
+    metrics["project_costs"] = [r["estimated"] for r in recent]
+    metrics["project_real_costs"] = [r["real_cost"] or 0 for r in recent]
 
-    conn = get_db_conn()
-    projects = conn.execute("SELECT * FROM projects WHERE user_id=? ORDER BY created_at DESC", (user["id"],)).fetchall()
-    materials = conn.execute("SELECT * FROM materials WHERE user_id=?", (user["id"],)).fetchall()
-    clients = conn.execute("SELECT * FROM clients WHERE user_id=?", (user["id"],)).fetchall()
-    suppliers = conn.execute("SELECT * FROM suppliers WHERE user_id=?", (user["id"],)).fetchall()
-    labor = conn.execute("SELECT * FROM labor WHERE user_id=?", (user["id"],)).fetchall()
-    equipment = conn.execute("SELECT * FROM equipment WHERE user_id=?", (user["id"],)).fetchall()
-
-    total_projects = len(projects)
-    active_projects = len([p for p in projects if p["status"] == "em_andamento"])
-    total_materials = len(materials)
-    total_clients = len(clients)
-    total_suppliers = len(suppliers)
-    total_labor = len(labor)
-    total_equipment = len(equipment)
-    
-    total_estimated = conn.execute("""
-        SELECT SUM(cost) as total FROM budgets
-        WHERE project_id IN (SELECT id FROM projects WHERE user_id=?)
-    """, (user["id"],)).fetchone()["total"] or 0
-    
-    total_real = conn.execute("""
-        SELECT SUM(real_cost) as total FROM projects WHERE user_id=?
-    """, (user["id"],)).fetchone()["total"] or 0
-    
-    project_costs = []
-    project_real_costs = []
-    for proj in projects[:5]:
-        cost = conn.execute("SELECT SUM(cost) as total FROM budgets WHERE project_id=?", (proj["id"],)).fetchone()["total"] or 0
-        project_costs.append(cost)
-        project_real_costs.append(proj["real_cost"] or 0)
-    
-    cost_materials = conn.execute("""
-        SELECT SUM(cost) as total FROM budgets
-        WHERE project_id IN (SELECT id FROM projects WHERE user_id=?) AND item_type='material'
-    """, (user["id"],)).fetchone()["total"] or 0
-    
-    cost_labor = conn.execute("""
-        SELECT SUM(cost) as total FROM budgets
-        WHERE project_id IN (SELECT id FROM projects WHERE user_id=?) AND item_type='labor'
-    """, (user["id"],)).fetchone()["total"] or 0
-    
-    cost_equipment = conn.execute("""
-        SELECT SUM(cost) as total FROM budgets
-        WHERE project_id IN (SELECT id FROM projects WHERE user_id=?) AND item_type='equipment'
-    """, (user["id"],)).fetchone()["total"] or 0
-    
     projects_over_budget = []
-    for proj in projects:
-        estimated = conn.execute("SELECT SUM(cost) as total FROM budgets WHERE project_id=?", (proj["id"],)).fetchone()["total"] or 0
+    for proj in rows:
+        estimated = proj["estimated"]
         real = proj["real_cost"] or 0
         if real > 0 and real > estimated:
             diff = real - estimated
@@ -733,36 +2430,141 @@ def dashboard():
                 "diff": diff,
                 "diff_percent": diff_percent
             })
+    metrics["projects_over_budget"] = projects_over_budget
+    return metrics
 
+@app.route("/")
+@app.route("/dashboard")
+@require_active_subscription
+@cached_page
+def dashboard():
+    user = current_user()
+    if not user:
+        return redirect(url_for("login"))
+
+    conn = get_db_conn()
+    metrics = dashboard_metrics(conn, user["id"])
     conn.close()
-    return render_template("dashboard.html", user=user, projects=projects,
-                           materials=materials, total_projects=total_projects,
-                           active_projects=active_projects,
-                           total_materials=total_materials, 
-                           total_clients=total_clients,
-                           total_suppliers=total_suppliers,
-                           total_labor=total_labor,
-                           total_equipment=total_equipment,
-                           total_estimated=total_estimated,
-                           total_real=total_real,
-                           project_costs=project_costs,
-                           project_real_costs=project_real_costs,
-                           cost_materials=cost_materials,
-                           cost_labor=cost_labor,
-                           cost_equipment=cost_equipment,
-                           projects_over_budget=projects_over_budget)
+    return render_template("dashboard.html", user=user, **metrics)
+
+LIST_PAGE_SIZE = 50
+LIST_MAX_PAGE_SIZE = 200
+
+# Cada ordenação percorre um índice (user_id, ...) e usa o id como desempate,
+# então a página seguinte começa direto na chave do último item (keyset)
+LIST_VIEWS = {
+    "projects": {
+        "sorts": {"recentes": (("created_at", "id"), True), "antigos": (("created_at", "id"), False)},
+        "filters": {"status": "status", "tipo": "project_type"},
+        "search": ("name", "client"),
+    },
+    "materials": {
+        "sorts": {"categoria": (("category", "name", "id"), False), "nome": (("name", "id"), False)},
+        "filters": {"categoria": "category"},
+        "search": ("name",),
+    },
+    "clients": {
+        "sorts": {"nome": (("name", "id"), False)},
+        "filters": {},
+        "search": ("name", "email", "cpf_cnpj"),
+    },
+    "suppliers": {
+        "sorts": {"categoria": (("category", "name", "id"), False)},
+        "filters": {"categoria": "category"},
+        "search": ("name", "email", "cnpj"),
+    },
+    "labor": {
+        "sorts": {"categoria": (("category", "name", "id"), False)},
+        "filters": {"categoria": "category"},
+        "search": ("name",),
+    },
+    "equipment": {
+        "sorts": {"categoria": (("category", "name", "id"), False)},
+        "filters": {"categoria": "category"},
+        "search": ("name",),
+    },
+}
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_cursor(token, size):
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != size or None in values:
+        return None
+    return values
+
+def fetch_list_page(conn, table, user_id, args):
+    view = LIST_VIEWS[table]
+    sort = args.get("sort") if args.get("sort") in view["sorts"] else next(iter(view["sorts"]))
+    columns, descending = view["sorts"][sort]
+    try:
+        limit = min(max(int(args.get("limit", LIST_PAGE_SIZE)), 1), LIST_MAX_PAGE_SIZE)
+    except ValueError:
+        limit = LIST_PAGE_SIZE
+
+    if table in CATALOG_TABLES:
+        source = catalog_source(table)
+        where = []
+        params = [user_id, user_id]
+    else:
+        source = table
+        where = ["user_id=?"]
+        params = [user_id]
+    filters = {}
+    for arg, column in view["filters"].items():
+        value = args.get(arg, "").strip()
+        if value:
+            where.append(f"{column}=?")
+            params.append(value)
+            filters[arg] = value
+
+    q = args.get("q", "").strip()
+    match = search_match(q, user_id) if table in SEARCH_SOURCES else None
+    if match:
+        where.append(f"id IN (SELECT ref_id FROM search_index WHERE {match[0]} AND kind=?)")
+        params.extend(match[1] + [table])
+    elif q:
+        where.append("(" + " OR ".join(f"LOWER({column}) LIKE ?" for column in view["search"]) + ")")
+        params.extend([f"%{q.lower()}%"] * len(view["search"]))
+
+    # Cursor inválido ou de outra ordenação volta para a primeira página
+    cursor = decode_cursor(args.get("cursor"), len(columns))
+    if cursor:
+        where.append(f"({', '.join(columns)}) {'<' if descending else '>'} ({', '.join('?' * len(columns))})")
+        params.extend(cursor)
+
+    order = ", ".join(f"{column} DESC" if descending else column for column in columns)
+    rows = conn.execute(f"SELECT * FROM {source} WHERE {' AND '.join(where) or '1=1'} ORDER BY {order} LIMIT ?",
+                        params + [limit + 1]).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][column] for column in columns])
+
+    return {"items": rows, "next_cursor": next_cursor, "sort": sort, "sorts": list(view["sorts"]),
+            "q": q, "filters": filters, "limit": limit, "first_page": cursor is None}
 
 @app.route("/projects")
+@require_active_subscription
+@cached_page
 def projects_list():
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    projs = conn.execute("SELECT * FROM projects WHERE user_id=? ORDER BY created_at DESC", (user["id"],)).fetchall()
+    page = fetch_list_page(conn, "projects", user["id"], request.args)
     conn.close()
-    return render_template("projetos.html", projects=projs, user=user)
+    return render_template("projetos.html", projects=page["items"], page=page, user=user)
 
 @app.route("/projects/add", methods=["GET", "POST"])
+@require_active_subscription
 def projects_add():
     user = current_user()
     if not user:
@@ -784,7 +2586,7 @@ def projects_add():
         if client_id_raw and client_id_raw != "new" and client_id_raw != "":
             client_id = int(client_id_raw)
             conn = get_db_conn()
-            client_row = conn.execute("SELECT name FROM clients WHERE id=? AND user_id=?", (client_id, user["id"])).fetchone()
+            client_row = CatalogRepository(conn, "clients", user["id"]).get(client_id)
             conn.close()
             if client_row:
                 final_client_name = client_row["name"]
@@ -792,46 +2594,52 @@ def projects_add():
             final_client_name = client_name
 
         conn = get_db_conn()
-        c = conn.cursor()
-        c.execute("""INSERT INTO projects (user_id, client_id, name, client, area, project_type, finish_level, status, deadline, notes, created_at)
-                     VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
-                  (user["id"], client_id, name, final_client_name, area, project_type, finish, "em_andamento", deadline, notes, datetime.utcnow().isoformat()))
-        conn.commit()
-        project_id = c.lastrowid
+        with write_transaction(conn):
+            project_id = ProjectRepository(conn, user["id"]).create({
+                "client_id": client_id, "name": name, "client": final_client_name, "area": area,
+                "project_type": project_type, "finish_level": finish, "status": "em_andamento",
+                "deadline": deadline, "notes": notes,
+            })
         conn.close()
         flash("Projeto criado", "success")
         return redirect(url_for("project_view", project_id=project_id))
 
     conn = get_db_conn()
-    clients = conn.execute("SELECT * FROM clients WHERE user_id=? ORDER BY name", (user["id"],)).fetchall()
+    clients = CatalogRepository(conn, "clients", user["id"]).list()
     conn.close()
     return render_template("add_project.html", user=user, clients=clients)
 
 @app.route("/projects/<int:project_id>")
+@require_active_subscription
+@cached_page
 def project_view(project_id):
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    proj = conn.execute("SELECT * FROM projects WHERE id=? AND user_id=?", (project_id, user["id"])).fetchone()
+    proj = ProjectRepository(conn, user["id"]).get(project_id)
     if not proj:
         conn.close()
         flash("Projeto não encontrado", "danger")
         return redirect(url_for("projects_list"))
 
-    budget = conn.execute("SELECT material, quantity, unit, cost FROM budgets WHERE project_id=?", (project_id,)).fetchall()
+    budgets = BudgetRepository(conn)
+    budget = budgets.lines(project_id)
+    summary = budgets.summaries([project_id]).get(project_id)
     conn.close()
-    total = sum([b["cost"] for b in budget]) if budget else 0
+    total = summary["estimated_total"] if summary else 0
     return render_template("view_project.html", project=proj, budget=budget, total=total, user=user)
 
 @app.route("/projects/<int:project_id>/edit", methods=["GET", "POST"])
+@require_active_subscription
 def project_edit(project_id):
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     
     conn = get_db_conn()
-    proj = conn.execute("SELECT * FROM projects WHERE id=? AND user_id=?", (project_id, user["id"])).fetchone()
+    projects = ProjectRepository(conn, user["id"])
+    proj = projects.get(project_id)
     if not proj:
         conn.close()
         flash("Projeto não encontrado", "danger")
@@ -854,51 +2662,54 @@ def project_edit(project_id):
         
         if client_id_raw and client_id_raw != "new" and client_id_raw != "":
             client_id = int(client_id_raw)
-            conn_temp = get_db_conn()
-            client_row = conn_temp.execute("SELECT name FROM clients WHERE id=? AND user_id=?", (client_id, user["id"])).fetchone()
-            conn_temp.close()
+            client_row = CatalogRepository(conn, "clients", user["id"]).get(client_id)
             if client_row:
                 final_client_name = client_row["name"]
         elif client_name:
             final_client_name = client_name
         
-        conn.execute("""UPDATE projects SET name=?, client_id=?, client=?, area=?, project_type=?, finish_level=?, 
-                        status=?, deadline=?, notes=?, real_cost=? WHERE id=?""",
-                     (name, client_id, final_client_name, area, project_type, finish, status, deadline, notes, real_cost, project_id))
-        conn.commit()
+        with write_transaction(conn):
+            projects.update(project_id, {
+                "name": name, "client_id": client_id, "client": final_client_name, "area": area,
+                "project_type": project_type, "finish_level": finish, "status": status, "deadline": deadline,
+                "notes": notes, "real_cost": real_cost,
+            })
         conn.close()
         flash("Projeto atualizado", "success")
         return redirect(url_for("project_view", project_id=project_id))
     
-    clients = conn.execute("SELECT * FROM clients WHERE user_id=? ORDER BY name", (user["id"],)).fetchall()
+    clients = CatalogRepository(conn, "clients", user["id"]).list()
     conn.close()
     return render_template("edit_project.html", project=proj, user=user, clients=clients)
 
 @app.route("/projects/<int:project_id>/delete", methods=["POST"])
+@require_active_subscription
 def project_delete(project_id):
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     
     conn = get_db_conn()
-    conn.execute("DELETE FROM budgets WHERE project_id=?", (project_id,))
-    conn.execute("DELETE FROM projects WHERE id=? AND user_id=?", (project_id, user["id"]))
-    conn.commit()
+    with write_transaction(conn):
+        ProjectRepository(conn, user["id"]).delete(project_id)
     conn.close()
     flash("Projeto excluído", "success")
     return redirect(url_for("projects_list"))
 
 @app.route("/materials")
+@require_active_subscription
+@cached_page
 def materials_list():
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    mats = conn.execute("SELECT * FROM materials WHERE user_id=? ORDER BY category, name", (user["id"],)).fetchall()
+    page = fetch_list_page(conn, "materials", user["id"], request.args)
     conn.close()
-    return render_template("materiais.html", materials=mats, user=user)
+    return render_template("materiais.html", materials=page["items"], page=page, user=user)
 
 @app.route("/materials/add", methods=["POST"])
+@require_active_subscription
 def materials_add():
     user = current_user()
     if not user:
@@ -908,14 +2719,16 @@ def materials_add():
     price = float(request.form.get("price") or 0)
     category = request.form.get("category", "geral")
     conn = get_db_conn()
-    conn.execute("INSERT INTO materials (user_id, name, unit, price, category, updated_at) VALUES (?,?,?,?,?,?)",
-                 (user["id"], name, unit, price, category, datetime.utcnow().isoformat()))
-    conn.commit()
+    catalog = CatalogRepository(conn, "materials", user["id"])
+    with write_transaction(conn):
+        catalog.add({"name": name, "unit": unit, "price": price, "category": category})
+        reprice_budgets(conn, user["id"], "materials", catalog.changed_names)
     conn.close()
     flash("Material adicionado", "success")
     return redirect(url_for("materials_list"))
 
 @app.route("/materials/<int:material_id>/edit", methods=["POST"])
+@require_active_subscription
 def materials_edit(material_id):
     user = current_user()
     if not user:
@@ -927,36 +2740,43 @@ def materials_edit(material_id):
     category = request.form.get("category", "geral")
     
     conn = get_db_conn()
-    conn.execute("UPDATE materials SET name=?, unit=?, price=?, category=?, updated_at=? WHERE id=? AND user_id=?",
-                 (name, unit, price, category, datetime.utcnow().isoformat(), material_id, user["id"]))
-    conn.commit()
+    catalog = CatalogRepository(conn, "materials", user["id"])
+    with write_transaction(conn):
+        catalog.save(material_id, {"name": name, "unit": unit, "price": price, "category": category})
+        reprice_budgets(conn, user["id"], "materials", catalog.changed_names)
     conn.close()
     flash("Material atualizado", "success")
     return redirect(url_for("materials_list"))
 
 @app.route("/materials/<int:material_id>/delete", methods=["POST"])
+@require_active_subscription
 def materials_delete(material_id):
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    conn.execute("DELETE FROM materials WHERE id=? AND user_id=?", (material_id, user["id"]))
-    conn.commit()
+    catalog = CatalogRepository(conn, "materials", user["id"])
+    with write_transaction(conn):
+        catalog.delete(material_id)
+        reprice_budgets(conn, user["id"], "materials", catalog.changed_names)
     conn.close()
     flash("Material excluído", "success")
     return redirect(url_for("materials_list"))
 
 @app.route("/clients")
+@require_active_subscription
+@cached_page
 def clients_list():
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    clients = conn.execute("SELECT * FROM clients WHERE user_id=? ORDER BY name", (user["id"],)).fetchall()
+    page = fetch_list_page(conn, "clients", user["id"], request.args)
     conn.close()
-    return render_template("clientes.html", clients=clients, user=user)
+    return render_template("clientes.html", clients=page["items"], page=page, user=user)
 
 @app.route("/clients/add", methods=["POST"])
+@require_active_subscription
 def clients_add():
     user = current_user()
     if not user:
@@ -967,14 +2787,15 @@ def clients_add():
     cpf_cnpj = request.form.get("cpf_cnpj", "")
     address = request.form.get("address", "")
     conn = get_db_conn()
-    conn.execute("INSERT INTO clients (user_id, name, email, phone, cpf_cnpj, address, created_at) VALUES (?,?,?,?,?,?,?)",
-                 (user["id"], name, email, phone, cpf_cnpj, address, datetime.utcnow().isoformat()))
-    conn.commit()
+    with write_transaction(conn):
+        CatalogRepository(conn, "clients", user["id"]).add(
+            {"name": name, "email": email, "phone": phone, "cpf_cnpj": cpf_cnpj, "address": address})
     conn.close()
     flash("Cliente adicionado", "success")
     return redirect(url_for("clients_list"))
 
 @app.route("/clients/<int:client_id>/edit", methods=["POST"])
+@require_active_subscription
 def clients_edit(client_id):
     user = current_user()
     if not user:
@@ -987,36 +2808,40 @@ def clients_edit(client_id):
     address = request.form.get("address", "")
     
     conn = get_db_conn()
-    conn.execute("UPDATE clients SET name=?, email=?, phone=?, cpf_cnpj=?, address=? WHERE id=? AND user_id=?",
-                 (name, email, phone, cpf_cnpj, address, client_id, user["id"]))
-    conn.commit()
+    with write_transaction(conn):
+        CatalogRepository(conn, "clients", user["id"]).save(
+            client_id, {"name": name, "email": email, "phone": phone, "cpf_cnpj": cpf_cnpj, "address": address})
     conn.close()
     flash("Cliente atualizado", "success")
     return redirect(url_for("clients_list"))
 
 @app.route("/clients/<int:client_id>/delete", methods=["POST"])
+@require_active_subscription
 def clients_delete(client_id):
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    conn.execute("DELETE FROM clients WHERE id=? AND user_id=?", (client_id, user["id"]))
-    conn.commit()
+    with write_transaction(conn):
+        CatalogRepository(conn, "clients", user["id"]).delete(client_id)
     conn.close()
     flash("Cliente excluído", "success")
     return redirect(url_for("clients_list"))
 
 @app.route("/suppliers")
+@require_active_subscription
+@cached_page
 def suppliers_list():
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    suppliers = conn.execute("SELECT * FROM suppliers WHERE user_id=? ORDER BY category, name", (user["id"],)).fetchall()
+    page = fetch_list_page(conn, "suppliers", user["id"], request.args)
     conn.close()
-    return render_template("fornecedores.html", suppliers=suppliers, user=user)
+    return render_template("fornecedores.html", suppliers=page["items"], page=page, user=user)
 
 @app.route("/suppliers/add", methods=["POST"])
+@require_active_subscription
 def suppliers_add():
     user = current_user()
     if not user:
@@ -1028,14 +2853,15 @@ def suppliers_add():
     address = request.form.get("address", "")
     category = request.form.get("category", "geral")
     conn = get_db_conn()
-    conn.execute("INSERT INTO suppliers (user_id, name, email, phone, cnpj, address, category, created_at) VALUES (?,?,?,?,?,?,?,?)",
-                 (user["id"], name, email, phone, cnpj, address, category, datetime.utcnow().isoformat()))
-    conn.commit()
+    with write_transaction(conn):
+        CatalogRepository(conn, "suppliers", user["id"]).add(
+            {"name": name, "email": email, "phone": phone, "cnpj": cnpj, "address": address, "category": category})
     conn.close()
     flash("Fornecedor adicionado", "success")
     return redirect(url_for("suppliers_list"))
 
 @app.route("/suppliers/<int:supplier_id>/edit", methods=["POST"])
+@require_active_subscription
 def suppliers_edit(supplier_id):
     user = current_user()
     if not user:
@@ -1049,36 +2875,40 @@ def suppliers_edit(supplier_id):
     category = request.form.get("category", "geral")
     
     conn = get_db_conn()
-    conn.execute("UPDATE suppliers SET name=?, email=?, phone=?, cnpj=?, address=?, category=? WHERE id=? AND user_id=?",
-                 (name, email, phone, cnpj, address, category, supplier_id, user["id"]))
-    conn.commit()
+    with write_transaction(conn):
+        CatalogRepository(conn, "suppliers", user["id"]).save(
+            supplier_id, {"name": name, "email": email, "phone": phone, "cnpj": cnpj, "address": address, "category": category})
     conn.close()
     flash("Fornecedor atualizado", "success")
     return redirect(url_for("suppliers_list"))
 
 @app.route("/suppliers/<int:supplier_id>/delete", methods=["POST"])
+@require_active_subscription
 def suppliers_delete(supplier_id):
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    conn.execute("DELETE FROM suppliers WHERE id=? AND user_id=?", (supplier_id, user["id"]))
-    conn.commit()
+    with write_transaction(conn):
+        CatalogRepository(conn, "suppliers", user["id"]).delete(supplier_id)
     conn.close()
     flash("Fornecedor excluído", "success")
     return redirect(url_for("suppliers_list"))
 
 @app.route("/labor")
+@require_active_subscription
+@cached_page
 def labor_list():
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    labor = conn.execute("SELECT * FROM labor WHERE user_id=? ORDER BY category, name", (user["id"],)).fetchall()
+    page = fetch_list_page(conn, "labor", user["id"], request.args)
     conn.close()
-    return render_template("mao_obra.html", labor=labor, user=user)
+    return render_template("mao_obra.html", labor=page["items"], page=page, user=user)
 
 @app.route("/labor/add", methods=["POST"])
+@require_active_subscription
 def labor_add():
     user = current_user()
     if not user:
@@ -1089,14 +2919,16 @@ def labor_add():
     price = float(request.form.get("price") or 0)
     description = request.form.get("description", "")
     conn = get_db_conn()
-    conn.execute("INSERT INTO labor (user_id, name, category, unit, price, description, updated_at) VALUES (?,?,?,?,?,?,?)",
-                 (user["id"], name, category, unit, price, description, datetime.utcnow().isoformat()))
-    conn.commit()
+    catalog = CatalogRepository(conn, "labor", user["id"])
+    with write_transaction(conn):
+        catalog.add({"name": name, "category": category, "unit": unit, "price": price, "description": description})
+        reprice_budgets(conn, user["id"], "labor", catalog.changed_names)
     conn.close()
     flash("Mão de obra adicionada", "success")
     return redirect(url_for("labor_list"))
 
 @app.route("/labor/<int:labor_id>/edit", methods=["POST"])
+@require_active_subscription
 def labor_edit(labor_id):
     user = current_user()
     if not user:
@@ -1109,36 +2941,43 @@ def labor_edit(labor_id):
     description = request.form.get("description", "")
     
     conn = get_db_conn()
-    conn.execute("UPDATE labor SET name=?, category=?, unit=?, price=?, description=?, updated_at=? WHERE id=? AND user_id=?",
-                 (name, category, unit, price, description, datetime.utcnow().isoformat(), labor_id, user["id"]))
-    conn.commit()
+    catalog = CatalogRepository(conn, "labor", user["id"])
+    with write_transaction(conn):
+        catalog.save(labor_id, {"name": name, "category": category, "unit": unit, "price": price, "description": description})
+        reprice_budgets(conn, user["id"], "labor", catalog.changed_names)
     conn.close()
     flash("Mão de obra atualizada", "success")
     return redirect(url_for("labor_list"))
 
 @app.route("/labor/<int:labor_id>/delete", methods=["POST"])
+@require_active_subscription
 def labor_delete(labor_id):
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    conn.execute("DELETE FROM labor WHERE id=? AND user_id=?", (labor_id, user["id"]))
-    conn.commit()
+    catalog = CatalogRepository(conn, "labor", user["id"])
+    with write_transaction(conn):
+        catalog.delete(labor_id)
+        reprice_budgets(conn, user["id"], "labor", catalog.changed_names)
     conn.close()
     flash("Mão de obra excluída", "success")
     return redirect(url_for("labor_list"))
 
 @app.route("/equipment")
+@require_active_subscription
+@cached_page
 def equipment_list():
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    equipment = conn.execute("SELECT * FROM equipment WHERE user_id=? ORDER BY category, name", (user["id"],)).fetchall()
+    page = fetch_list_page(conn, "equipment", user["id"], request.args)
     conn.close()
-    return render_template("equipamentos.html", equipment=equipment, user=user)
+    return render_template("equipamentos.html", equipment=page["items"], page=page, user=user)
 
 @app.route("/equipment/add", methods=["POST"])
+@require_active_subscription
 def equipment_add():
     user = current_user()
     if not user:
@@ -1149,14 +2988,16 @@ def equipment_add():
     price = float(request.form.get("price") or 0)
     description = request.form.get("description", "")
     conn = get_db_conn()
-    conn.execute("INSERT INTO equipment (user_id, name, category, unit, price, description, updated_at) VALUES (?,?,?,?,?,?,?)",
-                 (user["id"], name, category, unit, price, description, datetime.utcnow().isoformat()))
-    conn.commit()
+    catalog = CatalogRepository(conn, "equipment", user["id"])
+    with write_transaction(conn):
+        catalog.add({"name": name, "category": category, "unit": unit, "price": price, "description": description})
+        reprice_budgets(conn, user["id"], "equipment", catalog.changed_names)
     conn.close()
     flash("Equipamento adicionado", "success")
     return redirect(url_for("equipment_list"))
 
 @app.route("/equipment/<int:equipment_id>/edit", methods=["POST"])
+@require_active_subscription
 def equipment_edit(equipment_id):
     user = current_user()
     if not user:
@@ -1169,328 +3010,1103 @@ def equipment_edit(equipment_id):
     description = request.form.get("description", "")
     
     conn = get_db_conn()
-    conn.execute("UPDATE equipment SET name=?, category=?, unit=?, price=?, description=?, updated_at=? WHERE id=? AND user_id=?",
-                 (name, category, unit, price, description, datetime.utcnow().isoformat(), equipment_id, user["id"]))
-    conn.commit()
+    catalog = CatalogRepository(conn, "equipment", user["id"])
+    with write_transaction(conn):
+        catalog.save(equipment_id, {"name": name, "category": category, "unit": unit, "price": price, "description": description})
+        reprice_budgets(conn, user["id"], "equipment", catalog.changed_names)
     conn.close()
     flash("Equipamento atualizado", "success")
     return redirect(url_for("equipment_list"))
 
 @app.route("/equipment/<int:equipment_id>/delete", methods=["POST"])
+@require_active_subscription
 def equipment_delete(equipment_id):
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    conn.execute("DELETE FROM equipment WHERE id=? AND user_id=?", (equipment_id, user["id"]))
-    conn.commit()
+    catalog = CatalogRepository(conn, "equipment", user["id"])
+    with write_transaction(conn):
+        catalog.delete(equipment_id)
+        reprice_budgets(conn, user["id"], "equipment", catalog.changed_names)
     conn.close()
     flash("Equipamento excluído", "success")
     return redirect(url_for("equipment_list"))
 
-def calc_quantities(area, finish_level, project_type):
-    multiplier = 1.0
-    if project_type == "comercial":
-        multiplier = 1.2
-    elif project_type == "industrial":
-        multiplier = 1.5
-    
-    finish_mult = {"simples": 1.0, "medio": 1.3, "alto": 1.6}
-    finish_factor = finish_mult.get(finish_level, 1.0)
-    
-    total_mult = multiplier * finish_factor
-    
-    materials = [
-        ("Cimento", round(area * 5.0 * total_mult), "sacos"),
-        ("Areia", round(area * 0.05 * total_mult, 3), "m³"),
-        ("Brita", round(area * 0.04 * total_mult, 3), "m³"),
-        ("Tijolos", int(area * 15 * total_mult), "un"),
-        ("Ferro 10mm", round(area * 8.0 * total_mult, 2), "kg"),
-        ("Argamassa", round(area * 0.03 * total_mult), "sacos"),
-        ("Cerâmica", round(area * 0.8 * total_mult, 2), "m²"),
-        ("Tinta", round(area * 0.25 * total_mult, 2), "lata"),
-    ]
-    
-    dias_obra = max(15, int(area * 0.3 * total_mult))
-    
-    labor = [
-        ("Pedreiro", dias_obra * 1.5, "dia"),
-        ("Servente", dias_obra * 2.0, "dia"),
-        ("Eletricista", max(5, int(dias_obra * 0.2)), "dia"),
-        ("Encanador", max(5, int(dias_obra * 0.2)), "dia"),
-        ("Pintor", max(3, int(dias_obra * 0.15)), "dia"),
-    ]
-    
-    equipment = [
-        ("Betoneira", min(dias_obra, 30), "dia"),
-        ("Andaime", min(dias_obra, 20), "dia"),
-        ("Serra circular", max(5, int(dias_obra * 0.1)), "dia"),
+IMPORT_TABLES = {"materials": "un", "labor": "hora", "equipment": "dia"}
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_SAMPLE_SIZE = 50
+# Cabeçalhos aceitos, já sem acento e em minúsculas; vale o prefixo, então
+# "PRECO MEDIANO R$" (SINAPI) cai em price e "DESCRICAO DO INSUMO" em name
+IMPORT_COLUMN_ALIASES = (
+    ("name", ("nome", "name", "descricao", "insumo", "item")),
+    ("unit", ("unidade", "unit", "und", "un")),
+    ("price", ("preco", "price", "valor", "custo")),
+    ("category", ("categoria", "category", "classificacao", "classe", "grupo")),
+)
+
+def normalize_header(value):
+    value = unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode().lower()
+    return re.sub(r"[^a-z0-9]+", " ", value).strip()
+
+def match_import_columns(header):
+    columns = {}
+    for index, value in enumerate(header):
+        normalized = normalize_header(value)
+        for field, aliases in IMPORT_COLUMN_ALIASES:
+            if field not in columns and any(normalized == alias or normalized.startswith(alias + " ") for alias in aliases):
+                columns[field] = index
+                break
+    return columns if "name" in columns and "price" in columns else None
+
+def parse_price(value):
+    value = value.strip().replace("R$", "").replace(" ", "")
+    if "," in value:
+        value = value.replace(".", "").replace(",", ".")
+    return float(value)
+
+def detect_encoding(path):
+    with open(path, "rb") as f:
+        sample = f.read(65536)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "latin-1"
+
+def find_import_header(lines):
+    # O separador certo é o que faz aparecer um cabeçalho reconhecível;
+    # ";" vem antes de "," porque planilhas brasileiras usam vírgula decimal
+    for delimiter in (";", "\t", ","):
+        for index, header in enumerate(csv.reader(lines, delimiter=delimiter)):
+            columns = match_import_columns(header)
+            if columns:
+                return delimiter, index, columns
+    raise ValueError("Cabeçalho não encontrado: a planilha precisa das colunas de nome e preço")
+
+def read_price_table(path):
+    """Lê a planilha em streaming: devolve (nome, unidade, preço, categoria) por linha, ou None se inválida.
+
+    Unidade e categoria vêm como None quando a planilha não as informa.
+    """
+    with open(path, newline="", encoding=detect_encoding(path)) as f:
+        # Exportações do SINAPI trazem linhas de título antes do cabeçalho
+        delimiter, header_index, columns = find_import_header(list(itertools.islice(f, 20)))
+        f.seek(0)
+        reader = csv.reader(f, delimiter=delimiter)
+        for _ in range(header_index + 1):
+            next(reader)
+
+        for line in reader:
+            if not "".join(line).strip():
+                continue
+            try:
+                name = line[columns["name"]].strip()
+                price = parse_price(line[columns["price"]])
+            except (IndexError, ValueError):
+                yield None
+                continue
+            if not name:
+                yield None
+                continue
+            unit = line[columns["unit"]].strip() if "unit" in columns and columns["unit"] < len(line) else ""
+            category = line[columns["category"]].strip().lower() if "category" in columns and columns["category"] < len(line) else ""
+            yield name, unit or None, price, category or None
+
+def import_catalog(conn, user_id, table, rows, dry_run=False, progress=None):
+    """Upsert em lotes por (user_id, nome), sem diferenciar maiúsculas. Em dry_run só calcula o diff.
+
+    user_id None importa direto no catálogo compartilhado."""
+    # Tuplas em vez de sqlite3.Row: o catálogo inteiro do usuário passa por aqui
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    if user_id is None:
+        source, params = f"(SELECT * FROM {table} WHERE user_id IS NULL) AS {table}", ()
+    else:
+        source, params = catalog_source(table), (user_id, user_id)
+    existing = {}
+    # Itens compartilhados alterados pelo arquivo viram sobrescritas do usuário
+    shared = {}
+    for item_id, owner, name, unit, price, category in cursor.execute(
+        f"SELECT id, user_id, name, unit, price, category FROM {source} ORDER BY user_id IS NOT NULL, id", params
+    ):
+        key = (name or "").strip().lower()
+        existing[key] = [item_id, name, unit, price, category]
+        if owner is None and user_id is not None:
+            shared[key] = item_id
+
+    report = {"table": table, "dry_run": dry_run, "rows": 0, "inserted": 0, "updated": 0,
+              "unchanged": 0, "invalid": 0, "repriced_projects": 0, "changes": []}
+    new_keys = set()
+    updated_keys = set()
+    updated_at = datetime.utcnow().isoformat()
+    chunk = []
+    if conn.dialect == "postgresql":
+        seq, real = "seq INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY", "DOUBLE PRECISION"
+    else:
+        seq, real = "seq INTEGER PRIMARY KEY", "REAL"
+    conn.execute(f"""CREATE TEMP TABLE IF NOT EXISTS import_stage (
+        {seq}, item_id INTEGER, base_id INTEGER, name TEXT, unit TEXT, price {real}, category TEXT
+    )""")
+    owner = "user_id IS NULL" if user_id is None else "user_id=?"
+
+    def flush():
+        inserts = {}
+        updates = {}
+        for name, unit, price, category in chunk:
+            key = name.lower()
+            current = existing.get(key)
+            # Sem unidade ou categoria na planilha, o item mantém as que já tinha
+            if current:
+                values = (name, unit or current[2], price, category or current[4])
+            else:
+                values = (name, unit or IMPORT_TABLES[table], price, category or "geral")
+            if current is not None and current[1:] == list(values):
+                report["unchanged"] += 1
+                continue
+            item_id = current[0] if current else None
+            if len(report["changes"]) < IMPORT_SAMPLE_SIZE:
+                report["changes"].append({"action": "update" if current else "insert", "name": values[0],
+                                          "old_price": current[3] if current else None, "new_price": values[2]})
+            # Repetições dentro do arquivo: vale a última linha
+            if key in shared:
+                inserts[key] = (shared[key], *values)
+                updated_keys.add(key)
+            elif item_id is None:
+                inserts[key] = (None, *values)
+                new_keys.add(key)
+            else:
+                updates[key] = (*values, updated_at, item_id)
+                if key not in new_keys:
+                    updated_keys.add(key)
+            existing[key] = [item_id, *values]
+        if dry_run:
+            return
+
+        # Os triggers de busca e de histórico custam bem menos quando o lote
+        # inteiro entra num único INSERT ... SELECT / UPDATE ... FROM: o FTS5
+        # descarrega o índice a cada comando, não a cada linha
+        with write_transaction(conn):
+            last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+            conn.execute("DELETE FROM import_stage")
+            conn.executemany("INSERT INTO import_stage (item_id, base_id, name, unit, price, category) VALUES (?,?,?,?,?,?)",
+                             [(None, *values) for values in inserts.values()] +
+                             [(item_id, None, *values) for *values, _, item_id in updates.values()])
+            conn.execute(f"""INSERT INTO {table} (user_id, base_id, name, unit, price, category, updated_at)
+                SELECT CAST(? AS INTEGER), base_id, name, unit, price, category, ? FROM import_stage WHERE item_id IS NULL ORDER BY seq""",
+                         (user_id, updated_at))
+            conn.execute(f"""UPDATE {table} SET name=s.name, unit=s.unit, price=s.price, category=s.category, updated_at=?
+                FROM import_stage s WHERE s.item_id = {table}.id""", (updated_at,))
+            bump_data_version(conn, user_id)
+        # Ids das linhas novas, para repetições em lotes seguintes virarem UPDATE
+        for row in conn.execute(f"SELECT id, name FROM {table} WHERE id > ? AND {owner}",
+                                (last_id,) if user_id is None else (last_id, user_id)):
+            key = row["name"].lower()
+            shared.pop(key, None)
+            entry = existing.get(key)
+            if entry is not None:
+                entry[0] = row["id"]
+
+    for item in rows:
+        report["rows"] += 1
+        if item is None:
+            report["invalid"] += 1
+        else:
+            chunk.append(item)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            flush()
+            chunk = []
+            if progress:
+                progress(report["rows"])
+    flush()
+    if progress:
+        progress(report["rows"])
+    report["inserted"] = len(new_keys)
+    report["updated"] = len(updated_keys)
+    if not dry_run and (new_keys or updated_keys):
+        # O catálogo padrão muda o orçamento de todos que não sobrescreveram o item
+        with write_transaction(conn):
+            if user_id is None:
+                owners = BudgetRepository(conn).price_key_owners(CATALOG_ITEM_TYPES[table])
+            else:
+                owners = [user_id]
+            for owner in owners:
+                repriced = reprice_budgets(conn, owner, table, new_keys | updated_keys)
+                if repriced:
+                    report["repriced_projects"] += len(repriced)
+                    bump_data_version(conn, owner)
+    return report
+
+def count_lines(path):
+    with open(path, "rb") as f:
+        return sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b""))
+
+def import_job(conn, job_id, user_id, path, table, dry_run):
+    try:
+        update_job(conn, job_id, total=count_lines(path))
+        report = import_catalog(conn, user_id, table, read_price_table(path), dry_run,
+                                progress=lambda done: update_job(conn, job_id, progress=done))
+    finally:
+        os.remove(path)
+    suffix = "previa" if dry_run else "resultado"
+    return json.dumps(report, ensure_ascii=False, indent=2).encode("utf-8"), f"importacao_{table}_{suffix}.json"
+
+@app.route("/catalog/<table>/import", methods=["POST"])
+@require_active_subscription
+def catalog_import(table):
+    user = current_user()
+    if not user:
+        return jsonify({"error": "login required"}), 401
+    if table not in IMPORT_TABLES:
+        return jsonify({"error": "tabela inválida"}), 404
+    upload = request.files.get("file")
+    if not upload or not upload.filename:
+        return jsonify({"error": "arquivo obrigatório"}), 400
+
+    # O upload vai para disco e o job lê dali em streaming
+    fd, path = tempfile.mkstemp(prefix="civipro_import_", suffix=".csv")
+    with os.fdopen(fd, "wb") as f:
+        shutil.copyfileobj(upload.stream, f)
+    dry_run = request.form.get("dry_run") in ("1", "on", "true")
+    job_id = enqueue_job(user["id"], "import", {"path": path, "table": table, "dry_run": dry_run})
+    return jsonify(job_status(get_user_job(job_id, user["id"]))), 202
+
+# Coeficientes de quantidade por item: qtd = base × coeficiente, onde a base é a
+# área × fator do tipo × fator do acabamento ("area") ou os dias de obra ("days").
+# decimals: None mantém o valor, -1 trunca para inteiro, N arredonda em N casas.
+# (item_type, name, unit, basis, coefficient, min_qty, max_qty, decimals)
+DEFAULT_COEFFICIENTS = [
+    ("project_type", "residencial", None, None, 1.0, None, None, None),
+    ("project_type", "comercial", None, None, 1.2, None, None, None),
+    ("project_type", "industrial", None, None, 1.5, None, None, None),
+    ("finish_level", "simples", None, None, 1.0, None, None, None),
+    ("finish_level", "medio", None, None, 1.3, None, None, None),
+    ("finish_level", "alto", None, None, 1.6, None, None, None),
+    ("schedule", "dias_obra", "dia", "area", 0.3, 15, None, -1),
+    ("material", "Cimento", "sacos", "area", 5.0, None, None, 0),
+    ("material", "Areia", "m³", "area", 0.05, None, None, 3),
+    ("material", "Brita", "m³", "area", 0.04, None, None, 3),
+    ("material", "Tijolos", "un", "area", 15, None, None, -1),
+    ("material", "Ferro 10mm", "kg", "area", 8.0, None, None, 2),
+    ("material", "Argamassa", "sacos", "area", 0.03, None, None, 0),
+    ("material", "Cerâmica", "m²", "area", 0.8, None, None, 2),
+    ("material", "Tinta", "lata", "area", 0.25, None, None, 2),
+    ("labor", "Pedreiro", "dia", "days", 1.5, None, None, None),
+    ("labor", "Servente", "dia", "days", 2.0, None, None, None),
+    ("labor", "Eletricista", "dia", "days", 0.2, 5, None, -1),
+    ("labor", "Encanador", "dia", "days", 0.2, 5, None, -1),
+    ("labor", "Pintor", "dia", "days", 0.15, 3, None, -1),
+    ("equipment", "Betoneira", "dia", "days", 1.0, None, 30, None),
+    ("equipment", "Andaime", "dia", "days", 1.0, None, 20, None),
+    ("equipment", "Serra circular", "dia", "days", 0.1, 5, None, -1),
+]
+
+COEFFICIENT_FIELDS = ("item_type", "name", "unit", "basis", "coefficient", "min_qty", "max_qty", "decimals")
+
+BUDGET_ITEM_TYPES = ("material", "labor", "equipment")
+
+def resolve_coefficients(rows):
+    # Linhas do usuário (user_id preenchido) vêm depois e substituem as padrão
+    resolved = {}
+    for row in rows:
+        resolved[(row["item_type"], row["name"].lower())] = {field: row[field] for field in COEFFICIENT_FIELDS}
+
+    table = {"project_type": {}, "finish_level": {}, "schedule": None, "items": []}
+    for (item_type, key), coef in resolved.items():
+        if item_type in ("project_type", "finish_level"):
+            table[item_type][key] = coef["coefficient"]
+        elif item_type == "schedule":
+            table["schedule"] = coef
+        elif item_type in BUDGET_ITEM_TYPES:
+            table["items"].append(coef)
+    return table
+
+DEFAULT_COEFFICIENT_TABLE = resolve_coefficients(
+    [dict(zip(COEFFICIENT_FIELDS, row)) for row in DEFAULT_COEFFICIENTS]
+)
+
+def load_coefficients(conn, user_id):
+    rows = conn.execute("""
+        SELECT * FROM budget_coefficients
+        WHERE user_id IS NULL OR user_id=?
+        ORDER BY user_id IS NOT NULL, sort_order, id
+    """, (user_id,)).fetchall()
+    return resolve_coefficients(rows) if rows else DEFAULT_COEFFICIENT_TABLE
+
+def _apply_coefficient(coef, areas, total_mult, days):
+    # Mesma ordem de operações da fórmula original: (área × coef) × fator
+    if coef["basis"] == "days":
+        qty = days * coef["coefficient"]
+    else:
+        qty = areas * coef["coefficient"] * total_mult
+    decimals = coef["decimals"]
+    if decimals is not None and decimals < 0:
+        qty = np.trunc(qty)
+    elif decimals is not None:
+        # O np.round escala por 10**N antes de arredondar e erra a última casa
+        # perto dos empates (0,0325 ou 2,675). Esses poucos valores passam pelo
+        # round() do Python, igual à fórmula original; os demais já coincidem
+        scaled = qty * 10.0 ** decimals
+        near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+        rounded = np.round(qty, decimals)
+        for i in np.flatnonzero(near_tie).tolist():
+            rounded[i] = round(float(qty[i]), decimals)
+        qty = rounded
+    if coef["min_qty"] is not None or coef["max_qty"] is not None:
+        qty = np.clip(qty, coef["min_qty"], coef["max_qty"])
+    return qty
+
+def calc_quantities_batch(areas, finish_levels, project_types, coefficients=None):
+    """Calcula as quantidades de uma carteira inteira de uma vez.
+
+    Retorna (items, matriz) onde matriz[i, j] é a quantidade do item j no
+    projeto i.
+    """
+    coefficients = coefficients or DEFAULT_COEFFICIENT_TABLE
+    areas = np.asarray([a or 0 for a in areas], dtype=float)
+    type_factor = np.asarray([coefficients["project_type"].get(t, 1.0) for t in project_types], dtype=float)
+    finish_factor = np.asarray([coefficients["finish_level"].get(f, 1.0) for f in finish_levels], dtype=float)
+    total_mult = type_factor * finish_factor
+
+    days = np.zeros(len(areas))
+    if coefficients["schedule"]:
+        days = _apply_coefficient(coefficients["schedule"], areas, total_mult, days)
+
+    items = coefficients["items"]
+    quantities = np.empty((len(areas), len(items)))
+    for j, coef in enumerate(items):
+        quantities[:, j] = _apply_coefficient(coef, areas, total_mult, days)
+    return items, quantities
+
+def calc_quantities(area, finish_level, project_type, coefficients=None):
+    items, quantities = calc_quantities_batch([area], [finish_level], [project_type], coefficients)
+    groups = {item_type: [] for item_type in BUDGET_ITEM_TYPES}
+    for coef, qty in zip(items, quantities[0].tolist()):
+        groups[coef["item_type"]].append((coef["name"], qty, coef["unit"]))
+    return groups["material"], groups["labor"], groups["equipment"]
+
+def load_price_map(conn, user_id, table):
+    # Itens do próprio usuário por último: num nome repetido, vale o preço dele
+    return {row["name"].lower(): row["price"] for row in conn.execute(
+        f"SELECT name, price FROM {catalog_source(table)} ORDER BY user_id IS NOT NULL, id", (user_id, user_id)
+    )}
+
+def load_price_maps(conn, user_id):
+    return {item_type: load_price_map(conn, user_id, table) for item_type, table in PRICE_TABLES}
+
+def load_price_maps_as_of(conn, user_id, as_of):
+    # Uma consulta para o catálogo inteiro: o MAX() faz o SQLite devolver, por
+    # item, a linha mais recente até a data, percorrendo o índice em ordem.
+    # O catálogo compartilhado vem primeiro e as linhas do usuário por cima
+    price_maps = {item_type: {} for item_type, _ in PRICE_TABLES}
+    if conn.dialect == "postgresql":
+        # Sem a coluna solta do MAX(): DISTINCT ON faz o mesmo percorrendo o índice
+        latest = """SELECT DISTINCT ON (item_type, item_id) user_id, item_type, item_id, base_id, name, price, effective_at
+            FROM price_history WHERE {owner} AND effective_at<=?
+            ORDER BY item_type, item_id, effective_at DESC, id DESC"""
+        first = """SELECT DISTINCT ON (item_type, item_id) user_id, item_type, item_id, base_id, name, price, effective_at
+            FROM price_history WHERE user_id IS NULL AND effective_at>?
+            ORDER BY item_type, item_id, effective_at, id"""
+    else:
+        latest = """SELECT user_id, item_type, item_id, base_id, name, price, MAX(effective_at) AS effective_at
+            FROM price_history WHERE {owner} AND effective_at<=?
+            GROUP BY item_type, item_id"""
+        first = """SELECT user_id, item_type, item_id, base_id, name, price, MIN(effective_at) AS effective_at
+            FROM price_history WHERE user_id IS NULL AND effective_at>?
+            GROUP BY item_type, item_id"""
+    rows = conn.execute(f"""
+        SELECT * FROM ({latest.format(owner="user_id IS NULL")}) AS shared
+        UNION ALL
+        SELECT * FROM ({latest.format(owner="user_id=?")}) AS own
+    """, (as_of, user_id, as_of)).fetchall()
+    # O histórico do catálogo compartilhado começa na migração que o criou:
+    # antes disso, cada item compartilhado vale o primeiro preço conhecido.
+    # Entram antes das linhas do usuário, que continuam por cima
+    known = {(row["item_type"], row["item_id"]) for row in rows if row["user_id"] is None}
+    rows = [row for row in conn.execute(first, (as_of,))
+            if (row["item_type"], row["item_id"]) not in known] + rows
+    # Mesma precedência de load_price_map: as linhas do usuário vêm por último
+    rows.sort(key=lambda row: (row["user_id"] is not None, row["item_id"]))
+    overridden = {(row["item_type"], row["base_id"]) for row in rows if row["base_id"] is not None}
+    for row in rows:
+        if row["user_id"] is None and (row["item_type"], row["item_id"]) in overridden:
+            continue
+        if row["price"] is not None and row["name"]:
+            price_maps[row["item_type"]][row["name"].lower()] = row["price"]
+    return price_maps
+
+def price_vector(items, price_maps):
+    return np.asarray([price_maps[coef["item_type"]].get(coef["name"].lower(), 0) or 0 for coef in items], dtype=float)
+
+def estimate_costs(projects, coefficients, price_maps):
+    items, quantities = calc_quantities_batch(
+        [p["area"] for p in projects],
+        [p["finish_level"] for p in projects],
+        [p["project_type"] or "residencial" for p in projects],
+        coefficients
+    )
+    costs = quantities * price_vector(items, price_maps)
+    return items, quantities, costs
+
+def subtotals_by_type(items, costs):
+    item_types = np.array([coef["item_type"] for coef in items])
+    return {item_type: costs[:, item_types == item_type].sum(axis=1).tolist() for item_type in BUDGET_ITEM_TYPES}
+
+def regenerate_budgets(conn, user_id, projects):
+    # Todas as linhas são calculadas em memória e gravadas numa única transação
+    # com um único timestamp
+    if not projects:
+        return 0
+    items, quantities, costs = estimate_costs(projects, load_coefficients(conn, user_id), load_price_maps(conn, user_id))
+    created_at = datetime.utcnow().isoformat()
+
+    budget_rows = []
+    for proj, qty_row, cost_row in zip(projects, quantities.tolist(), costs.tolist()):
+        for coef, qty, cost in zip(items, qty_row, cost_row):
+            budget_rows.append((proj["id"], user_id, coef["item_type"], coef["name"], coef["name"].lower(), qty,
+                                coef["unit"], cost, created_at))
+    totals = [(total, proj["id"]) for proj, total in zip(projects, costs.sum(axis=1).tolist())]
+
+    subtotals = subtotals_by_type(items, costs)
+    summaries = [
+        (proj["id"], user_id, total, material, labor, equipment, len(items), created_at)
+        for proj, (total, _), material, labor, equipment
+        in zip(projects, totals, subtotals["material"], subtotals["labor"], subtotals["equipment"])
     ]
-    
-    return materials, labor, equipment
+
+    with write_transaction(conn):
+        BudgetRepository(conn).replace([proj["id"] for proj in projects], budget_rows, totals, summaries)
+    return len(budget_rows)
+
+# Troca de preço no catálogo vai direto para os orçamentos já gerados;
+# REPRICE_BUDGETS=0 deixa os orçamentos com o preço da última geração
+REPRICE_BUDGETS = os.environ.get("REPRICE_BUDGETS", "1") != "0"
+
+def reprice_budgets(conn, user_id, table, names):
+    """Recalcula só as linhas de orçamento que usam os itens alterados e o
+    resumo dos projetos afetados; devolve os ids desses projetos.
+
+    Um UPDATE por item, com o mesmo preço que regenerate_budgets usaria.
+    Roda dentro da transação de quem alterou o catálogo."""
+    if not REPRICE_BUDGETS or not names:
+        return set()
+    budgets = BudgetRepository(conn)
+    item_type = CATALOG_ITEM_TYPES[table]
+    keys = {name.lower() for name in names if name} & budgets.price_keys(user_id, item_type)
+    if not keys:
+        return set()
+    prices = load_price_map(conn, user_id, table)
+    project_ids = set()
+    for key in sorted(keys):
+        project_ids |= budgets.reprice(user_id, item_type, key, prices.get(key, 0) or 0)
+    if project_ids:
+        affected = sorted(project_ids)
+        rebuild_cost_summary(conn, affected)
+        invalidate_pdf_cache(conn, affected)
+    return project_ids
 
 @app.route("/projects/<int:project_id>/generate_budget", methods=["POST"])
+@require_active_subscription
 def generate_budget(project_id):
     user = current_user()
     if not user:
         return redirect(url_for("login"))
 
     conn = get_db_conn()
-    proj = conn.execute("SELECT * FROM projects WHERE id=? AND user_id=?", (project_id, user["id"])).fetchone()
+    proj = ProjectRepository(conn, user["id"]).get(project_id)
     if not proj:
         conn.close()
         flash("Projeto inválido", "danger")
         return redirect(url_for("projects_list"))
 
-    mats = {m["name"].lower(): m for m in conn.execute("SELECT * FROM materials WHERE user_id=?", (user["id"],)).fetchall()}
-    labor_dict = {l["name"].lower(): l for l in conn.execute("SELECT * FROM labor WHERE user_id=?", (user["id"],)).fetchall()}
-    equip_dict = {e["name"].lower(): e for e in conn.execute("SELECT * FROM equipment WHERE user_id=?", (user["id"],)).fetchall()}
-
-    project_type = proj["project_type"] if "project_type" in proj.keys() else "residencial"
-    materials, labor, equipment = calc_quantities(proj["area"], proj["finish_level"], project_type)
-    
-    c = conn.cursor()
-    c.execute("DELETE FROM budgets WHERE project_id=?", (project_id,))
-
-    total_cost = 0
-    
-    for name, qty, unit in materials:
-        price = 0
-        key = name.lower()
-        if key in mats:
-            price = mats[key]["price"] * qty
-        total_cost += price
-        c.execute("INSERT INTO budgets (project_id, item_type, material, quantity, unit, cost, created_at) VALUES (?,?,?,?,?,?,?)",
-                  (project_id, "material", name, qty, unit, price, datetime.utcnow().isoformat()))
-    
-    for name, qty, unit in labor:
-        price = 0
-        key = name.lower()
-        if key in labor_dict:
-            price = labor_dict[key]["price"] * qty
-        total_cost += price
-        c.execute("INSERT INTO budgets (project_id, item_type, material, quantity, unit, cost, created_at) VALUES (?,?,?,?,?,?,?)",
-                  (project_id, "labor", name, qty, unit, price, datetime.utcnow().isoformat()))
-    
-    for name, qty, unit in equipment:
-        price = 0
-        key = name.lower()
-        if key in equip_dict:
-            price = equip_dict[key]["price"] * qty
-        total_cost += price
-        c.execute("INSERT INTO budgets (project_id, item_type, material, quantity, unit, cost, created_at) VALUES (?,?,?,?,?,?,?)",
-                  (project_id, "equipment", name, qty, unit, price, datetime.utcnow().isoformat()))
-    
-    c.execute("UPDATE projects SET real_cost=? WHERE id=?", (total_cost, project_id))
-    conn.commit()
+    regenerate_budgets(conn, user["id"], [proj])
     conn.close()
     flash("Orçamento gerado com materiais + mão de obra + equipamentos", "success")
     return redirect(url_for("project_view", project_id=project_id))
 
+@app.route("/projects/generate_budgets", methods=["POST"])
+@require_active_subscription
+def generate_budgets_bulk():
+    user = current_user()
+    if not user:
+        return redirect(url_for("login"))
+
+    project_ids = [int(pid) for pid in request.form.getlist("project_ids") if pid.isdigit()]
+    conn = get_db_conn()
+    projects = ProjectRepository(conn, user["id"]).list(project_ids or None)
+
+    regenerate_budgets(conn, user["id"], projects)
+    conn.close()
+    flash(f"Orçamentos regenerados para {len(projects)} projeto(s)", "success")
+    return redirect(url_for("projects_list"))
+
+# Mudanças no layout do PDF devem incrementar esta versão para invalidar o cache
+PDF_LAYOUT_VERSION = 2
+
+def budget_pdf_hash(proj, summary):
+    # As linhas de orçamento só mudam em regenerate_budgets e reprice_budgets;
+    # os dois reescrevem o resumo do projeto e apagam o pdf_cache dele, então
+    # projeto + resumo identificam o conteúdo do PDF
+    content = json.dumps([PDF_LAYOUT_VERSION, list(proj), list(summary) if summary else None], default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def invalidate_pdf_cache(conn, project_ids):
+    conn.executemany("DELETE FROM pdf_cache WHERE project_id=?", [(pid,) for pid in project_ids])
+
+PROJECT_TYPE_LABELS = {"residencial": "Residencial", "comercial": "Comercial", "industrial": "Industrial"}
+PROJECT_STATUS_LABELS = {"em_andamento": "Em Andamento", "concluido": "Concluído", "pausado": "Pausado"}
+
+# (item_type, título da seção, rótulo do subtotal)
+BUDGET_SECTIONS = (
+    ("material", "MATERIAIS", "Subtotal Materiais:"),
+    ("labor", "MÃO DE OBRA", "Subtotal Mão de Obra:"),
+    ("equipment", "EQUIPAMENTOS", "Subtotal Equipamentos:"),
+)
+
+PDF_MARGIN = 2 * cm
+# Altura útil do frame do corpo: A4 menos as margens e o padding de 6pt do Frame
+PDF_FRAME_HEIGHT = A4[1] - 2 * PDF_MARGIN - 12
+PDF_COLUMN_WIDTHS = (8.5 * cm, 2.5 * cm, 2 * cm, 4 * cm)
+# Nomes acima disso viram Paragraph para quebrar linha; o resto fica como texto simples
+PDF_WRAP_CHARS = 48
+# Limite inferior da altura de uma linha (fonte 9 + espaçamento), para estimar quantas cabem na página
+PDF_MIN_ROW_HEIGHT = 13
+
+_pdf_base_styles = getSampleStyleSheet()
+PDF_STYLES = {
+    "title": ParagraphStyle("civipro_title", parent=_pdf_base_styles["Title"], fontSize=18, leading=22, alignment=0),
+    "project": ParagraphStyle("civipro_project", parent=_pdf_base_styles["Heading1"], fontSize=13, leading=16,
+                              spaceBefore=4, spaceAfter=6, keepWithNext=1),
+    "section": ParagraphStyle("civipro_section", parent=_pdf_base_styles["Heading2"], fontSize=12, leading=15,
+                              spaceBefore=12, spaceAfter=4),
+    "body": ParagraphStyle("civipro_body", parent=_pdf_base_styles["Normal"], fontSize=10, leading=14),
+    "cell": ParagraphStyle("civipro_cell", parent=_pdf_base_styles["Normal"], fontSize=9, leading=11),
+}
+
+PDF_TABLE_STYLE = TableStyle([
+    ("FONT", (0, 0), (-1, 0), "Helvetica-Bold", 10),
+    ("FONT", (0, 1), (-1, -1), "Helvetica", 9),
+    ("LINEBELOW", (0, 0), (-1, 0), 0.8, colors.black),
+    ("VALIGN", (0, 0), (-1, -1), "TOP"),
+    ("TOPPADDING", (0, 0), (-1, -1), 1),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 2),
+])
+
+# Linha de subtotal: rótulo ocupa todas as colunas menos a do valor
+PDF_FOOTER_STYLE = TableStyle([
+    ("SPAN", (0, -1), (-2, -1)),
+    ("ALIGN", (0, -1), (-1, -1), "RIGHT"),
+    ("FONT", (0, -1), (-1, -1), "Helvetica-Bold", 10),
+    ("LINEABOVE", (0, -1), (-1, -1), 0.5, colors.grey),
+    ("TOPPADDING", (0, -1), (-1, -1), 4),
+])
+
+PDF_TOTALS_STYLE = TableStyle([
+    ("FONT", (0, 0), (-1, 0), "Helvetica-Bold", 14),
+    ("FONT", (0, 1), (-1, -1), "Helvetica", 10),
+    ("ALIGN", (1, 0), (1, -1), "RIGHT"),
+    ("LINEABOVE", (0, 0), (-1, 0), 0.8, colors.black),
+    ("TOPPADDING", (0, 0), (-1, 0), 8),
+])
+
+class BudgetDocTemplate(BaseDocTemplate):
+    """A4 com rodapé e número de página; com with_toc, os títulos marcados com
+    toc_level entram no sumário e nos marcadores do PDF."""
+
+    def __init__(self, buffer, with_toc=False, **kwargs):
+        super().__init__(buffer, pagesize=A4, leftMargin=PDF_MARGIN, rightMargin=PDF_MARGIN, topMargin=PDF_MARGIN,
+                         bottomMargin=PDF_MARGIN, author="CiviPro", **kwargs)
+        self.with_toc = with_toc
+        self.generated_at = datetime.utcnow().strftime("%d/%m/%Y %H:%M")
+        frame = Frame(self.leftMargin, self.bottomMargin, self.width, self.height, id="body")
+        self.addPageTemplates([PageTemplate(id="page", frames=[frame], onPage=self.draw_footer)])
+
+    def draw_footer(self, c, doc):
+        c.saveState()
+        c.setFont("Helvetica-Oblique", 8)
+        c.drawString(2 * cm, 1 * cm, f"Gerado em: {self.generated_at}")
+        c.drawString(2 * cm, 0.6 * cm, "Sistema desenvolvido por João Layon - Desenvolvedor Full Stack")
+        c.drawRightString(A4[0] - 2 * cm, 1 * cm, f"Página {doc.page}")
+        c.restoreState()
+
+    def afterFlowable(self, flowable):
+        level = getattr(flowable, "toc_level", None)
+        if not self.with_toc or level is None:
+            return
+        # A chave é fixa por título: multiBuild renderiza várias vezes e os
+        # links do sumário precisam apontar para a mesma chave em todas
+        text = flowable.getPlainText()
+        self.canv.bookmarkPage(flowable.toc_key)
+        self.canv.addOutlineEntry(text, flowable.toc_key, level=level, closed=level > 0)
+        self.notify("TOCEntry", (level, text, self.page, flowable.toc_key))
+
+class PagedTable(Flowable):
+    """Tabela longa montada página a página: cada pedaço é uma Table só com as
+    linhas que cabem, com o cabeçalho repetido e o rodapé no último pedaço.
+
+    Quebrar uma LongTable recalcula e reestiliza todas as linhas restantes a cada
+    página, o que fica quadrático em orçamentos com milhares de linhas."""
+
+    def __init__(self, header, rows, footer, col_widths, style, start=0):
+        super().__init__()
+        self.header = header
+        self.rows = rows
+        self.footer = footer
+        self.col_widths = col_widths
+        self.style = style
+        self.start = start
+        self._table = None
+
+    def _page_table(self, availHeight):
+        end = min(len(self.rows), self.start + int(availHeight / PDF_MIN_ROW_HEIGHT) + 1)
+        last = end == len(self.rows)
+        data = [self.header] + self.rows[self.start:end] + ([self.footer] if last else [])
+        table = Table(data, colWidths=self.col_widths, repeatRows=1)
+        table.setStyle(self.style)
+        if last:
+            table.setStyle(PDF_FOOTER_STYLE)
+        return table, last
+
+    def wrap(self, availWidth, availHeight):
+        self._table, last = self._page_table(availHeight)
+        width, height = self._table.wrap(availWidth, availHeight)
+        # Sobraram linhas: altura acima do espaço disponível faz o frame chamar split()
+        return width, height if last else max(height, availHeight + 1)
+
+    def split(self, availWidth, availHeight):
+        table, _ = self._page_table(availHeight)
+        parts = table.split(availWidth, availHeight)
+        if len(parts) == 1:
+            return parts
+        consumed = len(parts[0]._cellvalues) - 1 if parts else 0
+        if consumed > 0:
+            return [parts[0], PagedTable(self.header, self.rows, self.footer, self.col_widths, self.style,
+                                         self.start + consumed)]
+        # Nem a primeira linha coube. Se ela cabe numa página inteira, [] manda
+        # o frame tentar de novo na próxima; mais alta que isso, só quebrando o texto
+        row = self.rows[self.start]
+        _, row_height = self._table_for([row]).wrap(availWidth, PDF_FRAME_HEIGHT * 100)
+        if row_height <= PDF_FRAME_HEIGHT:
+            return []
+        return self._split_row(row, availWidth, availHeight)
+
+    def _table_for(self, rows):
+        table = Table([self.header] + rows, colWidths=self.col_widths, repeatRows=1)
+        table.setStyle(self.style)
+        return table
+
+    def _split_row(self, row, availWidth, availHeight):
+        # Cada Paragraph da linha é cortado na altura que sobra; o resto dele
+        # vira uma linha de continuação no início do próximo pedaço
+        leading = PDF_STYLES["cell"].leading
+        height = availHeight
+        while height > leading:
+            first, rest = [], []
+            for cell, width in zip(row, self.col_widths):
+                pieces = cell.split(width - 12, height) if isinstance(cell, Paragraph) else [cell]
+                first.append(pieces[0] if pieces else "")
+                rest.append(pieces[1] if len(pieces) > 1 else (cell if not pieces else ""))
+            if any(isinstance(cell, Paragraph) for cell in rest):
+                table = self._table_for([first])
+                if table.wrap(availWidth, availHeight)[1] <= availHeight:
+                    return [table, PagedTable(self.header, [rest] + self.rows[self.start + 1:], self.footer,
+                                              self.col_widths, self.style)]
+            height -= leading
+        return []
+
+    def drawOn(self, canvas, x, y, _sW=0):
+        self._table.drawOn(canvas, x, y, _sW)
+
+def pdf_heading(text, style, toc_key=None, toc_level=None):
+    heading = Paragraph(xml_escape(text), PDF_STYLES[style])
+    heading.toc_key = toc_key
+    heading.toc_level = toc_level if toc_key else None
+    return heading
+
+def budget_item_cell(name):
+    name = str(name or "")
+    return Paragraph(xml_escape(name), PDF_STYLES["cell"]) if len(name) > PDF_WRAP_CHARS else name
+
+def budget_section_table(rows, subtotal_label):
+    subtotal = sum(row["cost"] or 0 for row in rows)
+    data = [[budget_item_cell(row["material"]), f"{row['quantity'] or 0:.2f}", row["unit"] or "", f"{row['cost'] or 0:.2f}"]
+            for row in rows]
+    style = TableStyle([("ALIGN", (1, 1), (1, -1), "RIGHT"), ("ALIGN", (3, 1), (3, -1), "RIGHT")], parent=PDF_TABLE_STYLE)
+    table = PagedTable(["Item", "Qtd", "Un", "Custo (R$)"], data, [subtotal_label, "", "", f"R$ {subtotal:,.2f}"],
+                       PDF_COLUMN_WIDTHS, style)
+    return table, subtotal
+
+def budget_project_story(proj, budget_rows, toc_key=None):
+    """Flowables de um projeto: dados, uma tabela por seção, totais e observações."""
+    proj = dict(proj)
+    story = [pdf_heading(f"Projeto: {proj['name']}", "project", toc_key, 0)]
+    details = [
+        f"Cliente: {proj.get('client') or '-'}",
+        f"Área: {proj['area']} m²",
+        f"Tipo: {PROJECT_TYPE_LABELS.get(proj.get('project_type'), 'Residencial')} | "
+        f"Acabamento: {(proj.get('finish_level') or '-').title()}",
+        f"Status: {PROJECT_STATUS_LABELS.get(proj.get('status'), 'Em Andamento')}"
+        + (f" | Prazo: {proj['deadline']}" if proj.get("deadline") else ""),
+    ]
+    story.extend(Paragraph(xml_escape(line), PDF_STYLES["body"]) for line in details)
+
+    total = 0
+    for item_type, title, subtotal_label in BUDGET_SECTIONS:
+        rows = [row for row in budget_rows if row["item_type"] == item_type]
+        if not rows:
+            continue
+        # Título e primeiras linhas da tabela na mesma página
+        story += [CondPageBreak(3 * cm), pdf_heading(title, "section", toc_key and f"{toc_key}-{item_type}", 1)]
+        table, subtotal = budget_section_table(rows, subtotal_label)
+        story.append(table)
+        total += subtotal
+
+    totals = [["TOTAL GERAL:", f"R$ {total:,.2f}"]]
+    if (proj.get("real_cost") or 0) > 0:
+        diff = proj["real_cost"] - total
+        totals += [["Custo Real:", f"R$ {proj['real_cost']:,.2f}"], ["Diferença:", f"R$ {diff:,.2f}"]]
+    totals_table = Table(totals, colWidths=(11 * cm, 6 * cm))
+    totals_table.setStyle(PDF_TOTALS_STYLE)
+    if len(totals) > 1:
+        totals_table.setStyle([("TEXTCOLOR", (1, 2), (1, 2), colors.green if totals[2][1].startswith("R$ -") else colors.red)])
+    story += [Spacer(1, 0.4 * cm), KeepTogether(totals_table)]
+
+    if proj.get("notes"):
+        story.append(pdf_heading("Observações:", "section"))
+        story.append(Paragraph(xml_escape(proj["notes"]).replace("\n", "<br/>"), PDF_STYLES["body"]))
+    return story
+
+def build_budget_document(story, title, with_toc=False):
+    buffer = BytesIO()
+    doc = BudgetDocTemplate(buffer, with_toc=with_toc, title=title)
+    if with_toc:
+        doc.multiBuild(story)
+    else:
+        doc.build(story)
+    return buffer.getvalue()
+
+def render_budget_pdf(proj, budget_rows):
+    story = [pdf_heading("ORÇAMENTO DE OBRA", "title"), Spacer(1, 0.3 * cm)]
+    story += budget_project_story(proj, budget_rows)
+    return build_budget_document(story, f"Orçamento - {dict(proj)['name']}")
+
+def render_budget_book(projects):
+    """Caderno com vários projetos [(proj, budget_rows)] num só PDF, com sumário."""
+    toc = TableOfContents()
+    toc.levelStyles = [
+        ParagraphStyle("civipro_toc0", parent=PDF_STYLES["body"], fontName="Helvetica-Bold", leftIndent=0, spaceBefore=4),
+        ParagraphStyle("civipro_toc1", parent=PDF_STYLES["cell"], leftIndent=0.8 * cm),
+    ]
+    story = [pdf_heading("CADERNO DE ORÇAMENTOS", "title"),
+             Paragraph(f"{len(projects)} projeto(s)", PDF_STYLES["body"]), Spacer(1, 0.5 * cm),
+             pdf_heading("Sumário", "section"), toc]
+    grand_total = 0
+    for proj, budget_rows in projects:
+        proj = dict(proj)
+        story.append(PageBreak())
+        story += budget_project_story(proj, budget_rows, toc_key=f"projeto-{proj['id']}")
+        grand_total += sum(row["cost"] or 0 for row in budget_rows)
+    story += [PageBreak(), pdf_heading("Resumo", "project", "resumo", 0)]
+    summary = [[budget_item_cell(dict(proj)["name"]), f"{sum(row['cost'] or 0 for row in rows):,.2f}"]
+               for proj, rows in projects]
+    story.append(PagedTable(["Projeto", "Total (R$)"], summary, ["TOTAL GERAL:", f"R$ {grand_total:,.2f}"],
+                            (12 * cm, 5 * cm), TableStyle([("ALIGN", (1, 1), (1, -1), "RIGHT")], parent=PDF_TABLE_STYLE)))
+    return build_budget_document(story, "Caderno de Orçamentos", with_toc=True)
+
+def pdf_filename(proj):
+    return f"orcamento_{proj['name'].replace(' ', '_')}.pdf"
+
+def lookup_cached_pdf(conn, project_id, content_hash):
+    cached = conn.execute("SELECT content_hash, pdf, created_at FROM pdf_cache WHERE project_id=?", (project_id,)).fetchone()
+    if cached and cached["content_hash"] == content_hash:
+        return cached
+    return None
+
+def store_cached_pdf(conn, project_id, content_hash, pdf):
+    rendered_at = datetime.utcnow().isoformat()
+    with write_transaction(conn):
+        conn.execute(
+            """INSERT INTO pdf_cache (project_id, content_hash, pdf, created_at) VALUES (?,?,?,?)
+            ON CONFLICT(project_id) DO UPDATE SET content_hash=excluded.content_hash, pdf=excluded.pdf,
+            created_at=excluded.created_at""",
+            (project_id, content_hash, pdf, rendered_at)
+        )
+    return rendered_at
+
 @app.route("/projects/<int:project_id>/export_pdf")
+@require_active_subscription
 def export_pdf(project_id):
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     conn = get_db_conn()
-    proj = conn.execute("SELECT * FROM projects WHERE id=? AND user_id=?", (project_id, user["id"])).fetchone()
+    proj = ProjectRepository(conn, user["id"]).get(project_id)
     if not proj:
         conn.close()
         flash("Projeto inválido", "danger")
         return redirect(url_for("projects_list"))
-    
-    budget_materials = conn.execute("SELECT material, quantity, unit, cost FROM budgets WHERE project_id=? AND item_type='material'", (project_id,)).fetchall()
-    budget_labor = conn.execute("SELECT material, quantity, unit, cost FROM budgets WHERE project_id=? AND item_type='labor'", (project_id,)).fetchall()
-    budget_equipment = conn.execute("SELECT material, quantity, unit, cost FROM budgets WHERE project_id=? AND item_type='equipment'", (project_id,)).fetchall()
+
+    content_hash = budget_pdf_hash(proj, BudgetRepository(conn).summaries([project_id]).get(project_id))
+
+    # Download repetido custa só o hash: o PDF renderizado fica em pdf_cache
+    cached = lookup_cached_pdf(conn, project_id, content_hash)
+    if cached:
+        pdf, rendered_at = cached["pdf"], cached["created_at"]
+    else:
+        pdf = render_budget_pdf(proj, BudgetRepository(conn).rows_by_project([project_id])[project_id])
+        rendered_at = store_cached_pdf(conn, project_id, content_hash, pdf)
     conn.close()
 
+    response = send_file(BytesIO(pdf), mimetype="application/pdf", as_attachment=True, download_name=pdf_filename(proj),
+                         etag=content_hash, last_modified=datetime.fromisoformat(rendered_at), conditional=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", os.cpu_count() or 2))
+JOB_RETENTION = timedelta(days=1)
+# Job em fila ou rodando sem atualizar updated_at há mais que isso ficou órfão
+# (o processo reiniciou ou o worker morreu) e passa a "failed"
+JOB_STALE_AFTER = timedelta(minutes=int(os.environ.get("JOB_STALE_MINUTES", 15)))
+JOB_HEARTBEAT = 60
+
+_job_runner = ThreadPoolExecutor(max_workers=2, thread_name_prefix="civipro-job")
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def get_render_pool():
+    # Processos "spawn": fazer fork de um worker do gunicorn com threads não é seguro
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _render_pool
+
+def reset_render_pool():
+    global _render_pool
+    with _render_pool_lock:
+        pool, _render_pool = _render_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def update_job(conn, job_id, **fields):
+    fields["updated_at"] = datetime.utcnow().isoformat()
+    assignments = ", ".join(f"{field}=?" for field in fields)
+    with write_transaction(conn):
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE id=?", (*fields.values(), job_id))
+
+def enqueue_job(user_id, kind, params):
+    job_id = uuid.uuid4().hex
+    conn = get_db_conn()
+    with write_transaction(conn):
+        conn.execute("DELETE FROM jobs WHERE created_at < ?", ((datetime.utcnow() - JOB_RETENTION).isoformat(),))
+        fail_stale_jobs(conn)
+        now = datetime.utcnow().isoformat()
+        conn.execute(
+            "INSERT INTO jobs (id, user_id, kind, params, status, progress, total, created_at, updated_at) VALUES (?,?,?,?,?,?,?,?,?)",
+            (job_id, user_id, kind, json.dumps(params), "queued", 0, 0, now, now)
+        )
+    conn.close()
+    _job_runner.submit(run_job, job_id, kind, user_id, params)
+    return job_id
+
+def fail_stale_jobs(conn):
+    """Marca como falhos os jobs em fila ou rodando que pararam de dar sinal de vida."""
+    now = datetime.utcnow()
+    conn.execute(
+        """UPDATE jobs SET status='failed', error=?, finished_at=?
+        WHERE status IN ('queued', 'running') AND COALESCE(updated_at, created_at) < ?""",
+        ("interrompido: o servidor reiniciou ou o job parou de responder", now.isoformat(),
+         (now - JOB_STALE_AFTER).isoformat())
+    )
+
+def wait_render(conn, job_id, future):
+    # Uma renderização longa renova updated_at para o job não parecer órfão
+    while not wait([future], timeout=JOB_HEARTBEAT).done:
+        update_job(conn, job_id)
+    return future.result()
+
+def run_job(job_id, kind, user_id, params):
+    conn = get_db_conn()
+    try:
+        update_job(conn, job_id, status="running")
+        result, result_name = JOB_KINDS[kind](conn, job_id, user_id, **params)
+        update_job(conn, job_id, status="done", result=result, result_name=result_name,
+                   finished_at=datetime.utcnow().isoformat())
+    except Exception as e:
+        conn.rollback()
+        update_job(conn, job_id, status="failed", error=str(e), finished_at=datetime.utcnow().isoformat())
+    finally:
+        conn.close()
+
+def render_pdfs_parallel(conn, job_id, projects):
+    """Renderiza os PDFs dos projetos no pool de processos, reaproveitando o cache."""
+    summaries = BudgetRepository(conn).summaries([proj["id"] for proj in projects])
+    update_job(conn, job_id, total=len(projects))
+
+    pdfs = {}
+    pending = {}
+    pool = get_render_pool()
+    for proj in projects:
+        content_hash = budget_pdf_hash(proj, summaries.get(proj["id"]))
+        cached = lookup_cached_pdf(conn, proj["id"], content_hash)
+        if cached:
+            pdfs[proj["id"]] = cached["pdf"]
+        else:
+            budget_rows = BudgetRepository(conn).rows_by_project([proj["id"]])[proj["id"]]
+            future = pool.submit(render_budget_pdf, dict(proj), [dict(row) for row in budget_rows])
+            pending[future] = (proj["id"], content_hash)
+
+    done = len(pdfs)
+    update_job(conn, job_id, progress=done)
+    try:
+        for future in as_completed(pending):
+            project_id, content_hash = pending[future]
+            pdfs[project_id] = future.result()
+            store_cached_pdf(conn, project_id, content_hash, pdfs[project_id])
+            done += 1
+            update_job(conn, job_id, progress=done)
+    except BrokenProcessPool:
+        # Um processo morreu; o próximo job recria o pool
+        reset_render_pool()
+        raise
+    return pdfs
+
+def pdf_job(conn, job_id, user_id, project_id):
+    proj = ProjectRepository(conn, user_id).get(project_id)
+    if not proj:
+        raise ValueError("Projeto inválido")
+    pdfs = render_pdfs_parallel(conn, job_id, [proj])
+    return pdfs[project_id], pdf_filename(proj)
+
+def zip_export_job(conn, job_id, user_id):
+    projects = ProjectRepository(conn, user_id).list()
+    pdfs = render_pdfs_parallel(conn, job_id, projects)
+
     buffer = BytesIO()
-    p = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
-    y = height - 2*cm
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for proj in projects:
+            archive.writestr(f"{proj['id']:05d}_{pdf_filename(proj)}", pdfs[proj["id"]])
+    return buffer.getvalue(), f"orcamentos_{datetime.utcnow().strftime('%Y%m%d')}.zip"
 
-    p.setFont("Helvetica-Bold", 18)
-    p.drawString(2*cm, y, "ORÇAMENTO DE OBRA")
-    y -= 1*cm
-    
-    p.setFont("Helvetica-Bold", 12)
-    p.drawString(2*cm, y, f"Projeto: {proj['name']}")
-    y -= 0.6*cm
-    
-    p.setFont("Helvetica", 10)
-    p.drawString(2*cm, y, f"Cliente: {proj['client'] or '-'}")
-    y -= 0.5*cm
-    p.drawString(2*cm, y, f"Área: {proj['area']} m²")
-    y -= 0.5*cm
-    
-    project_type_label = {"residencial": "Residencial", "comercial": "Comercial", "industrial": "Industrial"}.get(proj.get("project_type", "residencial"), "Residencial")
-    p.drawString(2*cm, y, f"Tipo: {project_type_label} | Acabamento: {proj['finish_level'].title()}")
-    y -= 0.5*cm
-    
-    status_label = {"em_andamento": "Em Andamento", "concluido": "Concluído", "pausado": "Pausado"}.get(proj.get("status", "em_andamento"), "Em Andamento")
-    p.drawString(2*cm, y, f"Status: {status_label}")
-    if proj.get("deadline"):
-        p.drawString(10*cm, y, f"Prazo: {proj['deadline']}")
-    y -= 1*cm
+def book_job(conn, job_id, user_id, project_ids=None):
+    projects = ProjectRepository(conn, user_id).list(project_ids or None)
+    if not projects:
+        raise ValueError("Nenhum projeto para exportar")
+    update_job(conn, job_id, total=len(projects))
 
-    total_geral = 0
-    
-    if budget_materials:
-        p.setFont("Helvetica-Bold", 12)
-        p.drawString(2*cm, y, "MATERIAIS")
-        y -= 0.5*cm
-        
-        p.setFont("Helvetica-Bold", 10)
-        p.drawString(2*cm, y, "Item")
-        p.drawString(10*cm, y, "Qtd")
-        p.drawString(13*cm, y, "Un")
-        p.drawString(16*cm, y, "Custo (R$)")
-        y -= 0.3*cm
-        p.line(2*cm, y, width - 2*cm, y)
-        y -= 0.5*cm
-
-        p.setFont("Helvetica", 9)
-        subtotal_mat = 0
-        for row in budget_materials:
-            if y < 3*cm:
-                p.showPage()
-                y = height - 2*cm
-            p.drawString(2*cm, y, str(row["material"]))
-            p.drawRightString(12*cm, y, f"{row['quantity']:.2f}")
-            p.drawString(13*cm, y, row["unit"])
-            p.drawRightString(19*cm, y, f"{row['cost']:.2f}")
-            subtotal_mat += row["cost"]
-            y -= 0.4*cm
-        
-        y -= 0.2*cm
-        p.setFont("Helvetica-Bold", 10)
-        p.drawString(13*cm, y, "Subtotal Materiais:")
-        p.drawRightString(19*cm, y, f"R$ {subtotal_mat:,.2f}")
-        total_geral += subtotal_mat
-        y -= 0.8*cm
-    
-    if budget_labor:
-        if y < 8*cm:
-            p.showPage()
-            y = height - 2*cm
-        
-        p.setFont("Helvetica-Bold", 12)
-        p.drawString(2*cm, y, "MÃO DE OBRA")
-        y -= 0.5*cm
-        
-        p.setFont("Helvetica-Bold", 10)
-        p.drawString(2*cm, y, "Item")
-        p.drawString(10*cm, y, "Qtd")
-        p.drawString(13*cm, y, "Un")
-        p.drawString(16*cm, y, "Custo (R$)")
-        y -= 0.3*cm
-        p.line(2*cm, y, width - 2*cm, y)
-        y -= 0.5*cm
-
-        p.setFont("Helvetica", 9)
-        subtotal_labor = 0
-        for row in budget_labor:
-            if y < 3*cm:
-                p.showPage()
-                y = height - 2*cm
-            p.drawString(2*cm, y, str(row["material"]))
-            p.drawRightString(12*cm, y, f"{row['quantity']:.2f}")
-            p.drawString(13*cm, y, row["unit"])
-            p.drawRightString(19*cm, y, f"{row['cost']:.2f}")
-            subtotal_labor += row["cost"]
-            y -= 0.4*cm
-        
-        y -= 0.2*cm
-        p.setFont("Helvetica-Bold", 10)
-        p.drawString(13*cm, y, "Subtotal Mão de Obra:")
-        p.drawRightString(19*cm, y, f"R$ {subtotal_labor:,.2f}")
-        total_geral += subtotal_labor
-        y -= 0.8*cm
-    
-    if budget_equipment:
-        if y < 8*cm:
-            p.showPage()
-            y = height - 2*cm
-        
-        p.setFont("Helvetica-Bold", 12)
-        p.drawString(2*cm, y, "EQUIPAMENTOS")
-        y -= 0.5*cm
-        
-        p.setFont("Helvetica-Bold", 10)
-        p.drawString(2*cm, y, "Item")
-        p.drawString(10*cm, y, "Qtd")
-        p.drawString(13*cm, y, "Un")
-        p.drawString(16*cm, y, "Custo (R$)")
-        y -= 0.3*cm
-        p.line(2*cm, y, width - 2*cm, y)
-        y -= 0.5*cm
-
-        p.setFont("Helvetica", 9)
-        subtotal_equip = 0
-        for row in budget_equipment:
-            if y < 3*cm:
-                p.showPage()
-                y = height - 2*cm
-            p.drawString(2*cm, y, str(row["material"]))
-            p.drawRightString(12*cm, y, f"{row['quantity']:.2f}")
-            p.drawString(13*cm, y, row["unit"])
-            p.drawRightString(19*cm, y, f"{row['cost']:.2f}")
-            subtotal_equip += row["cost"]
-            y -= 0.4*cm
-        
-        y -= 0.2*cm
-        p.setFont("Helvetica-Bold", 10)
-        p.drawString(13*cm, y, "Subtotal Equipamentos:")
-        p.drawRightString(19*cm, y, f"R$ {subtotal_equip:,.2f}")
-        total_geral += subtotal_equip
-        y -= 0.8*cm
-    
-    if y < 5*cm:
-        p.showPage()
-        y = height - 2*cm
-    
-    y -= 0.3*cm
-    p.line(2*cm, y, width - 2*cm, y)
-    y -= 0.7*cm
-    p.setFont("Helvetica-Bold", 14)
-    p.drawString(2*cm, y, "TOTAL GERAL:")
-    p.drawRightString(19*cm, y, f"R$ {total_geral:,.2f}")
-    
-    if proj.get("real_cost", 0) > 0:
-        y -= 0.6*cm
-        p.setFont("Helvetica", 10)
-        p.drawString(2*cm, y, "Custo Real:")
-        p.drawRightString(19*cm, y, f"R$ {proj['real_cost']:,.2f}")
-        
-        diff = proj['real_cost'] - total_geral
-        y -= 0.5*cm
-        color = "green" if diff < 0 else "red"
-        p.drawString(2*cm, y, "Diferença:")
-        p.drawRightString(19*cm, y, f"R$ {diff:,.2f}")
-    
-    if proj.get("notes"):
-        y -= 1*cm
-        p.setFont("Helvetica-Bold", 10)
-        p.drawString(2*cm, y, "Observações:")
-        y -= 0.5*cm
-        p.setFont("Helvetica", 9)
-        lines = proj["notes"].split('\n')
-        for line in lines[:5]:
-            p.drawString(2*cm, y, line[:80])
-            y -= 0.4*cm
-
-    p.setFont("Helvetica-Oblique", 8)
-    p.drawString(2*cm, 1*cm, f"Gerado em: {datetime.utcnow().strftime('%d/%m/%Y %H:%M')}")
-    p.drawString(2*cm, 0.6*cm, "Sistema desenvolvido por João Layon - Desenvolvedor Full Stack")
-
-    p.showPage()
-    p.save()
-    buffer.seek(0)
-
-    filename = f"orcamento_{proj['name'].replace(' ', '_')}.pdf"
-    return send_file(buffer, mimetype="application/pdf", as_attachment=True, download_name=filename)
+    budget_rows = BudgetRepository(conn).rows_by_project([proj["id"] for proj in projects])
+    future = get_render_pool().submit(
+        render_budget_book, [(dict(proj), [dict(row) for row in budget_rows[proj["id"]]]) for proj in projects]
+    )
+    try:
+        pdf = wait_render(conn, job_id, future)
+    except BrokenProcessPool:
+        reset_render_pool()
+        raise
+    update_job(conn, job_id, progress=len(projects))
+    return pdf, f"caderno_orcamentos_{datetime.utcnow().strftime('%Y%m%d')}.pdf"
+
+JOB_KINDS = {
+    "pdf": pdf_job,
+    "zip": zip_export_job,
+    "book": book_job,
+    "import": import_job,
+}
+
+JOB_MIMETYPES = {
+    "pdf": "application/pdf",
+    "book": "application/pdf",
+    "zip": "application/zip",
+    "import": "application/json",
+}
+
+def job_status(job):
+    return {
+        "id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "total": job["total"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "finished_at": job["finished_at"],
+        "status_url": url_for("job_detail", job_id=job["id"]),
+        "download_url": url_for("job_download", job_id=job["id"]) if job["status"] == "done" else None,
+    }
+
+def get_user_job(job_id, user_id):
+    conn = get_db_conn()
+    query = "SELECT id, kind, status, progress, total, error, created_at, updated_at, finished_at FROM jobs WHERE id=? AND user_id=?"
+    job = conn.execute(query, (job_id, user_id)).fetchone()
+    # Sem isto o navegador consultaria para sempre um job que nenhum processo vai terminar
+    stale_before = (datetime.utcnow() - JOB_STALE_AFTER).isoformat()
+    if job and job["status"] in ("queued", "running") and (job["updated_at"] or job["created_at"]) < stale_before:
+        with write_transaction(conn):
+            fail_stale_jobs(conn)
+        job = conn.execute(query, (job_id, user_id)).fetchone()
+    conn.close()
+    return job
+
+@app.route("/projects/<int:project_id>/export_pdf/job", methods=["POST"])
+@require_active_subscription
+def export_pdf_job(project_id):
+    user = current_user()
+    if not user:
+        return jsonify({"error": "login required"}), 401
+    job_id = enqueue_job(user["id"], "pdf", {"project_id": project_id})
+    return jsonify(job_status(get_user_job(job_id, user["id"]))), 202
+
+@app.route("/projects/export_zip", methods=["POST"])
+@require_active_subscription
+def export_zip():
+    user = current_user()
+    if not user:
+        return jsonify({"error": "login required"}), 401
+    job_id = enqueue_job(user["id"], "zip", {})
+    return jsonify(job_status(get_user_job(job_id, user["id"]))), 202
+
+@app.route("/projects/export_book", methods=["POST"])
+@require_active_subscription
+def export_book():
+    user = current_user()
+    if not user:
+        return jsonify({"error": "login required"}), 401
+    job_id = enqueue_job(user["id"], "book", {"project_ids": request.form.getlist("project_ids", type=int)})
+    return jsonify(job_status(get_user_job(job_id, user["id"]))), 202
+
+@app.route("/jobs/<job_id>")
+@require_active_subscription
+def job_detail(job_id):
+    user = current_user()
+    if not user:
+        return jsonify({"error": "login required"}), 401
+    job = get_user_job(job_id, user["id"])
+    if not job:
+        return jsonify({"error": "job não encontrado"}), 404
+    return jsonify(job_status(job))
+
+@app.route("/jobs/<job_id>/download")
+@require_active_subscription
+def job_download(job_id):
+    user = current_user()
+    if not user:
+        return redirect(url_for("login"))
+    conn = get_db_conn()
+    job = conn.execute(
+        "SELECT kind, status, result, result_name FROM jobs WHERE id=? AND user_id=?", (job_id, user["id"])
+    ).fetchone()
+    conn.close()
+    if not job or job["status"] != "done":
+        flash("Exportação não encontrada ou ainda em andamento", "warning")
+        return redirect(url_for("projects_list"))
+
+    return send_file(BytesIO(job["result"]), mimetype=JOB_MIMETYPES[job["kind"]], as_attachment=True,
+                     download_name=job["result_name"])
 
 @app.route("/reports")
+@require_active_subscription
+@cached_page
 def reports():
     user = current_user()
     if not user:
@@ -1498,48 +4114,615 @@ def reports():
     
     conn = get_db_conn()
     projects = conn.execute("""
-        SELECT p.*, 
-               (SELECT SUM(cost) FROM budgets WHERE project_id = p.id) as estimated_cost
-        FROM projects p 
+        SELECT p.*, s.estimated_total AS estimated_cost
+        FROM projects p LEFT JOIN project_cost_summary s ON s.project_id = p.id
         WHERE p.user_id=? 
         ORDER BY p.created_at DESC
     """, (user["id"],)).fetchall()
     
     total_estimated = sum([p["estimated_cost"] or 0 for p in projects])
     total_real = sum([p["real_cost"] or 0 for p in projects])
+
+    # Quanto cada projeto custaria hoje com os preços e coeficientes atuais
+    current_estimates = {}
+    if projects:
+        _, _, costs = estimate_costs(projects, load_coefficients(conn, user["id"]), load_price_maps(conn, user["id"]))
+        current_estimates = dict(zip([p["id"] for p in projects], costs.sum(axis=1).tolist()))
     
     conn.close()
     return render_template("relatorios.html", projects=projects, 
                           total_estimated=total_estimated, 
-                          total_real=total_real, user=user)
+                          total_real=total_real,
+                          current_estimates=current_estimates, user=user)
+
+EXPORT_COLUMNS = ("Projeto ID", "Projeto", "Cliente", "Status", "Tipo de item", "Item", "Quantidade", "Unidade", "Custo (R$)", "Gerado em")
+EXPORT_ITEM_LABELS = {"material": "Material", "labor": "Mão de obra", "equipment": "Equipamento"}
+EXPORT_BATCH_SIZE = 1000
+
+def iter_budget_export_rows(user_id):
+    # Conexão própria: o gerador continua rodando depois que a view retorna.
+    # A ordem segue os índices (user_id, created_at) e (project_id, item_type),
+    # então o SQLite não precisa ordenar tudo antes da primeira linha
+    conn = db_pool.acquire()
+    try:
+        cursor = conn.execute("""
+            SELECT p.id, p.name, p.client, p.status, b.item_type, b.material, b.quantity, b.unit, b.cost, b.created_at
+            FROM projects p JOIN budgets b ON b.project_id = p.id
+            WHERE p.user_id=?
+            ORDER BY p.created_at, p.id, b.item_type, b.id
+        """, (user_id,))
+        while True:
+            batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not batch:
+                break
+            for row in batch:
+                row = list(row)
+                row[4] = EXPORT_ITEM_LABELS.get(row[4], row[4])
+                yield row
+    finally:
+        conn.close()
+
+def stream_csv(rows):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(EXPORT_COLUMNS)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+class _ChunkSink:
+    # Destino sem seek/tell: o zipfile grava em modo streaming (data descriptors)
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+XLSX_STATIC_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Orçamentos" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+def xlsx_row(values):
+    cells = []
+    for value in values:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f"<c><v>{value}</v></c>")
+        elif value is None or value == "":
+            cells.append("<c/>")
+        else:
+            cells.append(f'<c t="inlineStr"><is><t>{xml_escape(str(value))}</t></is></c>')
+    return f"<row>{''.join(cells)}</row>"
+
+def stream_xlsx(rows):
+    # XLSX mínimo (uma planilha, strings inline) escrito linha a linha
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_STATIC_PARTS.items():
+            archive.writestr(name, content)
+        yield sink.drain()
+
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(xlsx_row(EXPORT_COLUMNS).encode("utf-8"))
+            for count, row in enumerate(rows, 1):
+                sheet.write(xlsx_row(row).encode("utf-8"))
+                if count % EXPORT_BATCH_SIZE == 0:
+                    yield sink.drain()
+            sheet.write(b"</sheetData></worksheet>")
+    yield sink.drain()
+
+EXPORT_FORMATS = {
+    "csv": (stream_csv, "text/csv; charset=utf-8"),
+    "xlsx": (stream_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+def parse_as_of(value):
+    # Data sem hora vale até o fim do dia
+    parsed = datetime.fromisoformat(value)
+    if len(value) == 10:
+        return f"{value}T23:59:59.999999"
+    return parsed.isoformat()
+
+@app.route("/api/budgets/as_of")
+@require_active_subscription
+def api_budgets_as_of():
+    user = current_user()
+    if not user:
+        return jsonify({"error": "login required"}), 401
+    try:
+        as_of = parse_as_of(request.args.get("date", ""))
+    except ValueError:
+        return jsonify({"error": "date inválida (use AAAA-MM-DD)"}), 400
+
+    project_ids = [int(pid) for pid in request.args.get("project_ids", "").split(",") if pid.strip().isdigit()]
+    conn = get_db_conn()
+    sql = """SELECT p.*, s.estimated_total FROM projects p
+             LEFT JOIN project_cost_summary s ON s.project_id = p.id WHERE p.user_id=?"""
+    params = [user["id"]]
+    if project_ids:
+        sql += f" AND p.id IN ({','.join('?' * len(project_ids))})"
+        params.extend(project_ids)
+    projects = conn.execute(sql + " ORDER BY p.created_at DESC", params).fetchall()
+    if not projects:
+        conn.close()
+        return jsonify({"as_of": as_of, "projects": []})
+
+    # Coeficientes atuais nos dois cálculos: só os preços mudam entre as colunas
+    coefficients = load_coefficients(conn, user["id"])
+    as_of_prices = load_price_maps_as_of(conn, user["id"], as_of)
+    items, quantities, costs = estimate_costs(projects, coefficients, as_of_prices)
+    _, _, current_costs = estimate_costs(projects, coefficients, load_price_maps(conn, user["id"]))
+    conn.close()
+
+    subtotals = subtotals_by_type(items, costs)
+    include_lines = request.args.get("lines") == "1"
+    result = []
+    for i, proj in enumerate(projects):
+        total = float(costs[i].sum())
+        current = float(current_costs[i].sum())
+        entry = {
+            "project_id": proj["id"],
+            "name": proj["name"],
+            "as_of_total": total,
+            "as_of_subtotals": {item_type: subtotals[item_type][i] for item_type in BUDGET_ITEM_TYPES},
+            "current_total": current,
+            "stored_total": proj["estimated_total"],
+            "variation_percent": ((current - total) / total * 100) if total > 0 else None,
+        }
+        if include_lines:
+            entry["lines"] = [
+                {"item_type": coef["item_type"], "name": coef["name"], "unit": coef["unit"], "quantity": qty,
+                 "unit_price": as_of_prices[coef["item_type"]].get(coef["name"].lower(), 0), "cost": cost}
+                for coef, qty, cost in zip(items, quantities[i].tolist(), costs[i].tolist())
+            ]
+        result.append(entry)
+    return jsonify({"as_of": as_of, "projects": result})
+
+@app.route("/reports/export.<fmt>")
+@require_active_subscription
+def export_budgets(fmt):
+    user = current_user()
+    if not user:
+        return redirect(url_for("login"))
+    if fmt not in EXPORT_FORMATS:
+        flash("Formato de exportação inválido", "danger")
+        return redirect(url_for("reports"))
+
+    stream, mimetype = EXPORT_FORMATS[fmt]
+    filename = f"orcamentos_{datetime.utcnow().strftime('%Y%m%d')}.{fmt}"
+    return Response(stream(iter_budget_export_rows(user["id"])), mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 @app.route("/simulator")
+@require_active_subscription
 def simulator():
     user = current_user()
     if not user:
         return redirect(url_for("login"))
     
     conn = get_db_conn()
-    materials = conn.execute("SELECT * FROM materials WHERE user_id=? ORDER BY category, name", (user["id"],)).fetchall()
-    labor = conn.execute("SELECT * FROM labor WHERE user_id=? ORDER BY category, name", (user["id"],)).fetchall()
-    equipment = conn.execute("SELECT * FROM equipment WHERE user_id=? ORDER BY category, name", (user["id"],)).fetchall()
+    coefficients = load_coefficients(conn, user["id"])
+    prices = load_price_maps(conn, user["id"])
     conn.close()
-    
-    return render_template("simulador.html", user=user, materials=materials, labor=labor, equipment=equipment)
+
+    return render_template("simulador.html", user=user, coefficients=coefficients,
+                           prices=prices, default_prices=default_price_maps())
+
+SIMULATION_MAX_SAMPLES = 100000
+SIMULATION_MAX_AREA = 1000000
+SIMULATION_MAX_ADJUSTMENTS = 50
+SIMULATION_PERCENTILES = (10, 50, 90)
+
+def default_price_maps():
+    return {
+        "material": {name.lower(): price for name, _, price, _ in DEFAULT_MATERIALS},
+        "labor": {name.lower(): price for name, _, _, price, _ in DEFAULT_LABOR},
+        "equipment": {name.lower(): price for name, _, _, price, _ in DEFAULT_EQUIPMENT},
+    }
+
+def cost_summary(items, costs):
+    # costs: matriz (cenários × itens) → totais por tipo e geral por cenário
+    by_type = {item_type: np.zeros(costs.shape[0]) for item_type in BUDGET_ITEM_TYPES}
+    for j, coef in enumerate(items):
+        by_type[coef["item_type"]] += costs[:, j]
+    return by_type, costs.sum(axis=1)
+
+def percentiles(values):
+    return {f"p{p}": v for p, v in zip(SIMULATION_PERCENTILES, np.percentile(values, SIMULATION_PERCENTILES).tolist())}
+
+def simulation_number(value, name, low, high=None):
+    """Parâmetro numérico da simulação; ValueError fora de [low, high] (ou NaN)."""
+    number = float(value)
+    if high is None and not low <= number:
+        raise ValueError(f"{name} deve ser no mínimo {low:g}")
+    if high is not None and not low <= number <= high:
+        raise ValueError(f"{name} deve estar entre {low:g} e {high:g}")
+    return number
+
+def run_simulation(coefficients, price_maps, params):
+    """Varredura de ajustes e Monte Carlo; ValueError/TypeError para parâmetros inválidos."""
+    project_type = params.get("project_type", "residencial")
+    finish_level = params.get("finish_level", "simples")
+    # Acima do limite só corta; zero ou negativo é erro
+    samples = simulation_number(params.get("samples", 10000), "samples", 1)
+    samples = int(min(samples, SIMULATION_MAX_SAMPLES))
+    uncertainty = params.get("price_uncertainty", 0.1)
+    if isinstance(uncertainty, dict):
+        uncertainty = {key: simulation_number(value, "price_uncertainty", 0, 1) for key, value in uncertainty.items()}
+    else:
+        uncertainty = simulation_number(uncertainty, "price_uncertainty", 0, 1)
+    rng = np.random.default_rng(params.get("seed"))
+
+    area_range = params.get("area_range")
+    if area_range:
+        if not isinstance(area_range, (list, tuple)) or len(area_range) != 2:
+            raise ValueError("area_range deve ser [mínima, máxima]")
+        low, high = (simulation_number(a, "area_range", 0, SIMULATION_MAX_AREA) for a in area_range)
+        if low > high:
+            raise ValueError("area_range deve ser [mínima, máxima]")
+    else:
+        low = high = simulation_number(params.get("area", 100), "area", 0, SIMULATION_MAX_AREA)
+
+    # Varredura determinística de ajustes de preço sobre a área central
+    adjustments = params.get("price_adjustments", (-15, 0, 20))
+    if not isinstance(adjustments, (list, tuple)) or not 0 < len(adjustments) <= SIMULATION_MAX_ADJUSTMENTS:
+        raise ValueError(f"price_adjustments deve ter de 1 a {SIMULATION_MAX_ADJUSTMENTS} valores")
+    adjustments = [simulation_number(a, "price_adjustments", -100, 1000) for a in adjustments]
+    items, quantities = calc_quantities_batch([(low + high) / 2], [finish_level], [project_type], coefficients)
+    prices = price_vector(items, price_maps)
+    factors = 1 + np.asarray(adjustments)[:, None] / 100
+    by_type, totals = cost_summary(items, quantities * prices * factors)
+    sweep = [
+        dict({item_type: float(by_type[item_type][i]) for item_type in BUDGET_ITEM_TYPES},
+             adjustment=adjustment, total=float(totals[i]))
+        for i, adjustment in enumerate(adjustments)
+    ]
+
+    # Monte Carlo: área uniforme no intervalo e preço de cada item numa
+    # distribuição triangular (1 - u, 1, 1 + u) em torno do preço atual
+    areas = rng.uniform(low, high, samples) if high > low else np.full(samples, low)
+    items, quantities = calc_quantities_batch(areas, [finish_level] * samples, [project_type] * samples, coefficients)
+    if isinstance(uncertainty, dict):
+        spread = np.asarray([float(uncertainty.get(coef["name"].lower(), 0.1)) for coef in items])
+    else:
+        spread = np.full(len(items), float(uncertainty))
+    spread = np.clip(spread, 0, 0.99)
+    draws = rng.triangular(-1, 0, 1, size=(samples, len(items))) * spread + 1
+    by_type, totals = cost_summary(items, quantities * prices * draws)
+
+    return {
+        "samples": samples,
+        "sweep": sweep,
+        "monte_carlo": {
+            "total": dict(percentiles(totals), mean=float(totals.mean()), std=float(totals.std())),
+            "by_type": {item_type: percentiles(values) for item_type, values in by_type.items()},
+        },
+    }
+
+@app.route("/api/simulator", methods=["POST"])
+@require_active_subscription
+def api_simulator():
+    user = current_user()
+    if not user:
+        return jsonify({"error": "login required"}), 401
+
+    params = request.get_json(silent=True)
+    if params is None:
+        params = {}
+    if not isinstance(params, dict):
+        return jsonify({"error": "parâmetros inválidos: o corpo deve ser um objeto JSON"}), 400
+    conn = get_db_conn()
+    coefficients = load_coefficients(conn, user["id"])
+    price_maps = default_price_maps()
+    for item_type, prices in load_price_maps(conn, user["id"]).items():
+        price_maps[item_type].update(prices)
+    conn.close()
+
+    try:
+        result = run_simulation(coefficients, price_maps, params)
+    except (TypeError, ValueError, IndexError) as e:
+        return jsonify({"error": f"parâmetros inválidos: {e}"}), 400
+    return jsonify(result)
+
+@app.route("/api/coefficients", methods=["GET", "POST"])
+@require_active_subscription
+def api_coefficients():
+    user = current_user()
+    if not user:
+        return jsonify({"error": "login required"}), 401
+
+    conn = get_db_conn()
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        item_type = data.get("item_type")
+        name = (data.get("name") or "").strip()
+        if item_type not in ("project_type", "finish_level", "schedule") + BUDGET_ITEM_TYPES or not name:
+            conn.close()
+            return jsonify({"error": "item_type/name inválidos"}), 400
+
+        if data.get("reset"):
+            with write_transaction(conn):
+                conn.execute("DELETE FROM budget_coefficients WHERE user_id=? AND item_type=? AND name=?",
+                             (user["id"], item_type, name))
+        else:
+            default = conn.execute(
+                "SELECT * FROM budget_coefficients WHERE user_id IS NULL AND item_type=? AND name=?",
+                (item_type, name)
+            ).fetchone()
+            coef = {field: default[field] for field in COEFFICIENT_FIELDS} if default else {
+                "unit": None, "basis": "area", "min_qty": None, "max_qty": None, "decimals": None
+            }
+            coef.update({k: data[k] for k in ("unit", "basis", "coefficient", "min_qty", "max_qty", "decimals") if k in data})
+            try:
+                coef["coefficient"] = float(coef["coefficient"])
+            except (KeyError, TypeError, ValueError):
+                conn.close()
+                return jsonify({"error": "coefficient inválido"}), 400
+            with write_transaction(conn):
+                conn.execute(
+                    """INSERT INTO budget_coefficients
+                    (user_id, item_type, name, unit, basis, coefficient, min_qty, max_qty, decimals, sort_order)
+                    VALUES (?,?,?,?,?,?,?,?,?,?)
+                    ON CONFLICT(user_id, item_type, name) DO UPDATE SET
+                    unit=excluded.unit, basis=excluded.basis, coefficient=excluded.coefficient,
+                    min_qty=excluded.min_qty, max_qty=excluded.max_qty, decimals=excluded.decimals""",
+                    (user["id"], item_type, name, coef["unit"], coef["basis"], coef["coefficient"],
+                     coef["min_qty"], coef["max_qty"], coef["decimals"], default["sort_order"] if default else 1000)
+                )
+
+    coefficients = load_coefficients(conn, user["id"])
+    conn.close()
+    return jsonify(coefficients)
+
+@app.route("/api/projects", defaults={"table": "projects"})
+@app.route("/api/materials", defaults={"table": "materials"})
+@app.route("/api/clients", defaults={"table": "clients"})
+@app.route("/api/suppliers", defaults={"table": "suppliers"})
+@app.route("/api/labor", defaults={"table": "labor"})
+@app.route("/api/equipment", defaults={"table": "equipment"})
+@require_active_subscription
+def api_list(table):
+    user = current_user()
+    if not user:
+        return jsonify({"error": "login required"}), 401
+
+    conn = get_db_conn()
+    page = fetch_list_page(conn, table, user["id"], request.args)
+    conn.close()
+    page["items"] = [dict(row) for row in page["items"]]
+    return jsonify(page)
+
+@app.route("/api/db/stats")
+def api_db_stats():
+    if not metrics_authorized():
+        return jsonify({"error": "login required"}), 401
+    return jsonify(db_pool.stats())
+
+SEARCH_LIMIT = 20
+
+def fold_accents(text):
+    return "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+
+def search_match(q, user_id):
+    """Filtro do índice de busca para o texto digitado: (condição, parâmetros) ou None."""
+    terms = re.findall(r"\w+", q.lower())
+    if not terms:
+        return None
+    if db_pool.dialect == "postgresql":
+        # Prefixo por palavra no tsvector, sem acentos como em search_fold()
+        query = " & ".join(f"{fold_accents(term)}:*" for term in terms)
+        return "owner IN (?, 'global') AND document @@ to_tsquery('simple', ?)", [f"u{user_id}", query]
+    # Cada palavra vira um prefixo entre aspas: nada do texto digitado é
+    # interpretado como sintaxe FTS5
+    phrases = " ".join(f'"{term}"*' for term in terms)
+    return "search_index MATCH ?", [f"owner : (u{user_id} OR global) AND {{name detail}} : ({phrases})"]
+
+def search_catalog(conn, user_id, q, kinds=None, limit=SEARCH_LIMIT):
+    match = search_match(q, user_id)
+    if not match:
+        return []
+    condition, params = match
+    sql = f"SELECT kind, ref_id AS id, name, detail FROM search_index WHERE {condition}"
+    if kinds:
+        sql += f" AND kind IN ({', '.join('?' * len(kinds))})"
+        params.extend(kinds)
+    # O índice também tem as linhas ocultas e os itens compartilhados que o
+    # usuário sobrescreveu; saem antes do LIMIT para não encurtar o resultado
+    hidden = " OR ".join(
+        f"""(kind='{table}' AND (EXISTS (SELECT 1 FROM {table} o WHERE o.id=ref_id AND o.hidden<>0)
+            OR EXISTS (SELECT 1 FROM {table} o WHERE o.user_id=? AND o.base_id=ref_id)))"""
+        for table in CATALOG_TABLES
+    )
+    sql += f" AND NOT ({hidden})"
+    params.extend([user_id] * len(CATALOG_TABLES))
+    # Todas as ocorrências são ordenadas por relevância antes do LIMIT
+    if conn.dialect == "postgresql":
+        # Normalização 1: documentos longos pesam menos, como no bm25
+        sql += " ORDER BY ts_rank(document, to_tsquery('simple', ?), 1) DESC"
+        params.append(params[1])
+    else:
+        sql += " ORDER BY rank"
+    return conn.execute(sql + " LIMIT ?", params + [limit]).fetchall()
+
+@app.route("/api/search")
+@require_active_subscription
+def api_search():
+    user = current_user()
+    if not user:
+        return jsonify({"error": "login required"}), 401
+
+    kinds = [kind for kind in request.args.get("kinds", "").split(",") if kind in SEARCH_SOURCES]
+    try:
+        limit = min(max(int(request.args.get("limit", SEARCH_LIMIT)), 1), 100)
+    except ValueError:
+        limit = SEARCH_LIMIT
+
+    conn = get_db_conn()
+    rows = search_catalog(conn, user["id"], request.args.get("q", ""), kinds, limit)
+    conn.close()
+    return jsonify([dict(r) for r in rows])
 
 @app.route("/api/materials/search")
+@require_active_subscription
 def api_material_search():
-    q = request.args.get("q", "").strip().lower()
+    q = request.args.get("q", "").strip()
     user = current_user()
     if not user:
         return jsonify([])
 
     conn = get_db_conn()
-    rows = conn.execute("SELECT id, name, unit, price FROM materials WHERE user_id=? AND LOWER(name) LIKE ? LIMIT 10",
-                        (user["id"], f"%{q}%")).fetchall()
+    hits = search_catalog(conn, user["id"], q, ["materials"], 10)
+    if hits:
+        ids = [hit["id"] for hit in hits]
+        found = {row["id"]: row for row in conn.execute(
+            f"SELECT id, name, unit, price FROM materials WHERE id IN ({','.join('?' * len(ids))})", ids
+        )}
+        rows = [found[item_id] for item_id in ids if item_id in found]
+    elif search_match(q, user["id"]):
+        rows = []
+    else:
+        rows = conn.execute(f"SELECT id, name, unit, price FROM {catalog_source('materials')} ORDER BY name LIMIT 10",
+                            (user["id"], user["id"])).fetchall()
     conn.close()
     results = [dict(r) for r in rows]
     return jsonify(results)
 
+@app.cli.command("rebuild-cost-summary")
+@click.option("--check", is_flag=True, help="Só relata as divergências, sem gravar nada.")
+def rebuild_cost_summary_command(check):
+    """Confere project_cost_summary contra budgets e reconstrói o resumo."""
+    conn = db_pool.acquire()
+    try:
+        if check:
+            # BEGIN explícito: no PostgreSQL a conexão fica em autocommit
+            conn.execute(conn.BEGIN_WRITE)
+            try:
+                drifted = rebuild_cost_summary(conn)
+            finally:
+                conn.rollback()
+        else:
+            with write_transaction(conn):
+                drifted = rebuild_cost_summary(conn)
+                if drifted:
+                    # Afeta projetos de vários usuários: invalida as páginas de todos
+                    bump_data_version(conn, None)
+    finally:
+        conn.close()
+
+    if not drifted:
+        click.echo("project_cost_summary consistente com budgets")
+        return
+    click.echo(f"{len(drifted)} projeto(s) divergente(s): {', '.join(map(str, sorted(drifted)))}")
+    if check:
+        raise SystemExit(1)
+    click.echo("Resumo reconstruído")
+
+@app.cli.command("import-catalog")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--email", help="Usuário dono do catálogo.")
+@click.option("--shared", is_flag=True, help="Importa no catálogo padrão compartilhado por todos os usuários.")
+@click.option("--table", type=click.Choice(sorted(IMPORT_TABLES)), default="materials", show_default=True)
+@click.option("--dry-run", is_flag=True, help="Só mostra o que mudaria.")
+def import_catalog_command(path, email, shared, table, dry_run):
+    """Importa uma tabela de preços (CSV ou exportação do SINAPI) para o catálogo do usuário ou o compartilhado."""
+    if bool(email) == shared:
+        raise click.UsageError("Informe --email ou --shared")
+    conn = db_pool.acquire()
+    try:
+        user_id = None
+        if email:
+            user = UserRepository(conn).get_by_email(email)
+            if not user:
+                raise click.ClickException(f"Usuário não encontrado: {email}")
+            user_id = user["id"]
+        started = time.perf_counter()
+        report = import_catalog(conn, user_id, table, read_price_table(path), dry_run,
+                                progress=lambda done: click.echo(f"\r{done} linhas", nl=False, err=True))
+    finally:
+        conn.close()
+
+    click.echo(err=True)
+    for change in report["changes"][:10]:
+        click.echo(f"  {change['action']:<7}{change['name'][:60]:<62}{change['old_price'] or '-'!s:>12} -> {change['new_price']}")
+    click.echo(f"{'Prévia' if dry_run else 'Importação'} de {report['rows']} linhas em {time.perf_counter() - started:.1f}s: "
+               f"{report['inserted']} novos, {report['updated']} alterados, {report['unchanged']} sem mudança, "
+               f"{report['invalid']} inválidas")
+
+@app.cli.command("expire-trials")
+def expire_trials_command():
+    """Marca de uma vez os testes grátis vencidos (rodar periodicamente, ex.: cron a cada hora)."""
+    conn = db_pool.acquire()
+    try:
+        expired = expire_trials(conn)
+    finally:
+        conn.close()
+    click.echo(f"{len(expired)} teste(s) vencido(s) marcado(s) como trial_expired")
+
+@app.cli.command("process-webhooks")
+def process_webhooks_command():
+    """Processa agora os webhooks pendentes do Mercado Pago (o worker do app faz isso sozinho)."""
+    conn = db_pool.acquire()
+    try:
+        processed = 0
+        while True:
+            claimed = process_webhook_events(conn)
+            if not claimed:
+                break
+            processed += claimed
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM webhook_events GROUP BY status").fetchall())
+    finally:
+        conn.close()
+    queue = ", ".join(f"{status}={count}" for status, count in sorted(counts.items()))
+    click.echo(f"{processed} evento(s) processado(s); fila: {queue or 'vazia'}")
+
+# Os processos "spawn" do pool de renderização reimportam este módulo; banco e
+# migrações ficam com o processo do app
+if multiprocessing.parent_process() is None:
+    init_db()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
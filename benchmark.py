@@ -0,0 +1,1249 @@
+"""
+CiviPro - Benchmarks de desempenho
+Executa o app contra um database.db temporário usando o test client do Flask.
+
+Uso:
+    python benchmark.py connections
+    python benchmark.py query_plans
+    python benchmark.py budgets
+    python benchmark.py quantities
+    python benchmark.py simulation
+    python benchmark.py export
+    python benchmark.py pdf --lines=5000 --max-seconds=10 --max-mb=100
+    python benchmark.py lists
+    python benchmark.py search
+    python benchmark.py as_of
+    python benchmark.py import
+    python benchmark.py signup
+    python benchmark.py webhooks
+    python benchmark.py subscriptions
+    python benchmark.py instrumentation
+    python benchmark.py routes --users=5 --projects=200 --lines=60 --catalog=2000 --rounds=50
+    python benchmark.py page_cache
+    python benchmark.py concurrency --workers=8 --requests=40   # processos escrevendo no mesmo banco
+    python benchmark.py reprice --projects=500                  # troca de preço propagada aos orçamentos
+    python benchmark.py backends --pg-url=postgresql://...      # mesmo roteiro no SQLite e no PostgreSQL
+    python benchmark.py postgres_sql                            # SQL dos repositórios no dialeto do PostgreSQL, sem servidor
+    python benchmark.py routes --save=rotas.json        # grava a linha de base
+    python benchmark.py routes --baseline=rotas.json    # falha se alguma rota piorou
+
+Opções --nome=valor (ou --nome=1,2,3) são repassadas aos benchmarks que aceitam o parâmetro.
+"""
+
+import inspect
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+_connections = {"count": 0}
+_sqlite_connect = sqlite3.connect
+
+def _counting_connect(*args, **kwargs):
+    _connections["count"] += 1
+    return _sqlite_connect(*args, **kwargs)
+
+def load_app():
+    # O app usa DB = "database.db" relativo ao diretório atual; rodar num
+    # diretório temporário garante que o banco do projeto não seja tocado
+    os.chdir(tempfile.mkdtemp(prefix="civipro_bench_"))
+    sys.path.insert(0, ROOT)
+    sqlite3.connect = _counting_connect
+    import app as civipro
+    civipro.app.config["TESTING"] = True
+    return civipro
+
+def logged_client(civipro, email="bench@civipro.local"):
+    client = civipro.app.test_client()
+    client.post("/register", data={"name": "Bench", "email": email, "password": "bench"})
+    client.post("/login", data={"email": email, "password": "bench"})
+    return client
+
+def bench_connections(civipro):
+    client = logged_client(civipro)
+    client.post("/projects/add", data={"name": "Obra Bench", "area": "120", "finish": "medio"})
+    client.post("/projects/1/generate_budget")
+
+    def acquired():
+        stats = civipro.db_pool.stats()
+        return stats["created"] + stats["reused"]
+
+    pages = ["/dashboard", "/projects", "/projects/1", "/materials", "/reports"]
+    print(f"{'rota':<16}{'cache':>8}{'sqlite3.connect':>18}{'acquire do pool':>18}")
+    for url in pages:
+        for label, ttl in (("frio", 0), ("quente", civipro.USER_CACHE_TTL or 30)):
+            civipro.USER_CACHE_TTL = ttl
+            client.get(url)
+            _connections["count"] = 0
+            before = acquired()
+            client.get(url)
+            print(f"{url:<16}{label:>8}{_connections['count']:>18}{acquired() - before:>18}")
+    print(civipro.db_pool.stats())
+
+# Consultas quentes das rotas; todas precisam usar índice (nenhum SCAN de tabela)
+HOT_QUERIES = [
+    ("projects_list", "SELECT * FROM projects WHERE user_id=? ORDER BY created_at DESC, id DESC LIMIT 51", (1,)),
+    ("projects_page", "SELECT * FROM projects WHERE user_id=? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 51", (1, "2024", 10)),
+    ("materials_list", "SELECT * FROM {materials} ORDER BY category, name, id LIMIT 51", (1, 1)),
+    ("materials_page", "SELECT * FROM {materials} WHERE (category, name, id) > (?, ?, ?) ORDER BY category, name, id LIMIT 51", (1, 1, "geral", "Cimento", 3)),
+    ("materials_by_name", "SELECT * FROM materials WHERE user_id=? AND category=? AND (name, id) > (?, ?) ORDER BY name, id LIMIT 51", (1, "geral", "Cimento", 3)),
+    ("clients_page", "SELECT * FROM clients WHERE user_id=? AND (name, id) > (?, ?) ORDER BY name, id LIMIT 51", (1, "Ana", 3)),
+    ("suppliers_page", "SELECT * FROM suppliers WHERE user_id=? AND (category, name, id) > (?, ?, ?) ORDER BY category, name, id LIMIT 51", (1, "geral", "A", 3)),
+    ("labor_page", "SELECT * FROM {labor} WHERE (category, name, id) > (?, ?, ?) ORDER BY category, name, id LIMIT 51", (1, 1, "geral", "A", 3)),
+    ("equipment_page", "SELECT * FROM {equipment} WHERE (category, name, id) > (?, ?, ?) ORDER BY category, name, id LIMIT 51", (1, 1, "geral", "A", 3)),
+    ("catalog_prices", "SELECT name, price FROM {materials}", (1, 1)),
+    ("catalog_override", "SELECT id FROM materials WHERE user_id=? AND base_id=?", (1, 3)),
+    ("project_budget", "SELECT material, quantity, unit, cost FROM budgets WHERE project_id=?", (1,)),
+    ("budget_by_type", "SELECT material, quantity, unit, cost FROM budgets WHERE project_id=? AND item_type='labor'", (1,)),
+    ("budget_delete", "DELETE FROM budgets WHERE project_id=?", (1,)),
+    ("material_by_name", "SELECT * FROM materials WHERE user_id=? AND name=?", (1, "Cimento")),
+    ("cost_summary", "SELECT SUM(estimated_total) FROM project_cost_summary WHERE user_id=?", (1,)),
+    ("price_as_of", "SELECT item_type, name, price, MAX(effective_at) FROM price_history "
+                    "WHERE user_id=? AND effective_at<=? GROUP BY item_type, item_id", (1, "2025-01-01")),
+    ("shared_price_as_of", "SELECT item_type, name, price, MAX(effective_at) FROM price_history "
+                           "WHERE user_id IS NULL AND effective_at<=? GROUP BY item_type, item_id", ("2025-01-01",)),
+    ("budget_export", "SELECT p.id, b.material FROM projects p JOIN budgets b ON b.project_id = p.id "
+                      "WHERE p.user_id=? ORDER BY p.created_at, p.id, b.item_type, b.id", (1,)),
+]
+
+def bench_query_plans(civipro):
+    conn = civipro.get_db_conn()
+    # {materials}, {labor} e {equipment} viram a consulta do catálogo resolvido
+    sources = {table: civipro.catalog_source(table) for table in civipro.CATALOG_TABLES}
+    failures = []
+    for label, sql, params in HOT_QUERIES:
+        plan = [row["detail"] for row in conn.execute("EXPLAIN QUERY PLAN " + sql.format(**sources), params)]
+        scans = [d for d in plan if (d.startswith("SCAN") and "INDEX" not in d) or "TEMP B-TREE" in d]
+        print(f"{'FALHA' if scans else 'ok':<7}{label:<20}{' | '.join(plan)}")
+        if scans:
+            failures.append(label)
+    conn.close()
+    if failures:
+        sys.exit(f"consultas sem índice: {', '.join(failures)}")
+
+def seed_projects(civipro, user_id, count):
+    conn = civipro.get_db_conn()
+    finishes = ("simples", "medio", "alto")
+    types = ("residencial", "comercial", "industrial")
+    with conn:
+        conn.executemany(
+            "INSERT INTO projects (user_id, name, area, project_type, finish_level, status, created_at) VALUES (?,?,?,?,?,?,?)",
+            [(user_id, f"Obra {i}", 40 + i % 400, types[i % 3], finishes[i % 3], "em_andamento",
+              datetime.utcnow().isoformat()) for i in range(count)]
+        )
+    projects = conn.execute("SELECT * FROM projects WHERE user_id=?", (user_id,)).fetchall()
+    conn.close()
+    return projects
+
+def legacy_generate_budget(civipro, conn, user_id, proj):
+    # Caminho antigo: um INSERT e um utcnow() por linha de orçamento
+    price_maps = civipro.load_price_maps(conn, user_id)
+    project_type = proj["project_type"] or "residencial"
+    groups = civipro.calc_quantities(proj["area"], proj["finish_level"], project_type)
+    c = conn.cursor()
+    c.execute("DELETE FROM budgets WHERE project_id=?", (proj["id"],))
+    total_cost = 0
+    for item_type, items in zip(("material", "labor", "equipment"), groups):
+        for name, qty, unit in items:
+            price = price_maps[item_type].get(name.lower(), 0) * qty
+            total_cost += price
+            c.execute("INSERT INTO budgets (project_id, item_type, material, quantity, unit, cost, created_at) VALUES (?,?,?,?,?,?,?)",
+                      (proj["id"], item_type, name, qty, unit, price, datetime.utcnow().isoformat()))
+    c.execute("UPDATE projects SET real_cost=? WHERE id=?", (total_cost, proj["id"]))
+    conn.commit()
+
+def bench_budgets(civipro, count=1000):
+    logged_client(civipro, "budgets@civipro.local")
+    conn = civipro.get_db_conn()
+    user_id = conn.execute("SELECT id FROM users WHERE email=?", ("budgets@civipro.local",)).fetchone()["id"]
+    projects = seed_projects(civipro, user_id, count)
+
+    start = time.perf_counter()
+    for proj in projects:
+        legacy_generate_budget(civipro, conn, user_id, proj)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for proj in projects:
+        civipro.regenerate_budgets(conn, user_id, [proj])
+    per_project = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lines = civipro.regenerate_budgets(conn, user_id, projects)
+    bulk = time.perf_counter() - start
+    conn.close()
+
+    print(f"{count} projetos, {lines} linhas de orçamento")
+    print(f"{'INSERT por linha (antigo)':<36}{legacy * 1000:>10.1f} ms")
+    print(f"{'executemany por projeto':<36}{per_project * 1000:>10.1f} ms")
+    print(f"{'executemany em lote (1 transação)':<36}{bulk * 1000:>10.1f} ms")
+
+def legacy_calc_quantities(area, finish_level, project_type):
+    # Fórmula por projeto anterior à tabela de coeficientes, mantida como referência
+    multiplier = {"comercial": 1.2, "industrial": 1.5}.get(project_type, 1.0)
+    total_mult = multiplier * {"simples": 1.0, "medio": 1.3, "alto": 1.6}.get(finish_level, 1.0)
+    dias_obra = max(15, int(area * 0.3 * total_mult))
+    return {
+        "Cimento": round(area * 5.0 * total_mult),
+        "Areia": round(area * 0.05 * total_mult, 3),
+        "Brita": round(area * 0.04 * total_mult, 3),
+        "Tijolos": int(area * 15 * total_mult),
+        "Ferro 10mm": round(area * 8.0 * total_mult, 2),
+        "Argamassa": round(area * 0.03 * total_mult),
+        "Cerâmica": round(area * 0.8 * total_mult, 2),
+        "Tinta": round(area * 0.25 * total_mult, 2),
+        "Pedreiro": dias_obra * 1.5,
+        "Servente": dias_obra * 2.0,
+        "Eletricista": max(5, int(dias_obra * 0.2)),
+        "Encanador": max(5, int(dias_obra * 0.2)),
+        "Pintor": max(3, int(dias_obra * 0.15)),
+        "Betoneira": min(dias_obra, 30),
+        "Andaime": min(dias_obra, 20),
+        "Serra circular": max(5, int(dias_obra * 0.1)),
+    }
+
+def check_quantities_parity(civipro, areas, finish_levels, project_types):
+    items, quantities = civipro.calc_quantities_batch(areas, finish_levels, project_types)
+    mismatches = []
+    for i, (area, finish, ptype) in enumerate(zip(areas, finish_levels, project_types)):
+        expected = legacy_calc_quantities(area, finish, ptype)
+        for j, coef in enumerate(items):
+            if quantities[i, j] != expected[coef["name"]]:
+                mismatches.append((area, finish, ptype, coef["name"], expected[coef["name"]], quantities[i, j]))
+    return mismatches
+
+def bench_quantities(civipro, count=10000):
+    finishes = ("simples", "medio", "alto")
+    types = ("residencial", "comercial", "industrial")
+    areas = [40 + i % 400 for i in range(count)]
+    finish_levels = [finishes[i % 3] for i in range(count)]
+    project_types = [types[i % 3] for i in range(count)]
+
+    # Áreas com centavos exercitam os empates de arredondamento
+    parity_areas = [round(10 + (i * 7919) % 200000 / 100, 2) for i in range(count)]
+    parity_types = [types[i // 3 % 3] for i in range(count)]
+    mismatches = check_quantities_parity(civipro, parity_areas, finish_levels, parity_types)
+    if mismatches:
+        for mismatch in mismatches[:10]:
+            print("divergência: área=%s %s/%s %s esperado=%s obtido=%s" % mismatch)
+        sys.exit(f"{len(mismatches)} quantidades diferem da fórmula original")
+
+    start = time.perf_counter()
+    for area, finish, ptype in zip(areas, finish_levels, project_types):
+        civipro.calc_quantities(area, finish, ptype)
+    loop = time.perf_counter() - start
+
+    start = time.perf_counter()
+    civipro.calc_quantities_batch(areas, finish_levels, project_types)
+    batch = time.perf_counter() - start
+
+    print(f"{count} projetos, quantidades idênticas à fórmula original")
+    print(f"{'calc_quantities por projeto':<32}{loop * 1000:>10.1f} ms")
+    print(f"{'calc_quantities_batch':<32}{batch * 1000:>10.1f} ms")
+
+def bench_simulation(civipro, samples=10000, rounds=20):
+    price_maps = civipro.default_price_maps()
+    params = {"area_range": [80, 120], "project_type": "comercial", "finish_level": "medio", "samples": samples}
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        civipro.run_simulation(civipro.DEFAULT_COEFFICIENT_TABLE, price_maps, params)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f"{samples} amostras Monte Carlo, {rounds} rodadas")
+    print(f"{'p50':<8}{timings[len(timings) // 2] * 1000:>10.1f} ms")
+    print(f"{'máx':<8}{timings[-1] * 1000:>10.1f} ms")
+
+def bench_export(civipro, count=3000):
+    logged_client(civipro, "export@civipro.local")
+    conn = civipro.get_db_conn()
+    user_id = conn.execute("SELECT id FROM users WHERE email=?", ("export@civipro.local",)).fetchone()["id"]
+    lines = civipro.regenerate_budgets(conn, user_id, seed_projects(civipro, user_id, count))
+    conn.close()
+
+    print(f"{lines} linhas de orçamento")
+    print(f"{'formato':<8}{'1º bloco':>12}{'total':>12}{'bytes':>12}{'pico memória':>16}")
+    for fmt, (stream, _) in civipro.EXPORT_FORMATS.items():
+        tracemalloc.start()
+        start = time.perf_counter()
+        chunks = stream(civipro.iter_budget_export_rows(user_id))
+        size = len(next(chunks))
+        first = time.perf_counter() - start
+        for chunk in chunks:
+            size += len(chunk)
+        total = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{fmt:<8}{first * 1000:>9.1f} ms{total * 1000:>9.1f} ms{size:>12}{peak / 1024:>13.0f} KB")
+
+def synthetic_budget_rows(count, seed=7):
+    rng = random.Random(seed)
+    item_types = ("material", "material", "material", "labor", "equipment")
+    rows = []
+    for i in range(count):
+        name = f"{SEARCH_WORDS[i % 10]} {SEARCH_VARIANTS[rng.randrange(12)]} {i}"
+        if i % 40 == 0:
+            name += " - fornecimento e instalação conforme memorial descritivo do projeto executivo"
+        quantity = round(rng.uniform(1, 500), 2)
+        rows.append({"item_type": item_types[i % 5], "material": name, "quantity": quantity, "unit": "un",
+                     "cost": round(quantity * rng.uniform(1, 300), 2)})
+    return rows
+
+def bench_pdf(civipro, lines=5000, max_seconds=10, max_mb=100):
+    proj = {"id": 1, "name": "Obra Bench", "client": "Cliente", "area": 1200, "project_type": "comercial",
+            "finish_level": "alto", "status": "em_andamento", "deadline": "2026-12-31",
+            "notes": "\n".join(f"Observação {i}" for i in range(40)), "real_cost": 1.0}
+    rows = synthetic_budget_rows(lines)
+    # Uma descrição mais alta que a página inteira tem de ser quebrada, não recusada
+    tall = rows[:20] + [dict(rows[20], material=" ".join(f"descrição {i}" for i in range(4000)))] + rows[21:40]
+    cases = [
+        ("1 projeto", lambda: civipro.render_budget_pdf(proj, rows)),
+        ("linha mais alta que A4", lambda: civipro.render_budget_pdf(proj, tall)),
+        ("caderno 1 projeto", lambda: civipro.render_budget_book([(proj, rows)])),
+        ("caderno 50 projetos", lambda: civipro.render_budget_book(
+            [(dict(proj, id=i, name=f"Obra {i}"), rows[i::50]) for i in range(50)])),
+    ]
+    print(f"{lines} linhas de orçamento")
+    print(f"{'documento':<22}{'tempo':>10}{'páginas':>10}{'bytes':>10}{'pico memória':>16}")
+    failures = []
+    for label, render in cases:
+        start = time.perf_counter()
+        pdf = render()
+        elapsed = time.perf_counter() - start
+        # Memória numa segunda execução: o tracemalloc deixa a renderização ~10x mais lenta
+        tracemalloc.start()
+        render()
+        peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+        pages = pdf.count(b"/Type /Page\n")
+        print(f"{label:<22}{elapsed:>8.2f} s{pages:>10}{len(pdf):>10}{peak:>13.1f} MB")
+        if elapsed > max_seconds or peak > max_mb:
+            failures.append(label)
+    if failures:
+        sys.exit(f"acima do limite ({max_seconds} s, {max_mb} MB): {', '.join(failures)}")
+
+def bench_lists(civipro, sizes=(1000, 10000, 50000), rounds=20):
+    civipro.page_cache.max_bytes = 0
+    client = logged_client(civipro, "lists@civipro.local")
+    conn = civipro.get_db_conn()
+    user_id = conn.execute("SELECT id FROM users WHERE email=?", ("lists@civipro.local",)).fetchone()["id"]
+    categories = ("geral", "estrutura", "alvenaria", "acabamento")
+    print(f"{'materiais':>10}{'1ª página':>14}{'página final':>16}{'bytes/página':>14}")
+    total = conn.execute("SELECT COUNT(*) FROM materials WHERE user_id=?", (user_id,)).fetchone()[0]
+    for size in sizes:
+        with conn:
+            conn.executemany(
+                "INSERT INTO materials (user_id, name, unit, price, category, updated_at) VALUES (?,?,?,?,?,?)",
+                [(user_id, f"Material {i:06d}", "un", 1.0, categories[i % 4], "") for i in range(total, size)]
+            )
+        total = size
+        last = conn.execute("SELECT category, name, id FROM materials WHERE user_id=? ORDER BY category DESC, name DESC, id DESC LIMIT 1 OFFSET 10",
+                            (user_id,)).fetchone()
+        cursor = civipro.encode_cursor(list(last))
+        timings = {}
+        for label, query in (("first", ""), ("last", f"&cursor={cursor}")):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                client.get(f"/materials?limit=50{query}")
+            timings[label] = (time.perf_counter() - start) / rounds
+        print(f"{size:>10}{timings['first'] * 1000:>11.1f} ms{timings['last'] * 1000:>13.1f} ms{len(client.get('/materials?limit=50').data):>14}")
+    conn.close()
+
+SEARCH_WORDS = ("Cerâmica", "Cimento", "Argamassa", "Porcelanato", "Tubo", "Conexão", "Vergalhão", "Tijolo", "Telha", "Tinta")
+SEARCH_VARIANTS = ("PVC", "CP-II", "esmaltada", "acetinada", "cerâmico", "maciço", "colonial", "soldável", "CA-50", "AC-III", "60x60", "25mm")
+
+def bench_search(civipro, size=100000, rounds=50):
+    client = logged_client(civipro, "search@civipro.local")
+    conn = civipro.get_db_conn()
+    user_id = conn.execute("SELECT id FROM users WHERE email=?", ("search@civipro.local",)).fetchone()["id"]
+    # Metade das linhas é de outro usuário, para o filtro por dono ter trabalho
+    with conn:
+        conn.executemany(
+            "INSERT INTO materials (user_id, name, unit, price, category, updated_at) VALUES (?,?,?,?,?,?)",
+            [(user_id if i % 2 else user_id + 1000, f"{SEARCH_WORDS[i // 2 % 10]} {SEARCH_VARIANTS[i // 20 % 12]} {i % 997}", "un", 1.0, "geral", "")
+             for i in range(size)]
+        )
+
+    queries = ("ceramica", "cer", "ci", "conexao 12", "vergalhão ca-50", "tinta acetin")
+    print(f"{size} materiais")
+    print(f"{'busca':<22}{'FTS5':>10}{'LIKE':>10}{'resultados':>12}")
+    for q in queries:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            results = client.get("/api/materials/search", query_string={"q": q}).get_json()
+        fts = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            conn.execute("SELECT id, name, unit, price FROM materials WHERE user_id=? AND LOWER(name) LIKE ? LIMIT 10",
+                         (user_id, f"%{q}%")).fetchall()
+        like = (time.perf_counter() - start) / rounds
+        print(f"{q:<22}{fts * 1000:>7.1f} ms{like * 1000:>7.1f} ms{len(results):>12}")
+    conn.close()
+
+def bench_as_of(civipro, count=500, edits=200, rounds=20):
+    client = logged_client(civipro, "asof@civipro.local")
+    conn = civipro.get_db_conn()
+    user_id = conn.execute("SELECT id FROM users WHERE email=?", ("asof@civipro.local",)).fetchone()["id"]
+    seed_projects(civipro, user_id, count)
+    # Cada item do catálogo compartilhado recebe `edits` reajustes, um por dia
+    catalog = [(table, row["id"], row["price"]) for _, table in civipro.PRICE_TABLES
+               for row in conn.execute(f"SELECT id, price FROM {table} WHERE user_id IS NULL")]
+    with conn:
+        for day in range(edits):
+            updated_at = (datetime(2020, 1, 1) + timedelta(days=day)).isoformat()
+            for table, item_id, price in catalog:
+                conn.execute(f"UPDATE {table} SET price=?, updated_at=? WHERE id=?",
+                             (price * (1 + 0.001 * day), updated_at, item_id))
+    history = conn.execute("SELECT COUNT(*) FROM price_history").fetchone()[0]
+    conn.close()
+
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        data = client.get("/api/budgets/as_of?date=2020-03-01").get_json()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f"{count} projetos, {history} linhas em price_history")
+    print(f"{'as_of (todos os projetos)':<28}{timings[len(timings) // 2] * 1000:>10.1f} ms")
+    print(f"{'variação média':<28}{sum(p['variation_percent'] or 0 for p in data['projects']) / count:>10.1f} %")
+
+    # Item próprio com o nome de um compartilhado: o preço do usuário é o que vale
+    client.post("/materials/add", data={"name": "cimento", "unit": "sacos", "price": "100", "category": "geral"})
+    conn = civipro.get_db_conn()
+    prices = {
+        "atual": civipro.load_price_map(conn, user_id, "materials").get("cimento"),
+        "na data": civipro.load_price_maps_as_of(conn, user_id, datetime.utcnow().isoformat())["material"].get("cimento"),
+    }
+    conn.close()
+    wrong = {label: price for label, price in prices.items() if price != 100}
+    if wrong:
+        sys.exit(f"preço compartilhado venceu o item do usuário: {wrong}")
+    print(f"{'item próprio prevalece':<28}{'ok':>10}")
+
+def write_sinapi_csv(path, count, increase=0.0):
+    # Mesmo formato das exportações do SINAPI: título, ";" e vírgula decimal em latin-1
+    with open(path, "w", encoding="latin-1", newline="") as f:
+        f.write("SINAPI - PREÇOS DE INSUMOS\nMÊS DE COLETA: 09/2025\n\n")
+        f.write("CODIGO;DESCRICAO DO INSUMO;UNIDADE;ORIGEM DE PRECO;PRECO MEDIANO R$\n")
+        for i in range(count):
+            price = f"{(1 + i % 5000 / 7) * (1 + increase):.2f}".replace(".", ",")
+            f.write(f"{10000 + i};INSUMO {i:06d} AÇO/CERÂMICA;{('UN', 'KG', 'M2', 'M3')[i % 4]};C;{price}\n")
+
+def bench_import(civipro, count=200000):
+    logged_client(civipro, "import@civipro.local")
+    conn = civipro.get_db_conn()
+    user_id = conn.execute("SELECT id FROM users WHERE email=?", ("import@civipro.local",)).fetchone()["id"]
+    path = os.path.join(os.getcwd(), "sinapi.csv")
+    print(f"{count} linhas")
+    for label, increase, dry_run in (("importação inicial", 0, False), ("prévia com reajuste de 5%", 0.05, True),
+                                     ("reajuste de 5%", 0.05, False), ("reimportação sem mudança", 0.05, False)):
+        write_sinapi_csv(path, count, increase)
+        start = time.perf_counter()
+        report = civipro.import_catalog(conn, user_id, "materials", civipro.read_price_table(path), dry_run)
+        elapsed = time.perf_counter() - start
+        print(f"{label:<28}{elapsed:>8.2f} s   +{report['inserted']} ~{report['updated']} ={report['unchanged']}")
+    conn.close()
+
+def bench_signup(civipro, count=200):
+    conn = civipro.get_db_conn()
+    catalog_rows = lambda: sum(conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in civipro.CATALOG_TABLES)
+    before = catalog_rows()
+    client = civipro.app.test_client()
+    start = time.perf_counter()
+    for i in range(count):
+        client.post("/register", data={"name": "Bench", "email": f"signup{i}@civipro.local", "password": "bench"})
+    elapsed = time.perf_counter() - start
+    print(f"{count} cadastros: {elapsed / count * 1000:.1f} ms cada, {catalog_rows() - before} linhas novas no catálogo")
+
+    # Reajuste no catálogo compartilhado: uma escrita vale para todos os usuários
+    users = [row["id"] for row in conn.execute("SELECT id FROM users")]
+    start = time.perf_counter()
+    with conn:
+        changed = conn.execute("UPDATE materials SET price=price * 1.05 WHERE user_id IS NULL AND name='Cimento'").rowcount
+    elapsed = time.perf_counter() - start
+    prices = {civipro.load_price_maps(conn, user_id)["material"]["cimento"] for user_id in users}
+    print(f"reajuste do cimento: {changed} linha em {elapsed * 1000:.2f} ms, {len(users)} usuários veem {sorted(prices)}")
+    conn.close()
+
+class PreapprovalStub(BaseHTTPRequestHandler):
+    # Stub local da API do Mercado Pago: GET /preapproval/user_<id> demora
+    # `delay` segundos e falha com 503 nas primeiras `failures` chamadas
+    delay = 0.3
+    failures = 0
+    calls = []
+
+    def do_GET(self):
+        PreapprovalStub.calls.append(self.path)
+        time.sleep(self.delay)
+        if len(self.calls) <= self.failures:
+            status, body = 503, {"message": "unavailable"}
+        else:
+            preapproval_id = self.path.rsplit("/", 1)[-1]
+            status, body = 200, {"id": preapproval_id, "status": "authorized", "external_reference": preapproval_id}
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def bench_webhooks(civipro, users=50, repeats=4, failures=5):
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), PreapprovalStub)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    os.environ["MERCADOPAGO_API_URL"] = f"http://127.0.0.1:{stub.server_port}"
+    os.environ["MERCADOPAGO_ACCESS_TOKEN"] = "TEST-bench"
+    PreapprovalStub.failures = failures
+    civipro.WEBHOOK_RETRY_BASE = 0.1
+
+    conn = civipro.get_db_conn()
+    with conn:
+        conn.executemany("INSERT INTO users (name, email, password_hash) VALUES (?,?,?)",
+                         [("Bench", f"webhook{i}@civipro.local", "-") for i in range(users)])
+    ids = [row["id"] for row in conn.execute("SELECT id FROM users WHERE email LIKE 'webhook%'")]
+
+    # Cada assinatura notifica `repeats` vezes, como o Mercado Pago faz
+    client = civipro.app.test_client()
+    timings = []
+    for _ in range(repeats):
+        for user_id in ids:
+            start = time.perf_counter()
+            client.post("/mercadopago-webhook", json={"type": "subscription_preapproval", "data": {"id": f"user_{user_id}"}})
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    start = time.perf_counter()
+    while conn.execute("SELECT COUNT(*) FROM webhook_events WHERE status='pending'").fetchone()[0]:
+        time.sleep(0.05)
+        civipro.wake_webhook_worker()
+    drained = time.perf_counter() - start
+    active = conn.execute(f"SELECT COUNT(*) FROM users WHERE subscription_status='active' AND id IN ({','.join(map(str, ids))})").fetchone()[0]
+    conn.close()
+    stub.shutdown()
+
+    print(f"{users * repeats} notificações de {users} assinaturas, API com {PreapprovalStub.delay * 1000:.0f} ms e {failures} falhas")
+    print(f"{'latência do webhook (p50)':<30}{timings[len(timings) // 2] * 1000:>8.1f} ms")
+    print(f"{'latência do webhook (p99)':<30}{timings[int(len(timings) * 0.99)] * 1000:>8.1f} ms")
+    print(f"{'fila processada em':<30}{drained:>8.1f} s")
+    print(f"{'chamadas à API':<30}{len(PreapprovalStub.calls):>8}")
+    print(f"{'assinaturas ativadas':<30}{active:>8}")
+
+def bench_subscriptions(civipro, users=100000, rounds=100000):
+    conn = civipro.get_db_conn()
+    now = int(time.time())
+    # Um terço dos testes já venceu
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (name, email, password_hash, subscription_status, trial_end_date, subscription_expires_at) VALUES (?,?,?,?,?,?)",
+            [("Bench", f"sub{i}@civipro.local", "-", "trial" if i % 4 else "active",
+              datetime.utcfromtimestamp(now + (i % 3 - 1) * 86400 * 3).isoformat(), now + (i % 3 - 1) * 86400 * 3)
+             for i in range(users)]
+        )
+    user = conn.execute("SELECT * FROM users WHERE subscription_status='trial' AND subscription_expires_at > ? LIMIT 1", (now,)).fetchone()
+
+    def legacy_check(user):
+        # Caminho antigo: converte trial_end_date a cada chamada
+        trial_end = datetime.fromisoformat(user["trial_end_date"])
+        now = datetime.utcnow()
+        if now < trial_end:
+            return {"active": True, "status": "trial", "days_left": (trial_end - now).days + 1, "is_trial": True}
+        return {"active": False, "status": "trial_expired", "days_left": 0, "is_trial": False}
+
+    for label, check in (("fromisoformat (antigo)", legacy_check), ("epoch em cache", civipro.check_subscription_status)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            check(user)
+        print(f"{label:<26}{(time.perf_counter() - start) / rounds * 1e6:>8.2f} µs por verificação")
+
+    # Por requisição: o context processor e o decorator leem o mesmo resultado de flask.g
+    client = logged_client(civipro, "subscriptions@civipro.local")
+    calls = {"count": 0}
+    original = civipro.check_subscription_status
+    def counting_check(user):
+        calls["count"] += 1
+        return original(user)
+    civipro.check_subscription_status = counting_check
+    client.get("/projects")
+    civipro.check_subscription_status = original
+    print(f"verificações por requisição (/projects): {calls['count']}")
+
+    start = time.perf_counter()
+    expired = civipro.expire_trials(conn)
+    print(f"varredura: {len(expired)} de {users} testes vencidos em {(time.perf_counter() - start) * 1000:.1f} ms")
+    conn.close()
+
+def bench_instrumentation(civipro, rounds=100000):
+    # Custo do TracedCursor por comando, dentro de uma requisição
+    raw = _sqlite_connect(":memory:")
+    with civipro.app.test_request_context("/"):
+        civipro.start_request_metrics()
+        conn = civipro.get_db_conn()
+        for label, execute in (("sqlite3 puro", raw.execute), ("conexão do pool", conn.execute)):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                execute("SELECT 1")
+            print(f"{label:<18}{(time.perf_counter() - start) / rounds * 1e6:>8.2f} µs por comando")
+        print(f"comandos contados na requisição: {civipro.g._sql_stats[0]}")
+
+    client = logged_client(civipro, "metrics@civipro.local")
+    client.post("/projects/add", data={"name": "Obra Bench", "area": "120", "finish": "medio"})
+    client.post("/projects/1/generate_budget")
+    for url in ("/dashboard", "/projects", "/projects/1", "/materials", "/reports"):
+        client.get(url)
+    lines = client.get("/metrics").get_data(as_text=True).splitlines()
+    print("\n".join(line for line in lines if line.startswith("civipro_sql_queries_total")))
+
+TENANT_CATEGORIES = ("geral", "estrutura", "alvenaria", "acabamento", "hidraulica", "eletrica")
+TENANT_STATUSES = ("em_andamento", "em_andamento", "concluido", "pausado")
+
+def generate_tenants(civipro, users=5, projects=200, lines=60, catalog=2000, clients=50, seed=42):
+    """Popula o banco com inquilinos sintéticos; devolve [(user_id, email, project_ids)]."""
+    rng = random.Random(seed)
+    base = datetime(2025, 1, 1)
+    password_hash = civipro.generate_password_hash("bench")
+    expires_at = int(time.time()) + 30 * 86400
+    conn = civipro.get_db_conn()
+    shared = {
+        item_type: [(row["id"], row["name"], row["unit"], row["price"])
+                    for row in conn.execute(f"SELECT id, name, unit, price FROM {table} WHERE user_id IS NULL")]
+        for item_type, table in zip(civipro.BUDGET_ITEM_TYPES, civipro.CATALOG_TABLES)
+    }
+
+    tenants = []
+    for n in range(users):
+        email = f"tenant{n}@civipro.local"
+        created_at = (base - timedelta(days=rng.randint(0, 365))).isoformat()
+        with conn:
+            user_id = conn.execute(
+                """INSERT INTO users (name, email, password_hash, created_at, trial_start_date, trial_end_date,
+                subscription_status, subscription_expires_at) VALUES (?,?,?,?,?,?,?,?)""",
+                (f"Construtora {n}", email, password_hash, created_at, created_at,
+                 datetime.utcfromtimestamp(expires_at).isoformat(), "trial", expires_at)
+            ).lastrowid
+
+            # Catálogo próprio, alguns preços padrão sobrescritos e um item padrão oculto
+            own = [(user_id, f"{SEARCH_WORDS[i % 10]} {SEARCH_VARIANTS[rng.randrange(12)]} {i}", "un",
+                    round(rng.uniform(1, 500), 2), TENANT_CATEGORIES[i % 6], base.isoformat()) for i in range(catalog)]
+            conn.executemany("INSERT INTO materials (user_id, name, unit, price, category, updated_at) VALUES (?,?,?,?,?,?)", own)
+            overrides = rng.sample(shared["material"], min(5, len(shared["material"])))
+            conn.executemany(
+                "INSERT INTO materials (user_id, base_id, name, unit, price, category, updated_at) VALUES (?,?,?,?,?,?,?)",
+                [(user_id, item_id, name, unit, round(price * rng.uniform(0.9, 1.3), 2), "geral", base.isoformat())
+                 for item_id, name, unit, price in overrides[:-1]]
+            )
+            item_id, name, unit, price = overrides[-1]
+            conn.execute("INSERT INTO materials (user_id, base_id, name, unit, price, hidden) VALUES (?,?,?,?,?,1)",
+                         (user_id, item_id, name, unit, price))
+
+            conn.executemany(
+                "INSERT INTO clients (user_id, name, email, phone, created_at) VALUES (?,?,?,?,?)",
+                [(user_id, f"Cliente {i:04d}", f"cliente{i}@exemplo.com", f"(31) 9{i:04d}-0000", created_at) for i in range(clients)]
+            )
+            client_ids = [row[0] for row in conn.execute("SELECT id FROM clients WHERE user_id=?", (user_id,))]
+            conn.executemany(
+                """INSERT INTO projects (user_id, client_id, name, area, project_type, finish_level, status, created_at)
+                VALUES (?,?,?,?,?,?,?,?)""",
+                [(user_id, rng.choice(client_ids) if client_ids else None, f"Obra {i:05d}", rng.randint(40, 800),
+                  rng.choice(("residencial", "comercial", "industrial")), rng.choice(("simples", "medio", "alto")),
+                  rng.choice(TENANT_STATUSES), (base + timedelta(minutes=rng.randint(0, 525600))).isoformat())
+                 for i in range(projects)]
+            )
+            project_ids = [row[0] for row in conn.execute("SELECT id FROM projects WHERE user_id=?", (user_id,))]
+
+            choices = dict(shared, material=shared["material"] + [(None, name, unit, price) for _, name, unit, price, _, _ in own[:200]])
+            budget_rows = []
+            for project_id in project_ids:
+                for i in range(lines):
+                    item_type = civipro.BUDGET_ITEM_TYPES[0 if i % 5 < 3 else i % 5 - 2]
+                    _, name, unit, price = rng.choice(choices[item_type])
+                    quantity = round(rng.uniform(1, 200), 2)
+                    budget_rows.append((project_id, user_id, item_type, name, name.lower(), quantity, unit,
+                                        round(quantity * (price or 0), 2), base.isoformat()))
+            conn.executemany(
+                """INSERT INTO budgets (project_id, user_id, item_type, material, item_key, quantity, unit, cost, created_at)
+                VALUES (?,?,?,?,?,?,?,?,?)""",
+                budget_rows
+            )
+            civipro.rebuild_cost_summary(conn, project_ids)
+            conn.execute("""UPDATE projects SET real_cost=(SELECT estimated_total FROM project_cost_summary s
+                            WHERE s.project_id=projects.id) WHERE user_id=?""", (user_id,))
+        tenants.append((user_id, email, project_ids))
+    conn.close()
+    return tenants
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+# Rotas medidas: (rótulo, método, função que monta a URL a partir do projeto sorteado)
+ROUTES = (
+    ("dashboard", "GET", lambda pid, q: "/dashboard"),
+    ("reports", "GET", lambda pid, q: "/reports"),
+    ("projects_list", "GET", lambda pid, q: "/projects"),
+    ("project_view", "GET", lambda pid, q: f"/projects/{pid}"),
+    ("materials_list", "GET", lambda pid, q: "/materials"),
+    ("labor_list", "GET", lambda pid, q: "/labor"),
+    ("equipment_list", "GET", lambda pid, q: "/equipment"),
+    ("clients_list", "GET", lambda pid, q: "/clients"),
+    ("material_search", "GET", lambda pid, q: f"/api/materials/search?q={q}"),
+    ("generate_budget", "POST", lambda pid, q: f"/projects/{pid}/generate_budget"),
+    ("export_pdf", "GET", lambda pid, q: f"/projects/{pid}/export_pdf"),
+)
+
+def bench_routes(civipro, users=5, projects=200, lines=60, catalog=2000, clients=50, rounds=50, seed=42,
+                 save=None, baseline=None, tolerance=50, cache=0):
+    # Sem o cache de páginas por padrão: mede a renderização, não o acerto no cache
+    if not cache:
+        civipro.page_cache.max_bytes = 0
+    start = time.perf_counter()
+    tenants = generate_tenants(civipro, users, projects, lines, catalog, clients, seed)
+    print(f"{users} inquilinos x {projects} projetos x {lines} linhas, {catalog} materiais próprios "
+          f"({time.perf_counter() - start:.1f} s para gerar)")
+
+    # A contagem de consultas vem do cabeçalho Server-Timing (ver /metrics)
+    civipro.SERVER_TIMING = True
+    rng = random.Random(seed)
+    clients_by_user = []
+    for user_id, email, project_ids in tenants:
+        client = civipro.app.test_client()
+        client.post("/login", data={"email": email, "password": "bench"})
+        clients_by_user.append((client, project_ids))
+
+    words = [word.lower() for word in SEARCH_WORDS + SEARCH_VARIANTS]
+    results = {}
+    print(f"{'rota':<18}{'p50':>10}{'p95':>10}{'consultas':>11}{'máx':>6}")
+    for label, method, url in ROUTES:
+        timings, queries = [], []
+        for i in range(rounds):
+            client, project_ids = clients_by_user[i % len(clients_by_user)]
+            path = url(rng.choice(project_ids), rng.choice(words)[:rng.randint(2, 6)])
+            started = time.perf_counter()
+            response = client.open(path, method=method)
+            timings.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                sys.exit(f"{label}: {method} {path} respondeu {response.status_code}")
+            match = re.search(r'desc="(\d+) consultas"', response.headers.get("Server-Timing", ""))
+            queries.append(int(match.group(1)) if match else 0)
+        results[label] = {"p50_ms": round(percentile(timings, 0.5) * 1000, 2),
+                          "p95_ms": round(percentile(timings, 0.95) * 1000, 2),
+                          "queries": round(sum(queries) / len(queries), 2)}
+        print(f"{label:<18}{results[label]['p50_ms']:>7.1f} ms{results[label]['p95_ms']:>7.1f} ms"
+              f"{results[label]['queries']:>11.1f}{max(queries):>6}")
+
+    if save:
+        with open(os.path.join(ROOT, save) if not os.path.isabs(save) else save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline:
+        with open(os.path.join(ROOT, baseline) if not os.path.isabs(baseline) else baseline) as f:
+            reference = json.load(f)
+        # Consultas por requisição são determinísticas; latência tem folga de `tolerance` %
+        regressions = []
+        for label, ref in reference.items():
+            current = results.get(label)
+            if current is None:
+                continue
+            if current["queries"] > ref["queries"]:
+                regressions.append(f"{label}: {ref['queries']} -> {current['queries']} consultas")
+            if current["p95_ms"] > ref["p95_ms"] * (1 + tolerance / 100):
+                regressions.append(f"{label}: p95 {ref['p95_ms']} -> {current['p95_ms']} ms")
+        if regressions:
+            sys.exit("regressões:\n  " + "\n  ".join(regressions))
+        print(f"sem regressões em relação a {baseline}")
+
+def bench_page_cache(civipro, projects=1000, lines=60, rounds=50):
+    user_id, email, project_ids = generate_tenants(civipro, 1, projects, lines, 500, 50)[0]
+    client = civipro.app.test_client()
+    client.post("/login", data={"email": email, "password": "bench"})
+    client.get("/dashboard")
+    max_bytes = civipro.page_cache.max_bytes
+
+    def timed(url, **kwargs):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            response = client.get(url, **kwargs)
+        return (time.perf_counter() - start) / rounds * 1000, response
+
+    print(f"{projects} projetos x {lines} linhas")
+    print(f"{'rota':<16}{'sem cache':>12}{'cache':>12}{'304':>12}{'após escrita':>15}")
+    for url in ("/dashboard", "/reports", f"/projects/{project_ids[0]}", "/projects", "/materials"):
+        civipro.page_cache.max_bytes = 0
+        uncached, _ = timed(url)
+        civipro.page_cache.max_bytes = max_bytes
+        client.get(url)
+        cached, response = timed(url)
+        not_modified, _ = timed(url, headers={"If-None-Match": response.headers["ETag"]})
+        client.post("/clients/add", data={"name": "Cliente Bench"})
+        client.get("/clients")
+        start = time.perf_counter()
+        client.get(url)
+        after_write = (time.perf_counter() - start) * 1000
+        print(f"{url:<16}{uncached:>9.2f} ms{cached:>9.2f} ms{not_modified:>9.2f} ms{after_write:>12.2f} ms")
+    print(civipro.page_cache.stats())
+
+def budget_snapshot(conn, user_id):
+    """Linhas e resumos dos projetos do usuário, para comparar dois caminhos de cálculo."""
+    lines = sorted((row[0], row[1], row[2], round(row[3], 6)) for row in conn.execute(
+        "SELECT project_id, item_type, material, cost FROM budgets WHERE user_id=?", (user_id,)
+    ))
+    projects = sorted((row[0], round(row[1] or 0, 6), row[2]) for row in conn.execute(
+        """SELECT p.id, s.estimated_total, s.line_count FROM projects p
+        LEFT JOIN project_cost_summary s ON s.project_id = p.id WHERE p.user_id=?""", (user_id,)
+    ))
+    return lines, projects
+
+def real_costs(conn, user_id):
+    return dict(conn.execute("SELECT id, real_cost FROM projects WHERE user_id=?", (user_id,)).fetchall())
+
+def bench_reprice(civipro, projects=500, lines=60, rounds=20):
+    """Troca de preço propagada pelas linhas afetadas contra regenerar todos os orçamentos."""
+    user_id, email, project_ids = generate_tenants(civipro, 1, projects, lines, 200, 5)[0]
+    client = civipro.app.test_client()
+    client.post("/login", data={"email": email, "password": "bench"})
+    conn = civipro.get_db_conn()
+    start = time.perf_counter()
+    civipro.regenerate_budgets(conn, user_id, civipro.ProjectRepository(conn, user_id).list())
+    full = time.perf_counter() - start
+    key, affected = conn.execute(
+        """SELECT item_key, COUNT(*) FROM budgets WHERE user_id=? AND item_type='material'
+        GROUP BY item_key ORDER BY COUNT(*) DESC, item_key LIMIT 1""", (user_id,)
+    ).fetchone()
+    item = next(row for row in conn.execute(f"SELECT * FROM {civipro.catalog_source('materials')}", (user_id, user_id))
+                if row["name"].lower() == key)
+    # Custo real digitado pelo usuário: a troca de preço não pode mexer nele
+    with civipro.write_transaction(conn):
+        conn.execute("UPDATE projects SET real_cost=90000 + id WHERE user_id=?", (user_id,))
+    typed = real_costs(conn, user_id)
+    conn.close()
+    print(f"{projects} projetos; '{item['name']}' aparece em {affected} linhas")
+
+    timings = []
+    for n in range(rounds):
+        price = round(item["price"] * (1 - (n + 1) / 100), 2)
+        start = time.perf_counter()
+        client.post(f"/materials/{item['id']}/edit", data={"name": item["name"], "unit": item["unit"],
+                                                           "price": str(price), "category": item["category"]})
+        timings.append(time.perf_counter() - start)
+
+    # A propagação tem de deixar linhas e resumos como uma regeneração
+    # completa deixaria, sem tocar no real_cost
+    conn = civipro.get_db_conn()
+    kept = real_costs(conn, user_id) == typed
+    repriced = budget_snapshot(conn, user_id)
+    civipro.regenerate_budgets(conn, user_id, civipro.ProjectRepository(conn, user_id).list())
+    regenerated = budget_snapshot(conn, user_id)
+    conn.close()
+
+    print(f"{'edição com propagação p50':<30}{percentile(timings, 0.5) * 1000:>9.1f} ms")
+    print(f"{'edição com propagação p99':<30}{percentile(timings, 0.99) * 1000:>9.1f} ms")
+    print(f"{'regenerar todos os projetos':<30}{full * 1000:>9.1f} ms")
+    line_diffs = sum(a != b for a, b in zip(*(snapshot[0] for snapshot in (repriced, regenerated))))
+    project_diffs = [a for a, b in zip(repriced[1], regenerated[1]) if a != b]
+    if not kept:
+        sys.exit("propagação alterou o real_cost digitado pelo usuário")
+    if line_diffs or project_diffs or len(repriced[0]) != len(regenerated[0]):
+        sys.exit(f"propagação diverge da regeneração: {line_diffs} linhas, {len(project_diffs)} projetos "
+                 f"(ex.: {project_diffs[:3]})")
+
+def _concurrency_worker(workdir, email, project_ids, requests, seed):
+    # Cada processo é um worker do gunicorn: app, pool e conexões próprios sobre o mesmo database.db
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app as civipro
+    # Filhos do multiprocessing não rodam init_db ao importar; aqui o processo faz as vezes do app
+    civipro.init_db()
+    civipro.app.config["TESTING"] = True
+    civipro.page_cache.max_bytes = 0
+    client = civipro.app.test_client()
+    client.post("/login", data={"email": email, "password": "bench"})
+
+    rng = random.Random(seed)
+    timings, errors = [], []
+    for i in range(requests):
+        roll = rng.random()
+        if roll < 0.7:
+            path, data = f"/projects/{rng.choice(project_ids)}/generate_budget", None
+        elif roll < 0.85:
+            path, data = "/projects/generate_budgets", {"project_ids": [str(pid) for pid in rng.sample(project_ids, 3)]}
+        else:
+            path, data = "/clients/add", {"name": f"Cliente {seed}-{i}"}
+        started = time.perf_counter()
+        try:
+            response = client.post(path, data=data)
+            if response.status_code >= 400:
+                errors.append(f"{path}: {response.status_code}")
+        except sqlite3.OperationalError as e:
+            errors.append(f"{path}: {e}")
+        timings.append(time.perf_counter() - started)
+    return timings, errors, dict(civipro.write_stats)
+
+def bench_concurrency(civipro, workers=8, requests=40, projects=20, lines=60, busy_timeout=None, retries=None):
+    # Os workers leem DB_BUSY_TIMEOUT/DB_WRITE_RETRIES do ambiente ao importar o app
+    if busy_timeout is not None:
+        os.environ["DB_BUSY_TIMEOUT"] = str(busy_timeout)
+    if retries is not None:
+        os.environ["DB_WRITE_RETRIES"] = str(retries)
+    tenants = generate_tenants(civipro, workers, projects, lines, 200, 20)
+    print(f"{workers} processos x {requests} escritas (gerar orçamento, regenerar em lote, cadastrar cliente), "
+          f"{projects} projetos x {lines} linhas por inquilino")
+
+    context = multiprocessing.get_context("spawn")
+    jobs = [(os.getcwd(), email, project_ids, requests, n) for n, (_, email, project_ids) in enumerate(tenants)]
+    start = time.perf_counter()
+    with context.Pool(workers) as pool:
+        results = pool.starmap(_concurrency_worker, jobs)
+    elapsed = time.perf_counter() - start
+
+    timings = [t for worker_timings, _, _ in results for t in worker_timings]
+    errors = [e for _, worker_errors, _ in results for e in worker_errors]
+    stats = {key: sum(worker_stats[key] for _, _, worker_stats in results) for key in results[0][2]}
+    conn = civipro.get_db_conn()
+    drifted = civipro.rebuild_cost_summary(conn)
+    conn.rollback()
+    conn.close()
+
+    print(f"{'escritas por segundo':<28}{len(timings) / elapsed:>10.1f}")
+    print(f"{'latência p50':<28}{percentile(timings, 0.5) * 1000:>7.1f} ms")
+    print(f"{'latência p99':<28}{percentile(timings, 0.99) * 1000:>7.1f} ms")
+    print(f"{'transações':<28}{stats['transactions']:>10}")
+    print(f"{'BEGIN repetidos':<28}{stats['busy_retries']:>10}")
+    print(f"{'erros':<28}{len(errors):>10}")
+    print(f"{'resumos divergentes':<28}{len(drifted):>10}")
+    if errors or drifted:
+        sys.exit("falhas sob concorrência:\n  " + "\n  ".join(errors[:10]))
+
+# Campos que mudam a cada execução (horários) ficam fora da comparação
+VOLATILE_KEYS = {"created_at", "updated_at", "regenerated_at", "generated_at", "effective_at", "as_of", "next_cursor"}
+
+def normalize_result(value):
+    if isinstance(value, float):
+        return round(value, 2)
+    if isinstance(value, dict):
+        return {key: normalize_result(item) for key, item in value.items() if key not in VOLATILE_KEYS}
+    if isinstance(value, (list, tuple)):
+        return [normalize_result(item) for item in value]
+    return value
+
+def _backend_worker(db_url, projects, lines):
+    """Roda o mesmo roteiro de rotas num banco vazio e devolve [(passo, resultado, segundos)]."""
+    os.environ["DB_URL"] = db_url
+    os.chdir(tempfile.mkdtemp(prefix="civipro_backend_"))
+    sys.path.insert(0, ROOT)
+    import app as civipro
+    civipro.init_db()  # cria o esquema no banco vazio
+    client = civipro.app.test_client()
+    steps = []
+
+    def step(name, call):
+        start = time.perf_counter()
+        result = call()
+        steps.append((name, normalize_result(result), time.perf_counter() - start))
+        return result
+
+    def get_json(url):
+        response = client.get(url)
+        return response.status_code, response.get_json()
+
+    def post(url, data=None):
+        return client.post(url, data=data).status_code
+
+    step("cadastro", lambda: [post("/register", {"name": "Paridade", "email": email, "password": "senha"})
+                              for email in ("paridade@civipro.local", "outro@civipro.local")])
+    step("login", lambda: post("/login", {"email": "paridade@civipro.local", "password": "senha"}))
+    step("clientes e fornecedores", lambda: [
+        post("/clients/add", {"name": f"Cliente {n}", "email": f"c{n}@x.com"}) for n in range(5)
+    ] + [post("/suppliers/add", {"name": f"Fornecedor {n}", "category": "estrutura"}) for n in range(3)]
+      + [post("/clients/2/edit", {"name": "Cliente Dois"}), post("/clients/3/delete")])
+    step("projetos", lambda: [
+        post("/projects/add", {"name": f"Obra {n}", "area": str(40 + n * 7), "finish": ("simples", "medio", "alto")[n % 3],
+                               "client_id": "1" if n % 2 else "", "client_name": "Avulso"})
+        for n in range(projects)
+    ])
+    step("editar projeto", lambda: post("/projects/2/edit", {"name": "Obra Dois", "area": "120", "finish": "alto",
+                                                             "status": "concluido", "real_cost": "1000"}))
+    step("gerar orçamentos", lambda: post("/projects/generate_budgets"))
+    as_of = datetime.utcnow().isoformat()
+    time.sleep(0.01)
+    step("editar catálogo", lambda: [
+        post("/materials/1/edit", {"name": "Cimento", "unit": "sacos", "price": "41.5", "category": "estrutura"}),
+        post("/materials/add", {"name": "Manta asfáltica", "unit": "m²", "price": "38", "category": "acabamento"}),
+        post("/labor/2/delete"),
+        post("/equipment/1/edit", {"name": "Betoneira 400L", "category": "maquina", "unit": "dia", "price": "95"}),
+    ])
+    step("regenerar um orçamento", lambda: post("/projects/1/generate_budget"))
+    step("excluir projeto", lambda: post(f"/projects/{projects}/delete"))
+    step("listas", lambda: [get_json(f"/api/{table}?limit={lines}") for table in
+                            ("projects", "materials", "clients", "suppliers", "labor", "equipment")])
+    step("lista filtrada", lambda: get_json("/api/materials?q=ci&sort=preco&limit=5"))
+    # A ordem por relevância difere entre FTS5 e tsvector: compara só o conjunto
+    step("busca", lambda: [sorted((item["kind"], item["name"]) for item in get_json(f"/api/search?q={q}")[1])
+                           for q in ("cim", "areia fina", "betoneira", "cliente", "pedreiro")])
+    step("orçamento na data", lambda: get_json(f"/api/budgets/as_of?date={as_of}&lines=1"))
+    step("exportar CSV", lambda: [line.split(",")[:9] for line in
+                                  client.get("/reports/export.csv").get_data(as_text=True).splitlines()[:lines]])
+    step("PDF", lambda: [client.get(f"/projects/{pid}/export_pdf").status_code for pid in (1, 2)])
+    step("páginas", lambda: [client.get(url).status_code for url in
+                             ("/dashboard", "/projects", "/projects/1", "/materials", "/reports", "/simulator")])
+    path = os.path.join(os.getcwd(), "precos.csv")
+    write_sinapi_csv(path, 500, increase=0.1)
+    conn = civipro.get_db_conn()
+    user_id = civipro.UserRepository(conn).get_by_email("paridade@civipro.local")["id"]
+    step("importar catálogo", lambda: {key: value for key, value in
+                                       civipro.import_catalog(conn, user_id, "materials", civipro.read_price_table(path)).items()
+                                       if key != "changes"})
+    conn.close()
+    step("lista depois da importação", lambda: get_json("/api/materials?sort=preco&limit=20"))
+    return steps
+
+def bench_backends(civipro, pg_url=None, projects=10, lines=200):
+    """Roda o mesmo roteiro no SQLite e no PostgreSQL e falha se algum resultado divergir.
+
+    O PostgreSQL vem de --pg-url ou DB_URL_TEST; cada execução usa um schema novo, apagado no fim."""
+    pg_url = pg_url or os.environ.get("DB_URL_TEST")
+    if not pg_url:
+        sys.exit("informe --pg-url=postgresql://... ou DB_URL_TEST")
+    import psycopg
+    schema = f"civipro_bench_{os.getpid()}"
+    admin = psycopg.connect(pg_url, autocommit=True)
+    admin.execute(f"CREATE SCHEMA {schema}")
+    backends = {
+        "sqlite": "",
+        "postgresql": f"{pg_url}{'&' if '?' in pg_url else '?'}options=-csearch_path%3D{schema}",
+    }
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    try:
+        for name, db_url in backends.items():
+            with context.Pool(1) as pool:
+                results[name] = pool.apply(_backend_worker, (db_url, projects, lines))
+    finally:
+        admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.close()
+
+    print(f"{'passo':<30}{'sqlite':>10}{'postgresql':>12}")
+    mismatches = []
+    for (step, sqlite_result, sqlite_time), (_, pg_result, pg_time) in zip(results["sqlite"], results["postgresql"]):
+        same = sqlite_result == pg_result
+        print(f"{step:<30}{sqlite_time * 1000:>7.1f} ms{pg_time * 1000:>9.1f} ms  {'ok' if same else 'DIVERGE'}")
+        if not same:
+            mismatches.append(f"{step}:\n    sqlite     {json.dumps(sqlite_result, ensure_ascii=False)[:300]}"
+                              f"\n    postgresql {json.dumps(pg_result, ensure_ascii=False)[:300]}")
+    if mismatches:
+        sys.exit("resultados diferentes entre os bancos:\n  " + "\n  ".join(mismatches))
+
+# Construções que o SQLite aceita e o PostgreSQL não (procuradas fora das strings)
+SQLITE_ONLY_SQL = (
+    (r"\bINSERT\s+OR\b", "INSERT OR ..."),
+    (r"\bstrftime\s*\(", "strftime()"),
+    (r"\bdatetime\s*\(", "datetime()"),
+    (r"\bIFNULL\s*\(", "IFNULL()"),
+    (r"\bGROUP_CONCAT\s*\(", "GROUP_CONCAT()"),
+    (r"\browid\b", "rowid"),
+    (r"\bAUTOINCREMENT\b", "AUTOINCREMENT"),
+    (r"\bIMMEDIATE\b", "BEGIN IMMEDIATE"),
+    (r"\bMATCH\b", "MATCH do FTS5"),
+    (r"\bIS\s+(?!NOT\b|NULL\b|DISTINCT\b|TRUE\b|FALSE\b)", "a IS b (use IS NOT DISTINCT FROM)"),
+    (r"\bIS\s+NOT\s+(?!NULL\b|DISTINCT\b|TRUE\b|FALSE\b)", "a IS NOT b (use IS DISTINCT FROM)"),
+)
+
+class _RecordingCursor:
+    """Cursor do psycopg de mentira: guarda o SQL já traduzido e devolve as linhas da fila."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.rowcount = 0
+
+    def execute(self, sql, parameters=()):
+        self.raw.statements.append((sql, [tuple(parameters)]))
+
+    def executemany(self, sql, seq_of_parameters):
+        self.raw.statements.append((sql, [tuple(parameters) for parameters in seq_of_parameters]))
+
+    def fetchone(self):
+        return self.raw.rows.pop(0) if self.raw.rows else None
+
+    def fetchall(self):
+        return []
+
+    def __iter__(self):
+        return iter(())
+
+class _RecordingRaw:
+    def __init__(self):
+        self.statements = []
+        self.rows = []
+
+    def cursor(self, row_factory=None):
+        return _RecordingCursor(self)
+
+def _postgres_statement_errors(sql, params_list):
+    text = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    errors = [f"{label}: {' '.join(sql.split())[:120]}" for pattern, label in SQLITE_ONLY_SQL
+              if re.search(pattern, text, re.IGNORECASE)]
+    if "?" in text:
+        errors.append(f"marcador ? sem tradução: {' '.join(sql.split())[:120]}")
+    placeholders = text.replace("%%", "").count("%s")
+    errors += [f"{placeholders} marcadores e {len(params)} parâmetros: {' '.join(sql.split())[:120]}"
+               for params in params_list if len(params) != placeholders]
+    return errors
+
+def bench_postgres_sql(civipro):
+    """Confere o SQL que a camada de repositórios manda ao PostgreSQL, sem servidor.
+
+    Os métodos rodam sobre a PostgresConnection de verdade com um cursor que só
+    grava os comandos; cada um é conferido quanto a marcadores e parâmetros e a
+    construções que só o SQLite aceita. Confere também o contador do pool quando
+    o getconn() falha e as migrações equivalentes do PostgreSQL."""
+    errors = []
+    sqlite_versions = {version for version, _, _ in civipro.MIGRATIONS if version > 14}
+    postgres_versions = {version for version, _, _ in civipro.POSTGRES_MIGRATIONS if version > 14}
+    if sqlite_versions != postgres_versions:
+        errors.append(f"migrações sem equivalente no PostgreSQL: {sorted(sqlite_versions ^ postgres_versions)}")
+    if civipro.psycopg is None:
+        sys.exit("psycopg não instalado (pip install \".[postgres]\")")
+
+    def row(**values):
+        return civipro.PostgresRow(tuple(values.values()), {key: i for i, key in enumerate(values)})
+
+    shared = row(id=7, user_id=None, base_id=None, name="Cimento")
+    own = row(id=9, user_id=1, base_id=None, name="Cimento")
+    override = row(id=8, user_id=1, base_id=7, name="Cimento")
+    new_id = row(id=42)
+    now = datetime.utcnow().isoformat()
+    summary = (1, 1, 10.0, 10.0, 0.0, 0.0, 1, now)
+    # (descrição, linhas devolvidas pelos fetchone() em ordem, chamada)
+    calls = [
+        ("UserRepository.get", [], lambda c: civipro.UserRepository(c).get(1)),
+        ("UserRepository.get_by_email", [], lambda c: civipro.UserRepository(c).get_by_email("a@b")),
+        ("UserRepository.create", [new_id], lambda c: civipro.UserRepository(c).create("A", "a@b", "h", 7)),
+        ("UserRepository.set_subscription", [], lambda c: civipro.UserRepository(c).set_subscription(1, "s", "basic")),
+        ("UserRepository.set_status", [], lambda c: civipro.UserRepository(c).set_status(1, "active")),
+        ("UserRepository.expire_trials", [], lambda c: civipro.UserRepository(c).expire_trials(0)),
+        ("ProjectRepository.get", [], lambda c: civipro.ProjectRepository(c, 1).get(1)),
+        ("ProjectRepository.list", [], lambda c: civipro.ProjectRepository(c, 1).list()),
+        ("ProjectRepository.list(ids)", [], lambda c: civipro.ProjectRepository(c, 1).list([1, 2])),
+        ("ProjectRepository.create", [new_id], lambda c: civipro.ProjectRepository(c, 1).create({"name": "Obra", "area": 10})),
+        ("ProjectRepository.update", [], lambda c: civipro.ProjectRepository(c, 1).update(1, {"name": "Obra"})),
+        ("ProjectRepository.delete", [row(id=1)], lambda c: civipro.ProjectRepository(c, 1).delete(1)),
+        ("BudgetRepository.lines", [], lambda c: civipro.BudgetRepository(c).lines(1)),
+        ("BudgetRepository.rows_by_project", [], lambda c: civipro.BudgetRepository(c).rows_by_project([1, 2])),
+        ("BudgetRepository.summaries", [], lambda c: civipro.BudgetRepository(c).summaries([1, 2])),
+        ("BudgetRepository.replace", [], lambda c: civipro.BudgetRepository(c).replace(
+            [1], [(1, 1, "material", "Cimento", "cimento", 2.0, "sacos", 70.0, now)], [(70.0, 1)], [summary])),
+        ("BudgetRepository.price_keys", [], lambda c: civipro.BudgetRepository(c).price_keys(1, "material")),
+        ("BudgetRepository.price_key_owners", [], lambda c: civipro.BudgetRepository(c).price_key_owners("material")),
+        ("BudgetRepository.reprice", [], lambda c: civipro.BudgetRepository(c).reprice(1, "material", "cimento", 35.0)),
+        ("load_price_map", [], lambda c: civipro.load_price_map(c, 1, "materials")),
+        ("load_price_maps_as_of", [], lambda c: civipro.load_price_maps_as_of(c, 1, now)),
+        ("rebuild_cost_summary", [], lambda c: civipro.rebuild_cost_summary(c, [1, 2])),
+    ]
+    for table in civipro.CATALOG_TABLES + ("clients",):
+        fields = {"name": "Cimento", "price": 35.0} if table in civipro.CATALOG_TABLES else {"name": "Ana"}
+        catalog = lambda c, table=table: civipro.CatalogRepository(c, table, 1)
+        calls += [
+            (f"CatalogRepository({table}).get", [], lambda c, catalog=catalog: catalog(c).get(1)),
+            (f"CatalogRepository({table}).list", [], lambda c, catalog=catalog: catalog(c).list()),
+            (f"CatalogRepository({table}).add", [new_id], lambda c, catalog=catalog, fields=fields: catalog(c).add(fields)),
+        ]
+        for label, rows in (("compartilhado", [shared, None]), ("sobrescrito", [shared, override]),
+                            ("próprio", [own]), ("sobrescrita", [override])):
+            calls += [
+                (f"CatalogRepository({table}).save {label}", list(rows),
+                 lambda c, catalog=catalog, fields=fields: catalog(c).save(7, fields)),
+                (f"CatalogRepository({table}).delete {label}", list(rows),
+                 lambda c, catalog=catalog: catalog(c).delete(7)),
+            ]
+
+    statements = 0
+    for label, rows, call in calls:
+        raw = _RecordingRaw()
+        raw.rows = rows
+        try:
+            call(civipro.PostgresConnection(raw, None))
+        except Exception as e:
+            errors.append(f"{label}: {type(e).__name__}: {e}")
+        for sql, params_list in raw.statements:
+            errors += [f"{label}: {error}" for error in _postgres_statement_errors(sql, params_list)]
+        statements += len(raw.statements)
+
+    # O pool só conta a conexão depois que o getconn() dá certo
+    class FailingPool:
+        def getconn(self):
+            raise civipro.psycopg.OperationalError("pool esgotado")
+
+        def get_stats(self):
+            return {}
+
+    pool = civipro.PostgresPool("postgresql://localhost/civipro", 1)
+    pool.pid, pool._pool = os.getpid(), FailingPool()
+    for _ in range(3):
+        try:
+            pool.acquire()
+        except civipro.psycopg.OperationalError:
+            pass
+    if pool.stats()["in_use"]:
+        errors.append(f"pool: in_use={pool.stats()['in_use']} depois de três getconn() com falha")
+
+    print(f"{len(calls)} chamadas, {statements} comandos conferidos")
+    if errors:
+        sys.exit("SQL incompatível com o PostgreSQL:\n  " + "\n  ".join(errors))
+    print(f"{'SQL do PostgreSQL':<30}{'ok':>10}")
+
+BENCHMARKS = {
+    "connections": bench_connections,
+    "query_plans": bench_query_plans,
+    "budgets": bench_budgets,
+    "quantities": bench_quantities,
+    "simulation": bench_simulation,
+    "export": bench_export,
+    "pdf": bench_pdf,
+    "lists": bench_lists,
+    "search": bench_search,
+    "as_of": bench_as_of,
+    "import": bench_import,
+    "signup": bench_signup,
+    "webhooks": bench_webhooks,
+    "subscriptions": bench_subscriptions,
+    "instrumentation": bench_instrumentation,
+    "routes": bench_routes,
+    "page_cache": bench_page_cache,
+    "concurrency": bench_concurrency,
+    "reprice": bench_reprice,
+    "backends": bench_backends,
+    "postgres_sql": bench_postgres_sql,
+}
+
+def parse_args(args):
+    names, options = [], {}
+    for arg in args:
+        if arg.startswith("--"):
+            key, _, value = arg[2:].partition("=")
+            if "," in value:
+                value = tuple(int(part) for part in value.split(","))
+            elif value.isdigit():
+                value = int(value)
+            options[key.replace("-", "_")] = value
+        else:
+            names.append(arg)
+    return names, options
+
+if __name__ == "__main__":
+    names, options = parse_args(sys.argv[1:])
+    civipro = load_app()
+    for name in names or list(BENCHMARKS):
+        print(f"== {name}")
+        bench = BENCHMARKS[name]
+        accepted = inspect.signature(bench).parameters
+        bench(civipro, **{key: value for key, value in options.items() if key in accepted})